@@ -3,6 +3,14 @@ from .lists import *
 from .filesys import Filesys
 from .user import User
 from .host import Host
+from .audit import OwnershipAudit
+from .cache import QueryCache
+from .threaded import SharedClient
+from .concurrency import AdaptiveLimiter
+from .directory import UserDirectory
+from .mirror import Mirror, MirrorClient
+from .rights import RightsCalculator
+from .watch import ListWatcher
 from .stubs import *
 from .errors import *
 from . import constants 
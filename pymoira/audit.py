@@ -0,0 +1,75 @@
+#
+## PyMoira client library
+##
+## This file contains the tools for auditing the ownership of Moira objects
+## by many owners at once.
+#
+
+from . import constants
+from . import protocol
+from .errors import *
+from .lists import Owner
+
+class OwnershipAudit(object):
+    """Determines which objects are owned by each of the specified owners (users
+    and lists). The get_ace_use queries for all owners are pipelined over a single
+    connection, and the objects owned by several owners are represented by the same
+    object. After the audit is run, the owned dictionary maps each owner to the list
+    of the objects it owns, and the owners dictionary maps each object to the list
+    of its owners."""
+
+    def __init__(self, client, owners, recursive = False, window = protocol.MOIRA_PIPELINE_WINDOW):
+        self.client = client
+        self.recursive = recursive
+        self.window = window
+
+        self.objects = {}
+        self.owned = {}
+        self.owners = {}
+        self.denied = set()
+
+        self.run(owners)
+
+    def getObject(self, mtype, name):
+        """Returns the shared object of a given type and name, constructing it if
+        it was not encountered before."""
+
+        key = (mtype, name)
+        if key not in self.objects:
+            self.objects[key] = Owner.createOwnedObject(self.client, mtype, name)
+        return self.objects[key]
+
+    def run(self, owners):
+        """Fetches the objects owned by the owners which were not audited before
+        and adds them to the indices."""
+
+        owners = [owner for owner in set(owners) if owner not in self.owned]
+        queries = (owner.getOwnedObjectsQuery(self.recursive) for owner in owners)
+        results = self.client.pipeline(queries, version = 14, window = self.window)
+
+        for owner, response in zip(owners, results):
+            if isinstance(response, MoiraError):
+                if response.code == constants.MR_NO_MATCH:
+                    response = ()
+                elif response.code == constants.MR_PERM:
+                    self.denied.add(owner)
+                    response = ()
+                else:
+                    raise response
+
+            owned = []
+            for mtype, name in response:
+                m = self.getObject(mtype, name)
+                if m is None:
+                    continue
+                owned.append(m)
+                self.owners.setdefault(m, []).append(owner)
+            self.owned[owner] = owned
+
+    def ownersOf(self, mtype, name):
+        """Returns the list of audited owners of the object of a given type and name."""
+
+        key = (mtype, name)
+        if key not in self.objects:
+            return []
+        return self.owners.get(self.objects[key], [])
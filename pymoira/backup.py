@@ -0,0 +1,382 @@
+#
+## PyMoira client library
+##
+## This file contains the tools for backing up lists into JSON Lines files
+## (one serialized list per line).
+#
+
+import json
+import os
+
+from . import constants
+from . import utils
+from .errors import *
+from .lists import List, ListMember
+
+class ListExporter(object):
+    """Writes the serialized lists (see List.serialize()) into a JSON Lines stream.
+    The lists are processed in batches: for every list of the batch, the list
+    information and the tagged members are requested at the same time through
+    the pipeline, and the record is written as soon as both are received, so only
+    the current batch is kept in memory. If the checkpoint file is specified, the
+    progress is stored there after every batch, and an interrupted export may be
+    resumed by creating the exporter with the same checkpoint file.
+
+    The names of the lists which could not be exported because of the lack of
+    permissions are collected in denied, and the ones which do not exist (or were
+    deleted while the export was running) are collected in missing."""
+
+    def __init__(self, client, output, checkpoint = None, recursive = True, batch_size = 64):
+        self.client = client
+        self.output = output
+        self.checkpoint = checkpoint
+        self.recursive = recursive
+        self.batch_size = batch_size
+
+        self.done = set()
+        self.pending = []
+        self.denied = set()
+        self.missing = set()
+
+        # The get_list_info rows already received for the pending lists
+        self.info = {}
+
+        self.loadCheckpoint()
+
+    def loadCheckpoint(self):
+        """Restores the export state from the checkpoint file, if it exists. If the
+        output is a regular file, it is truncated to the size it had at the moment
+        the checkpoint was made, so no records are duplicated."""
+
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+
+        with open(self.checkpoint, 'r') as checkpoint_file:
+            state = json.load(checkpoint_file)
+
+        self.done = set( str(name) for name in state['done'] )
+        self.pending = [ str(name) for name in state['pending'] ]
+        self.denied = set( str(name) for name in state['denied'] )
+        self.missing = set( str(name) for name in state.get('missing', ()) )
+        if hasattr(self.output, 'truncate'):
+            self.output.seek(state['offset'])
+            self.output.truncate()
+
+    def saveCheckpoint(self):
+        """Atomically stores the export state into the checkpoint file."""
+
+        if not self.checkpoint:
+            return
+
+        self.output.flush()
+        state = {
+            'done' : sorted(self.done),
+            'pending' : self.pending,
+            'denied' : sorted(self.denied),
+            'missing' : sorted(self.missing),
+            'offset' : self.output.tell() if hasattr(self.output, 'tell') else 0,
+        }
+        temp_name = "%s.%i" % (self.checkpoint, os.getpid())
+        with open(temp_name, 'w') as checkpoint_file:
+            json.dump(state, checkpoint_file)
+        os.rename(temp_name, self.checkpoint)
+
+    def add(self, names):
+        """Schedules the lists with the specified names to be exported."""
+
+        queued = set(self.pending)
+        for name in names:
+            if name not in self.done and name not in queued:
+                self.pending.append(name)
+                queued.add(name)
+
+    def addWildcard(self, pattern):
+        """Schedules all the lists matching the wildcard pattern to be exported. The
+        list information received here is kept, so it is not requested again."""
+
+        names = []
+        for row in self.client.iterQuery( 'get_list_info', (pattern, ), version = 14 ):
+            name = row[0]
+            if name not in self.done:
+                self.info[name] = row
+            names.append(name)
+        self.add(names)
+
+    def exportBatch(self, names):
+        """Exports the lists with given names and returns the list of the names of
+        their sublists."""
+
+        queries = []
+        for name in names:
+            if name not in self.info:
+                queries.append( ('get_list_info', (name, )) )
+            queries.append( ('get_tagged_members_of_list', (name, )) )
+        results = iter( self.client.pipeline(queries, version = 14) )
+
+        sublists = []
+        for name in names:
+            info = ( self.info.pop(name), ) if name in self.info else next(results)
+            members = next(results)
+            self.done.add(name)
+
+            errors = [response for response in (info, members) if isinstance(response, MoiraError)]
+            for err in errors:
+                if err.code not in (constants.MR_PERM, constants.MR_NO_MATCH, constants.MR_LIST):
+                    raise err
+            if errors:
+                if any(err.code == constants.MR_PERM for err in errors):
+                    self.denied.add(name)
+                else:
+                    self.missing.add(name)
+                continue
+
+            mlist = List(self.client, name)
+            mlist.loadInfoFromResponse(info[0])
+            members = [ ListMember.fromTuple(self.client, member) for member in members ]
+            self.output.write( json.dumps(mlist.serializeLoaded(members), sort_keys = True) + "\n" )
+
+            sublists += [ member.name for member in members if member.mtype == ListMember.List ]
+
+        return sublists
+
+    def run(self, progress = None):
+        """Exports all scheduled lists (and their sublists, if the export is recursive).
+        If progress callback is specified, it is called after every batch with the
+        number of lists exported and the number of lists still pending."""
+
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            sublists = self.exportBatch(batch)
+            if self.recursive:
+                self.add(sublists)
+
+            self.saveCheckpoint()
+            if progress:
+                progress( len(self.done), len(self.pending) )
+
+        self.output.flush()
+
+def exportLists(client, names, path, checkpoint = None, recursive = True, wildcard = None):
+    """Exports the specified lists (and their sublists, if recursive is set) into
+    a JSON Lines file. If wildcard is specified, the lists matching it are exported
+    as well. If checkpoint file is specified and exists, the previous interrupted
+    export into the same file is resumed; if the output file no longer exists, the
+    export is started over. The names of the lists which were denied or not found
+    are available in the denied and missing attributes of the returned exporter."""
+
+    resuming = checkpoint is not None and os.path.exists(checkpoint)
+    if resuming and not os.path.exists(path):
+        # The records written before the interruption are lost
+        os.remove(checkpoint)
+        resuming = False
+    with open(path, 'r+' if resuming else 'w') as output:
+        exporter = ListExporter(client, output, checkpoint, recursive)
+        if not resuming:
+            exporter.add(names)
+            if wildcard:
+                exporter.addWildcard(wildcard)
+        exporter.run()
+
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    return exporter
+
+def readRecords(source):
+    """Yields the serialized lists from a JSON Lines file (either a path or
+    a file object)."""
+
+    if isinstance(source, str):
+        with open(source, 'r') as input_file:
+            for record in readRecords(input_file):
+                yield record
+        return
+
+    for line in source:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def _recordValue(value):
+    """Converts a value from a serialized list into Moira protocol representation."""
+
+    if isinstance(value, (bool, int)):
+        return utils.convertToMoiraValue(value)
+    if not isinstance(value, str):
+        value = value.encode('utf-8')
+    return value
+
+class RestoreResult(object):
+    """Describes what was (or, in case of a dry run, would be) changed in a list
+    when it was restored from a serialized record."""
+
+    def __init__(self, name):
+        self.name = name
+        self.created = False
+        self.updated = {}
+        self.added = []
+        self.removed = []
+        self.retagged = []
+        self.errors = []
+
+    def changed(self):
+        return bool(self.created or self.updated or self.added or self.removed or self.retagged)
+
+    def __repr__(self):
+        return "<RestoreResult %s: created=%s, updated=%i, added=%i, removed=%i, retagged=%i, errors=%i>" % \
+            (self.name, self.created, len(self.updated), len(self.added), len(self.removed), len(self.retagged), len(self.errors))
+
+class ListRestorer(object):
+    """Brings the lists on the server into the state described by the serialized
+    records (see List.serialize()). The current state of the lists is fetched in
+    batches through the pipeline and compared with the records, and only the
+    operations required to reconcile them are sent, again pipelined. List settings
+    are applied before the memberships, and the operations which fail because
+    a list they refer to does not exist yet are retried after all records were
+    processed, so a whole hierarchy may be restored into an empty server.
+
+    If remove_members is not set, the members which are not in the record are
+    kept on the list. If dry_run is set, nothing is changed on the server, but
+    the report describes the changes which would be made."""
+
+    # The fields which may be set through update_list, in the order of its arguments
+    update_fields = List.info_query_description[:-3]
+
+    # Errors which may be caused by a list being restored before the lists it refers to
+    retry_errors = (constants.MR_LIST, constants.MR_ACE)
+
+    def __init__(self, client, remove_members = True, dry_run = False, batch_size = 64):
+        self.client = client
+        self.remove_members = remove_members
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+
+        self.results = []
+        self.deferred = []
+
+    def planList(self, record, info, members, result):
+        """Returns the queries which reconcile the list with the record given the
+        current get_list_info and get_tagged_members_of_list responses (None if
+        the list does not exist)."""
+
+        name = result.name
+        target = [ _recordValue(record[field]) if record.get(field) is not None else None for field, field_type in self.update_fields ]
+
+        settings = []
+        if info is None:
+            result.created = True
+            current_members = {}
+            target = [ value if value is not None else constants.UNIQUE_GID for value in target ]
+            settings.append( ('add_list', target) )
+        else:
+            current = list(info[:len(self.update_fields)])
+            target = [ value if value is not None else current[i] for i, value in enumerate(target) ]
+            for i, (field, field_type) in enumerate(self.update_fields):
+                if current[i] != target[i]:
+                    result.updated[field] = (current[i], target[i])
+            if result.updated:
+                settings.append( ('update_list', [name] + target) )
+            current_members = { (mtype, mname) : tag for mtype, mname, tag in members }
+            name = target[0]
+
+        memberships = []
+        target_members = {}
+        for member in record.get('members', ()):
+            mtype, mname = _recordValue(member[0]), _recordValue(member[1])
+            tag = _recordValue(member[2]) if len(member) > 2 else ""
+            target_members[(mtype, mname)] = tag
+
+            if (mtype, mname) not in current_members:
+                result.added.append( (mtype, mname, tag) )
+                memberships.append( ('add_tagged_member_to_list', (name, mtype, mname, tag)) )
+            elif current_members[(mtype, mname)] != tag:
+                result.retagged.append( (mtype, mname, tag) )
+                memberships.append( ('tag_member_of_list', (name, mtype, mname, tag)) )
+
+        if self.remove_members:
+            for mtype, mname in sorted(current_members):
+                if (mtype, mname) not in target_members:
+                    result.removed.append( (mtype, mname) )
+                    memberships.append( ('delete_member_from_list', (name, mtype, mname)) )
+
+        return settings, memberships
+
+    def execute(self, operations):
+        """Runs the (result, query) operations pipelined. Failures are recorded in
+        the results, except for the ones which are deferred to be retried later."""
+
+        if self.dry_run or not operations:
+            return
+
+        queries = ( query for result, query in operations )
+        for (result, query), response in zip(operations, self.client.pipeline(queries, version = 14)):
+            if isinstance(response, MoiraError):
+                if response.code in self.retry_errors:
+                    self.deferred.append( (result, query, response) )
+                else:
+                    result.errors.append( (query, response) )
+
+    def restoreBatch(self, records):
+        """Restores the lists from a batch of records."""
+
+        queries = []
+        for record in records:
+            name = _recordValue(record['name'])
+            queries.append( ('get_list_info', (name, )) )
+            queries.append( ('get_tagged_members_of_list', (name, )) )
+        responses = iter( self.client.pipeline(queries, version = 14) )
+
+        settings, memberships = [], []
+        for record in records:
+            result = RestoreResult( _recordValue(record['name']) )
+            self.results.append(result)
+
+            info, members = next(responses), next(responses)
+            if isinstance(info, MoiraError):
+                if info.code != constants.MR_NO_MATCH:
+                    result.errors.append( (('get_list_info', (result.name, )), info) )
+                    continue
+                info, members = None, ()
+            elif isinstance(members, MoiraError):
+                result.errors.append( (('get_tagged_members_of_list', (result.name, )), members) )
+                continue
+            else:
+                info = info[0]
+
+            list_settings, list_memberships = self.planList(record, info, members, result)
+            settings += [ (result, query) for query in list_settings ]
+            memberships += [ (result, query) for query in list_memberships ]
+
+        self.execute(settings)
+        self.execute(memberships)
+
+    def restore(self, records):
+        """Restores the lists from an iterable of serialized records and returns the
+        list of RestoreResult objects describing the changes."""
+
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                self.restoreBatch(batch)
+                batch = []
+        if batch:
+            self.restoreBatch(batch)
+
+        # Retry the operations which failed because of the missing lists until no more progress is made
+        while self.deferred:
+            deferred, self.deferred = self.deferred, []
+            self.execute( [ (result, query) for result, query, err in deferred ] )
+            if len(self.deferred) == len(deferred):
+                for result, query, err in self.deferred:
+                    result.errors.append( (query, err) )
+                self.deferred = []
+
+        return self.results
+
+def restoreLists(client, source, remove_members = True, dry_run = False):
+    """Restores the lists from a JSON Lines file produced by exportLists() and
+    returns the report (list of RestoreResult objects)."""
+
+    restorer = ListRestorer(client, remove_members, dry_run)
+    return restorer.restore( readRecords(source) )
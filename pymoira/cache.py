@@ -0,0 +1,331 @@
+#
+## PyMoira client library
+##
+## This file contains the read-through cache for the results of Moira queries.
+#
+
+import collections
+import hashlib
+import json
+import os
+import stat
+import threading
+
+from .errors import *
+
+#
+# Classification of the queries. Every read-only query depends on some of the
+# tables below, and every write query modifies some of them; the cache entries
+# of a read query are invalidated when any of the tables it depends on is modified.
+#
+# The read-only queries which are not listed depend on the special '*' table,
+# which is modified by every write query. The queries which are not known to be
+# read-only are treated as the write queries modifying all tables.
+#
+read_queries = {
+    'get_list_info' : ('list', ),
+    'expand_list_names' : ('list', ),
+    'get_members_of_list' : ('members', ),
+    'get_tagged_members_of_list' : ('members', ),
+    'get_end_members_of_list' : ('members', ),
+    'count_members_of_list' : ('members', ),
+    'get_lists_of_member' : ('list', 'members'),
+    'get_ace_use' : ('list', 'members', 'filesys', 'quota', 'machine', 'other'),
+    'get_user_account_by_login' : ('user', ),
+    'get_user_account_by_uid' : ('user', ),
+    'get_user_account_by_name' : ('user', ),
+    'get_user_account_by_class' : ('user', ),
+    'get_user_account_by_id' : ('user', ),
+    'get_filesys_by_label' : ('filesys', ),
+    'get_filesys_by_machine' : ('filesys', ),
+    'get_filesys_by_group' : ('filesys', ),
+    'get_quota_by_filesys' : ('quota', ),
+    'get_quota' : ('quota', ),
+    'get_machine' : ('machine', ),
+}
+
+write_queries = {
+    'add_list' : ('list', ),
+    'update_list' : ('list', 'members', 'other'),
+    'delete_list' : ('list', 'members', 'other'),
+    'add_member_to_list' : ('list', 'members'),
+    'add_tagged_member_to_list' : ('list', 'members'),
+    'delete_member_from_list' : ('list', 'members'),
+    'tag_member_of_list' : ('list', 'members'),
+    'add_user_account' : ('user', ),
+    'update_user_account' : ('user', 'other'),
+    'update_user_shell' : ('user', ),
+    'update_user_windows_shell' : ('user', ),
+    'update_user_status' : ('user', ),
+    'update_user_security_status' : ('user', ),
+    'delete_user' : ('user', 'members', 'other'),
+    'add_filesys' : ('filesys', ),
+    'update_filesys' : ('filesys', 'other'),
+    'delete_filesys' : ('filesys', 'quota'),
+    'add_quota' : ('quota', ),
+    'update_quota' : ('quota', ),
+    'delete_quota' : ('quota', ),
+    'add_machine' : ('machine', ),
+    'update_machine' : ('machine', 'other'),
+    'delete_machine' : ('machine', 'members', 'other'),
+}
+
+_all_tables = frozenset( sum(read_queries.values(), ()) + sum(write_queries.values(), ()) + ('*', ) )
+
+_read_prefixes = ('get_', 'count_', 'expand_', 'qualified_get_')
+
+def isReadOnly(name):
+    """Returns whether the query does not modify anything on the server."""
+
+    return name in read_queries or (name not in write_queries and name.startswith(_read_prefixes))
+
+def readTables(name):
+    """Returns the tables on which the result of a read-only query depends."""
+
+    return read_queries.get(name, ('*', ))
+
+def writeTables(name):
+    """Returns the tables which may be modified by a write query."""
+
+    if name in write_queries:
+        return write_queries[name] + ('*', )
+    return _all_tables
+
+def _resultSize(result):
+    """Estimates the memory occupied by a query result in bytes."""
+
+    size = 64
+    for row in result:
+        size += 64 + 8 * len(row)
+        for field in row:
+            size += 40 + len(field)
+    return size
+
+def _encodeResult(result):
+    """Serializes a query result (a tuple of rows of strings) for a cache backend.
+    The fields are byte strings in an unknown encoding, so every byte is mapped to
+    the code point with the same value."""
+
+    return json.dumps( [ [ field.decode('latin-1') for field in row ] for row in result ] )
+
+def _decodeResult(value):
+    """Restores the query result serialized by _encodeResult(), or returns None if
+    the value is malformed."""
+
+    try:
+        return tuple( tuple( field.encode('latin-1') for field in row ) for row in json.loads(value) )
+    except (ValueError, TypeError, AttributeError, UnicodeError):
+        return None
+
+class DirectoryCacheBackend(object):
+    """A cache backend which stores the entries as files in a directory, so the
+    cache may be shared between the processes of the same user on the host.
+    Entries are written atomically; the counters are updated under an exclusive
+    file lock. The directory is created accessible only to its owner, and an
+    existing directory is refused if it belongs to another user or may be written
+    by others, as anyone who can write there can forge the cached results.
+
+    The entries are limited to max_bytes in total: the modification time of an
+    entry is updated when it is read, and once the process has written a tenth of
+    the limit since the last check, the least recently used entries are removed
+    until the directory fits into it. The counters are never removed. Since the
+    size is checked periodically, the directory may temporarily exceed the limit
+    by a tenth of it per process."""
+
+    def __init__(self, path, max_bytes = 256 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.written = 0
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path, 0o700)
+
+        info = os.stat(path)
+        if info.st_uid != os.getuid():
+            raise UserError("The cache directory %s belongs to another user" % path)
+        if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise UserError("The cache directory %s may be written by other users" % path)
+
+    def filename(self, key):
+        return os.path.join( self.path, hashlib.sha1(key.encode('utf-8') if not isinstance(key, bytes) else key).hexdigest() )
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            with open(filename, 'rb') as entry:
+                value = entry.read()
+            os.utime(filename, None)
+            return value
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        filename = self.filename(key)
+        temp_name = "%s.%i.%i" % (filename, os.getpid(), threading.current_thread().ident)
+        with open(temp_name, 'wb') as entry:
+            entry.write(value)
+        os.rename(temp_name, filename)
+
+        with self.lock:
+            self.written += len(value)
+            if self.written < self.max_bytes // 10:
+                return
+            self.written = 0
+        self.prune()
+
+    def prune(self):
+        """Removes the least recently used entries until the directory fits into the
+        size limit."""
+
+        names = set( os.listdir(self.path) )
+        entries = []
+        total = 0
+        for name in names:
+            # Skips the counters (and the entries holding their values) and the
+            # entries being written
+            if '.' in name or name + '.counter' in names:
+                continue
+            try:
+                info = os.stat( os.path.join(self.path, name) )
+            except OSError:
+                continue
+            entries.append( (info.st_mtime, info.st_size, name) )
+            total += info.st_size
+
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink( os.path.join(self.path, name) )
+            except OSError:
+                # Removed by another process
+                pass
+            total -= size
+
+    def incr(self, key):
+        import fcntl
+
+        with open(self.filename(key) + '.counter', 'a+') as counter:
+            fcntl.flock(counter, fcntl.LOCK_EX)
+            counter.seek(0)
+            value = int(counter.read() or 0) + 1
+            counter.seek(0)
+            counter.truncate()
+            counter.write(str(value))
+            counter.flush()
+        self.set(key, str(value).encode('ascii'))
+        return value
+
+class QueryCache(object):
+    """An LRU cache of the results of read-only queries, keyed by the query name,
+    arguments and the query version, and limited by the estimated size of the
+    results in bytes. The write queries sent through the same client invalidate
+    the results of the read queries depending on the tables they modify.
+
+    If a backend is specified (see DirectoryCacheBackend for the interface), the
+    results and the invalidations are also stored there, so the clients in
+    several processes using the same backend share the cache."""
+
+    def __init__(self, max_bytes = 64 * 1024 * 1024, backend = None):
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.generations = dict.fromkeys(_all_tables, 0)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, table):
+        if self.backend:
+            value = self.backend.get('generation:' + table)
+            return int(value) if value else 0
+        return self.generations[table]
+
+    def key(self, name, params, version):
+        """Returns the cache key for a read-only query. The key includes the current
+        generations of the tables the result depends on, so the entries stored
+        before a table is modified are never returned after that."""
+
+        generations = tuple( self.generation(table) for table in readTables(name) )
+        return repr( (name, tuple(params), version, generations) )
+
+    def lookup(self, key):
+        """Returns the cached result for the key, or None if there is none."""
+
+        with self.lock:
+            if key in self.entries:
+                result, size = self.entries.pop(key)
+                self.entries[key] = (result, size)
+                self.hits += 1
+                return result
+
+        if self.backend:
+            value = self.backend.get('result:' + key)
+            result = _decodeResult(value) if value is not None else None
+            if result is not None:
+                self.store(key, result, shared = False)
+                with self.lock:
+                    self.hits += 1
+                return result
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def store(self, key, result, shared = True):
+        """Stores the result of a read-only query."""
+
+        size = _resultSize(result)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (result, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, (old_result, old_size) = self.entries.popitem(last = False)
+                self.size -= old_size
+                self.evictions += 1
+
+        if shared and self.backend:
+            self.backend.set( 'result:' + key, _encodeResult(result) )
+
+    def invalidate(self, name):
+        """Invalidates the results which may be changed by the write query."""
+
+        with self.lock:
+            self.invalidations += 1
+            for table in writeTables(name):
+                self.generations[table] += 1
+        if self.backend:
+            for table in writeTables(name):
+                self.backend.incr('generation:' + table)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            for table in self.generations:
+                self.generations[table] += 1
+
+    def stats(self):
+        """Returns the dictionary with the cache statistics."""
+
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_ratio' : float(self.hits) / total if total else 0.0,
+                'evictions' : self.evictions,
+                'invalidations' : self.invalidations,
+                'entries' : len(self.entries),
+                'bytes' : self.size,
+            }
@@ -5,23 +5,208 @@
 ## server location, etc).
 #
 
+import collections
+import itertools
+import json
+import os
 import socket
+import threading
+import time
 
 from .protocol import *
 from .protocol import _read_u32
 
 from .constants import *
+from . import cache
+from . import concurrency
+from . import profiling
+from . import schema
+from . import utils
+
+# How long Hesiod and DNS lookup results are trusted
+SERVER_LOOKUP_TTL = 3600
+SERVER_FAILURE_TTL = 300
+
+# How long the client waits for each candidate server before failing over to the next one
+SERVER_FAILOVER_TIMEOUT = 3
+
+class ServerLocator(object):
+    """Locates the Moira servers through Hesiod and remembers the results of the
+    lookups, the canonical names of the servers and the observed connection latency,
+    so the connection setup does not wait for Hesiod and DNS every time. If the
+    cache_file is specified (or PYMOIRA_SERVER_CACHE environment variable is set),
+    the cached information is shared between processes through that file."""
+
+    def __init__(self, cache_file = None, ttl = SERVER_LOOKUP_TTL):
+        if cache_file is None:
+            cache_file = os.environ.get('PYMOIRA_SERVER_CACHE')
+
+        self.cache_file = cache_file
+        self.servers = utils.TTLCache(ttl)
+        self.hostnames = utils.TTLCache(ttl)
+        self.latency = utils.TTLCache(ttl)
+        self.loadCache()
+
+    def loadCache(self):
+        """Reads the cached lookup results from the cache file, if there is one."""
+
+        if not self.cache_file:
+            return
+
+        try:
+            with open(self.cache_file, 'r') as cache_file:
+                data = json.load(cache_file)
+            self.servers.restore(data.get('servers', ()))
+            self.hostnames.restore(data.get('hostnames', ()))
+            self.latency.restore(data.get('latency', ()))
+        except (IOError, OSError, ValueError, TypeError):
+            # The cache is only an optimization, so a missing or broken file is not an error
+            pass
+
+    def saveCache(self):
+        """Writes the cached lookup results into the cache file, if there is one."""
+
+        if not self.cache_file:
+            return
+
+        data = {
+            'servers' : self.servers.dump(),
+            'hostnames' : self.hostnames.dump(),
+            'latency' : self.latency.dump(),
+        }
+        try:
+            temp_name = "%s.%i" % (self.cache_file, os.getpid())
+            with open(temp_name, 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.rename(temp_name, self.cache_file)
+        except (IOError, OSError):
+            pass
+
+    def lookup(self):
+        """Returns the list of all Moira servers listed in Hesiod."""
+
+        # FIXTHEM: some fine day Moira should start using real SRV records instead
+
+        servers = self.servers.get('moira')
+        if servers:
+            return list(servers)
+
+        import hesiod
+
+        lookup = hesiod.Lookup("moira", "sloc")
+        if not lookup or not lookup.results:
+            raise ConnectionError("Unable to locate Moira server through Hesiod")
+
+        servers = list(lookup.results)
+        self.servers.set('moira', servers)
+        self.saveCache()
+        return servers
+
+    def canonicalize(self, server):
+        """Returns the fully qualified domain name of the server."""
+
+        key = server.lower()
+        hostname = self.hostnames.get(key)
+        if hostname is None:
+            hostname = socket.getfqdn(server)
+            self.hostnames.set(key, hostname)
+            self.saveCache()
+        return str(hostname)
+
+    def canonicalizeMany(self, names, threads = 16):
+        """Returns the dictionary mapping each of the names to the fully qualified
+        domain name of the host. The names which are not cached are resolved
+        concurrently by a pool of threads; the ones which fail to resolve are not
+        in the dictionary."""
+
+        result = {}
+        missing = []
+        for name in set(names):
+            hostname = self.hostnames.get( name.lower() )
+            if hostname is None:
+                missing.append(name)
+            else:
+                result[name] = str(hostname)
+
+        if missing:
+            lock = threading.Lock()
+            remaining = iter(missing)
+
+            def resolve():
+                while True:
+                    with lock:
+                        name = next(remaining, None)
+                    if name is None:
+                        return
+                    try:
+                        hostname = socket.getfqdn(name)
+                    except socket.error:
+                        # The name is left out of the result, and is not cached
+                        continue
+                    self.hostnames.set( name.lower(), hostname )
+                    result[name] = hostname
+
+            workers = [ threading.Thread(target = resolve) for i in range( min(threads, len(missing)) ) ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            self.saveCache()
+
+        return result
+
+    def rank(self, servers):
+        """Orders the servers by the measured connection latency. Servers for which
+        no measurements are available are put after the measured ones in random order,
+        and servers which recently failed go last."""
+
+        import random
+
+        servers = list(servers)
+        random.shuffle(servers)
+        unknown = float(SERVER_FAILOVER_TIMEOUT)
+        return sorted(servers, key = lambda server: self.latency.get(server.lower(), unknown))
+
+    def connect(self, servers = None, timeout = None):
+        """Connects to the fastest server among the specified (or all known) servers,
+        failing over to the next one if the connection is not established within
+        SERVER_FAILOVER_TIMEOUT. Returns the (server, socket) tuple."""
+
+        if not servers:
+            servers = self.lookup()
+        candidates = self.rank(servers)
+
+        last_error = None
+        for i, server in enumerate(candidates):
+            if i == len(candidates) - 1:
+                connect_timeout = timeout
+            elif timeout is None:
+                connect_timeout = SERVER_FAILOVER_TIMEOUT
+            else:
+                connect_timeout = min(timeout, SERVER_FAILOVER_TIMEOUT)
+
+            started = time.time()
+            try:
+                sock = socket.create_connection( (server, MOIRA_PORT), connect_timeout )
+            except (socket.error, socket.timeout) as err:
+                self.latency.set(server.lower(), float('inf'), SERVER_FAILURE_TTL)
+                last_error = err
+                continue
+
+            sock.settimeout(timeout)
+            self.latency.set(server.lower(), time.time() - started)
+            self.saveCache()
+            return server, sock
+
+        self.saveCache()
+        raise ConnectionError("Unable to connect to any Moira server: %s" % last_error)
+
+default_locator = ServerLocator()
 
 def locate_server():
     """Locates the Moira server through Hesiod."""
-    # FIXTHEM: some fine day Moira should start using real SRV records instead
 
-    import random, hesiod
-    
-    lookup = hesiod.Lookup("moira", "sloc")
-    if not lookup or not lookup.results:
-        raise ConnectionError("Unable to locate Moira server through Hesiod")
-    return random.choice(lookup.results)
+    return default_locator.rank( default_locator.lookup() )[0]
 
 def _get_krb5_ap_req(service, server):
     """Returns the AP_REQ Kerberos 5 ticket for a given service."""
@@ -60,14 +245,29 @@ class Client(object):
     protocol-supported operations. Provides the foundation for building higher-level
     abstractions."""
     
-    def __init__(self, server = None, timeout = None, default_version = None):
-        if not server:
-            server = locate_server()
+    # The QueryCache used by the client, if any
+    cache = None
+    
+    # The AdaptiveLimiter shared with other connections, if any, and the priority
+    # with which the queries of this connection are admitted by it
+    limiter = None
+    priority = concurrency.Interactive
+    
+    # The number of streaming generators (iterQuery(), pipeline()) which have
+    # yielded while the responses to their queries are still being received
+    streaming = 0
+    
+    def __init__(self, server = None, timeout = None, default_version = None, locator = None, cache = None, limiter = None, priority = concurrency.Interactive):
+        self.cache = cache
+        self.limiter = limiter
+        self.priority = priority
+        if not locator:
+            locator = default_locator
         if not default_version:
             default_version = MOIRA_QUERY_VERSION
         
-        self.server = socket.getfqdn(server)
-        self.socket = socket.create_connection( (server, MOIRA_PORT), timeout )
+        server, self.socket = locator.connect( (server,) if server else None, timeout )
+        self.server = locator.canonicalize(server)
         self.challenge()
         self.checkMOTD()
         
@@ -82,11 +282,13 @@ class Client(object):
         if response != MOIRA_PROTOCOL_RESPONSE:
             raise ConnectionError("Moira server failed to return the correct response to connection initiation request")
     
+    @profiling.timed('socket')
     def send(self, data):
         """A blocking method to send data to Moira using appropriate connection interface."""
         
         self.socket.send(data)
     
+    @profiling.timed('socket')
     def recv(self, buffer_size, exact = True):
         """A blocking method to send data to Moira using appropriate connection interface. If exact
         flag is specified, the client waits until exactly buffer_size bytes are received and raises
@@ -152,6 +354,7 @@ class Client(object):
         if self.version == version:
             return
         
+        self.checkIdle()
         self.sendPacket( MR_SETVERSION, (str(version),) )
         result = self.recvPacket()
         if result.opcode != MR_SUCCESS and result.opcode != MR_VERSION_LOW:
@@ -170,26 +373,218 @@ class Client(object):
         if result.opcode != MR_SUCCESS:
             raise MoiraError(result.opcode)
     
+    def recvQueryResult(self):
+        """Receives the complete response to a query sent earlier and returns the
+        rows of it, or raises MoiraError if the query failed."""
+        
+        result = []
+        
+        response = self.recvPacket()
+        while response.opcode == MR_MORE_DATA:
+            result.append( response.data )
+            response = self.recvPacket()
+        
+        if response.opcode != MR_SUCCESS:
+            raise MoiraError(response.opcode)
+        
+        return tuple(result)
+    
+    def cacheKey(self, name, params):
+        """Returns the key under which the result of the query is cached, or None if
+        it may not be cached. Write queries invalidate the cached results they may
+        affect, so this has to be called for every query before it is sent."""
+        
+        if not self.cache:
+            return None
+        if cache.isReadOnly(name):
+            return self.cache.key(name, params, self.version)
+        self.cache.invalidate(name)
+        return None
+    
+    def checkIdle(self):
+        """Raises UserError if a new query may not be sent because the responses to
+        a streaming query are still being received, as the responses would be mixed
+        up. This happens, for instance, when a lazily loaded object is accessed
+        while iterating over the results of iterQuery()."""
+        
+        if self.streaming:
+            raise UserError("No queries may be sent while the results of a streaming query are being received on the same connection")
+    
+    def checkQuery(self, name, params):
+        """Returns the error the server would respond to the query with because of
+        the wrong number of arguments, or None. Queries missing from the query
+        catalog are not checked."""
+        
+        return schema.checkArguments(name, params, self.version)
+    
+    @profiling.operation('Client.query')
     def query(self, name, params, version = None):
         """Sends a query to the Moira server and returns the result."""
         
         if version:
             self.setVersion(version)
         
-        result = []
+        error = self.checkQuery(name, params)
+        if error:
+            raise error
+        
+        cache_key = self.cacheKey(name, params)
+        if cache_key is not None:
+            result = self.cache.lookup(cache_key)
+            if result is not None:
+                return result
+        
+        self.checkIdle()
+        query = (name,) + tuple(params)
+        if self.limiter:
+            with self.limiter.slot(self.priority):
+                self.sendPacket(MR_QUERY, query)
+                result = self.recvQueryResult()
+        else:
+            self.sendPacket(MR_QUERY, query)
+            result = self.recvQueryResult()
+        
+        if cache_key is not None:
+            self.cache.store(cache_key, result)
+        return result
+    
+    def iterQuery(self, name, params, version = None):
+        """Sends a query to the Moira server and yields the rows of the result as
+        they arrive, which allows processing very large results without keeping
+        them in memory. No other queries may be sent on this connection until the
+        generator is exhausted or closed. The results are not cached."""
+        
+        if version:
+            self.setVersion(version)
         
+        error = self.checkQuery(name, params)
+        if error:
+            raise error
+        
+        self.checkIdle()
+        self.cacheKey(name, params)
         query = (name,) + tuple(params)
         self.sendPacket(MR_QUERY, query)
+        
         response = self.recvPacket()
-
         while response.opcode == MR_MORE_DATA:
-            result.append( response.data )
+            self.streaming += 1
+            try:
+                yield response.data
+            except GeneratorExit:
+                self.discardResults(0, response)
+                raise
+            finally:
+                self.streaming -= 1
             response = self.recvPacket()
         
         if response.opcode != MR_SUCCESS:
             raise MoiraError(response.opcode)
+    
+    def pipeline(self, queries, version = None, window = MOIRA_PIPELINE_WINDOW):
+        """Sends a sequence of (name, params) queries to the server without waiting
+        for the previous ones to complete, keeping at most window queries in flight.
+        Yields the results in the order of queries; the results of failed queries
+        are yielded as MoiraError objects instead of being raised. If the generator
+        is closed early, the responses to the queries already sent are discarded."""
         
-        return tuple(result)
+        if version:
+            self.setVersion(version)
+        
+        self.checkIdle()
+        queries = iter(queries)
+        # (cache key, cached result, time sent) for every query not yet yielded, in order
+        pending = collections.deque()
+        in_flight = 0
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < window:
+                    try:
+                        name, params = next(queries)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    
+                    error = self.checkQuery(name, params)
+                    if error:
+                        pending.append( (None, error, None) )
+                        continue
+                    
+                    cache_key = self.cacheKey(name, params)
+                    if cache_key is not None:
+                        result = self.cache.lookup(cache_key)
+                        if result is not None:
+                            pending.append( (cache_key, result, None) )
+                            continue
+                    
+                    # Wait for a slot only if nothing is in flight; otherwise receive the
+                    # responses first, as they will free the slots
+                    if self.limiter:
+                        if in_flight:
+                            if not self.limiter.tryAcquire(self.priority):
+                                queries = itertools.chain( [(name, params)], queries )
+                                break
+                        else:
+                            self.limiter.acquire(self.priority)
+                    
+                    in_flight += 1
+                    self.sendPacket( MR_QUERY, (name,) + tuple(params) )
+                    pending.append( (cache_key, None, time.time()) )
+                
+                if not pending:
+                    return
+                
+                cache_key, result, sent = pending.popleft()
+                if result is None:
+                    try:
+                        result = self.recvQueryResult()
+                        if cache_key is not None:
+                            self.cache.store(cache_key, result)
+                    except MoiraError as err:
+                        result = err
+                    in_flight -= 1
+                    if self.limiter:
+                        self.limiter.release( time.time() - sent, result.code if isinstance(result, MoiraError) else None )
+                
+                # Other queries may be sent while the generator is suspended only if
+                # no responses are expected
+                busy = in_flight > 0
+                self.streaming += busy
+                try:
+                    yield result
+                except GeneratorExit:
+                    self.discardResults(in_flight)
+                    raise
+                finally:
+                    self.streaming -= busy
+        finally:
+            # Return the slots of the queries whose responses were discarded or
+            # never received because of a connection failure
+            if self.limiter:
+                for i in range(in_flight):
+                    self.limiter.release(None)
+    
+    def discardResults(self, count, current = None):
+        """Receives and throws away the responses to count queries sent earlier.
+        If the current packet is specified, the rest of the response to which it
+        belongs is discarded first."""
+        
+        while current is not None and current.opcode == MR_MORE_DATA:
+            current = self.recvPacket()
+        
+        for i in range(count):
+            try:
+                self.recvQueryResult()
+            except MoiraError:
+                pass
+    
+    @profiling.operation('Client.queryMany')
+    def queryMany(self, queries, version = None, window = MOIRA_PIPELINE_WINDOW):
+        """Runs multiple queries pipelined, as described in pipeline(), and returns
+        the list of their results."""
+        
+        return list( self.pipeline(queries, version, window) )
     
     def probe(self, name, params, version = None):
         """Asks Moira server whether the supplied query will trigger any errors
@@ -198,6 +593,11 @@ class Client(object):
         if version:
             self.setVersion(version)
         
+        error = self.checkQuery(name, params)
+        if error:
+            return error.code
+        
+        self.checkIdle()
         query = (name,) + params
         self.sendPacket(MR_ACCESS, query)
         response = self.recvPacket()
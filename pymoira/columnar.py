@@ -0,0 +1,235 @@
+#
+## PyMoira client library
+##
+## This file contains the columnar representation of large query results, which
+## stores every field in a compact per-field array instead of a dictionary per row.
+#
+
+import array
+import calendar
+import datetime
+
+from . import utils
+from .errors import *
+
+_months = { month : i + 1 for i, month in enumerate( ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec') ) }
+
+def _parseMoiraTimestamp(val):
+    """Converts the Moira date-time string into seconds since the epoch, treating
+    the time as UTC. This is a faster equivalent of convertMoiraDateTime()."""
+
+    try:
+        date, clock = val.split(' ')
+        day, month, year = date.split('-')
+        hour, minute, second = clock.split(':')
+        return float( calendar.timegm( (int(year), _months[month], int(day), int(hour), int(minute), int(second)) ) )
+    except (ValueError, KeyError):
+        return float( calendar.timegm( utils.convertMoiraDateTime(val).timetuple() ) )
+
+class Column(object):
+    """The base class for the columns of the columnar result."""
+
+    def __len__(self):
+        return len(self.data)
+
+    def toNumpy(self):
+        import numpy
+        return numpy.frombuffer(self.data, dtype = self.data.typecode) if len(self.data) else numpy.array([], dtype = self.data.typecode)
+
+class BoolColumn(Column):
+    """Stores the boolean values as bytes."""
+
+    def __init__(self):
+        self.data = array.array('b')
+
+    def append(self, val):
+        self.data.append( 1 if utils.convertMoiraBool(val) else 0 )
+
+    def __getitem__(self, i):
+        return bool(self.data[i])
+
+    def toNumpy(self):
+        return Column.toNumpy(self).astype(bool)
+
+class IntColumn(Column):
+    """Stores the integer values as machine integers. The values which are not
+    valid integers (None in responseToDict()) are stored as zeroes, and their
+    indices are kept in the nulls set."""
+
+    def __init__(self):
+        self.data = array.array('l')
+        self.nulls = set()
+
+    def append(self, val):
+        val = utils.convertMoiraInt(val)
+        if val is None:
+            self.nulls.add( len(self.data) )
+            val = 0
+        self.data.append(val)
+
+    def __getitem__(self, i):
+        return None if i in self.nulls else self.data[i]
+
+class DateTimeColumn(Column):
+    """Stores the date-time values as the floating point seconds since the epoch.
+    Moira does not specify the time zone, so the times are treated as UTC."""
+
+    def __init__(self):
+        self.data = array.array('d')
+
+    def append(self, val):
+        self.data.append( _parseMoiraTimestamp(val) )
+
+    def __getitem__(self, i):
+        return datetime.datetime.utcfromtimestamp(self.data[i])
+
+class StringColumn(Column):
+    """Stores the strings dictionary-encoded: every distinct value is stored once
+    in the values list, and the column itself contains the indices into it."""
+
+    def __init__(self):
+        self.data = array.array('l')
+        self.values = []
+        self.codes = {}
+
+    def encode(self, val):
+        """Returns the code of the value, or None if it is not present in the column."""
+
+        return self.codes.get(val)
+
+    def append(self, val):
+        code = self.codes.get(val)
+        if code is None:
+            code = len(self.values)
+            self.codes[val] = code
+            self.values.append(val)
+        self.data.append(code)
+
+    def __getitem__(self, i):
+        return self.values[ self.data[i] ]
+
+class PlainStringColumn(Column):
+    """Stores the strings as they are, for the fields in which most values are
+    distinct, so the dictionary encoding would only add overhead."""
+
+    def __init__(self):
+        self.data = []
+
+    def append(self, val):
+        self.data.append(val)
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def toNumpy(self):
+        import numpy
+        return numpy.array(self.data, dtype = object)
+
+_column_types = {
+    bool : BoolColumn,
+    int : IntColumn,
+    datetime.datetime : DateTimeColumn,
+    str : StringColumn,
+}
+
+class ColumnarResult(object):
+    """A query result stored column by column, according to the description of the
+    same format as the one used by responseToDict(). Rows are decoded directly into
+    the columns as they are appended, so no per-row objects are kept. The string
+    fields are dictionary-encoded, except for the ones listed in plain_fields,
+    which should be the fields with mostly distinct values."""
+
+    def __init__(self, description, plain_fields = ()):
+        self.description = description
+        self.fields = [name for name, datatype in description]
+        self.columns = {}
+        for name, datatype in description:
+            if datatype not in _column_types:
+                raise UserError("Unsupported Moira data type specified: %s" % datatype)
+            if datatype == str and name in plain_fields:
+                self.columns[name] = PlainStringColumn()
+            else:
+                self.columns[name] = _column_types[datatype]()
+        self.ordered_columns = [ self.columns[name] for name in self.fields ]
+        self.count = 0
+
+    def append(self, row):
+        """Decodes a response row into the columns."""
+
+        if len(row) != len(self.ordered_columns):
+            raise UserError("Error returned the response with invalid number of entries")
+
+        for column, value in zip(self.ordered_columns, row):
+            column.append(value)
+        self.count += 1
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def row(self, i):
+        """Returns the i-th row as a dictionary, the same as responseToDict() would."""
+
+        return { name : self.columns[name][i] for name in self.fields }
+
+    def values(self, i):
+        """Returns the i-th row as a tuple of values in the order of the description."""
+
+        return tuple( column[i] for column in self.ordered_columns )
+
+    def rows(self, indices = None):
+        """Yields the rows (all of them, or the ones with the specified indices)
+        as dictionaries."""
+
+        if indices is None:
+            indices = range(self.count)
+        for i in indices:
+            yield self.row(i)
+
+    def where(self, name, value):
+        """Returns the indices of the rows in which the field is equal to the value.
+        For string fields, the value is compared by its dictionary code, and if
+        NumPy is available, the comparison is vectorized."""
+
+        column = self.columns[name]
+        if isinstance(column, PlainStringColumn):
+            return [ i for i, val in enumerate(column.data) if val == value ]
+        if isinstance(column, StringColumn):
+            value = column.encode(value)
+            if value is None:
+                return []
+        elif isinstance(column, BoolColumn):
+            value = 1 if value else 0
+        elif isinstance(column, DateTimeColumn):
+            value = float( calendar.timegm(value.timetuple()) )
+
+        try:
+            import numpy
+            result = [ int(i) for i in numpy.flatnonzero( Column.toNumpy(column) == value ) ]
+        except ImportError:
+            data = column.data
+            result = [ i for i in range(self.count) if data[i] == value ]
+
+        if isinstance(column, IntColumn) and column.nulls:
+            result = [ i for i in result if i not in column.nulls ]
+        return result
+
+    def toNumpy(self):
+        """Returns the dictionary of NumPy arrays for all fields. Dictionary-encoded
+        string fields are returned as arrays of codes (the values are in the column's
+        values list), and the plain ones as arrays of objects."""
+
+        return { name : self.columns[name].toNumpy() for name in self.fields }
+
+def queryColumnar(client, name, params, description, version = None):
+    """Runs a query and streams its result into a ColumnarResult."""
+
+    result = ColumnarResult(description)
+    result.extend( client.iterQuery(name, params, version = version) )
+    return result
@@ -0,0 +1,160 @@
+#
+## PyMoira client library
+##
+## This file contains the adaptive limiter of the amount of concurrent queries
+## sent to the Moira server.
+#
+
+import threading
+import time
+
+from . import constants
+from .errors import *
+
+# Priority lanes
+Interactive = 0
+Batch = 1
+
+# Errors indicating that the server is overloaded
+overload_errors = frozenset( (
+    constants.MR_DBMS_ERR,
+    constants.MR_NO_MEM,
+    constants.MR_BUSY,
+    constants.MR_DEADLOCK,
+    constants.MR_DBMS_SOFTFAIL,
+) )
+
+class AdaptiveLimiter(object):
+    """Limits the number of queries in flight across all the connections and threads
+    sharing the limiter. The limit is adjusted with AIMD: it grows additively (by
+    about one query per round trip) while the query latency stays within tolerance
+    times the lowest latency observed, and is cut multiplicatively when the latency
+    exceeds that or the server reports an overload error (MR_DBMS_ERR, MR_NO_MEM
+    and similar). At most one decrease happens per round trip.
+
+    Queries have priorities: the reserved slots may only be used by interactive
+    queries, and batch queries are not admitted while interactive ones are waiting,
+    so interactive requests are not starved by batch crawls."""
+
+    def __init__(self, initial = 4, minimum = 1, maximum = 64, reserved = 1, tolerance = 2.0, backoff = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.reserved = reserved
+        self.tolerance = tolerance
+        self.backoff = backoff
+
+        self.in_flight = 0
+        self.waiting_interactive = 0
+        self.base_latency = None
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+        self.completed = 0
+        self.overloads = 0
+        self.decreases = 0
+
+    def currentLimit(self):
+        return max( self.minimum, int(self.limit) )
+
+    def admissible(self, priority):
+        limit = self.currentLimit()
+        if priority == Interactive:
+            return self.in_flight < limit
+        return self.waiting_interactive == 0 and self.in_flight < max(1, limit - self.reserved)
+
+    def tryAcquire(self, priority = Batch):
+        """Takes a slot for a query if one is available without waiting. Returns
+        whether the slot was taken."""
+
+        with self.condition:
+            if not self.admissible(priority):
+                return False
+            self.in_flight += 1
+            return True
+
+    def acquire(self, priority = Batch, timeout = None):
+        """Waits until a slot for a query is available and takes it."""
+
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.condition:
+            if priority == Interactive:
+                self.waiting_interactive += 1
+            try:
+                while not self.admissible(priority):
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise UserError("Timed out while waiting for a Moira query slot")
+                        self.condition.wait(remaining)
+                    else:
+                        self.condition.wait()
+                self.in_flight += 1
+            finally:
+                if priority == Interactive:
+                    self.waiting_interactive -= 1
+
+    def release(self, latency, error_code = None):
+        """Returns the slot taken for a query, reporting how long the query took and
+        the error code it failed with, if any. If the latency is None (the query was
+        answered locally or never completed), the slot is returned without taking
+        a sample, so the limit is not adjusted."""
+
+        now = time.time()
+        with self.condition:
+            self.in_flight -= 1
+            if latency is None:
+                self.condition.notify_all()
+                return
+            self.completed += 1
+
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+
+            overloaded = error_code in overload_errors
+            if overloaded:
+                self.overloads += 1
+
+            if overloaded or latency > self.base_latency * self.tolerance:
+                # Decrease at most once per round trip, as several queries in flight
+                # usually observe the same congestion
+                if now - self.last_decrease > latency:
+                    self.limit = max( self.minimum, self.limit * self.backoff )
+                    self.last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min( self.maximum, self.limit + 1.0 / max(self.limit, 1.0) )
+
+            self.condition.notify_all()
+
+    def slot(self, priority = Batch):
+        """Returns the context manager which holds a slot while the query runs.
+        The error code is determined from the MoiraError raised inside, if any."""
+
+        return _Slot(self, priority)
+
+    def stats(self):
+        with self.condition:
+            return {
+                'limit' : self.currentLimit(),
+                'in_flight' : self.in_flight,
+                'base_latency' : self.base_latency,
+                'completed' : self.completed,
+                'overloads' : self.overloads,
+                'decreases' : self.decreases,
+            }
+
+class _Slot(object):
+    def __init__(self, limiter, priority):
+        self.limiter = limiter
+        self.priority = priority
+
+    def __enter__(self):
+        self.limiter.acquire(self.priority)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        error_code = exc_value.code if isinstance(exc_value, MoiraError) else None
+        self.limiter.release(time.time() - self.started, error_code)
+        return False
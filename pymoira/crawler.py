@@ -0,0 +1,159 @@
+#
+## PyMoira client library
+##
+## This file contains the crawler which takes a snapshot of the explicit members
+## of all lists using a pool of processes, each with its own connection.
+#
+
+import collections
+import json
+import multiprocessing
+import socket
+
+from . import constants
+from .errors import *
+
+def authenticatedClient():
+    """The default client factory: connects to the Moira server and authenticates."""
+
+    from .client import Client
+
+    client = Client()
+    client.authenticate()
+    return client
+
+# The state of the worker process
+_worker_factory = None
+_worker_client = None
+
+def _initWorker(factory):
+    global _worker_factory, _worker_client
+    _worker_factory = factory
+    _worker_client = None
+
+def _crawlShard(task):
+    """Fetches the explicit members of a shard of lists in a worker process.
+    Returns the list of (list name, member tuples or error code) pairs."""
+
+    global _worker_client
+
+    names, query_name, retries = task
+    for attempt in range(retries + 1):
+        try:
+            if _worker_client is None:
+                _worker_client = _worker_factory()
+
+            queries = ( (query_name, (name, )) for name in names )
+            results = _worker_client.queryMany(queries, version = 14)
+            return [ (name, response.code if isinstance(response, MoiraError) else response) for name, response in zip(names, results) ]
+        except (ConnectionError, socket.error):
+            # The connection was lost; reconnect and retry the whole shard
+            if _worker_client is not None:
+                try:
+                    _worker_client.close()
+                except (BaseError, socket.error):
+                    pass
+            _worker_client = None
+            if attempt == retries:
+                raise
+
+class MembershipCrawler(object):
+    """Takes a snapshot of the explicit members of many lists (by default, all lists
+    matching the wildcard). The lists are split into shards which are processed by
+    a pool of processes; each process has its own authenticated connection created
+    by client_factory (which has to be picklable, e.g. a module-level function) and
+    fetches the members of a shard through the pipeline. The snapshot is written as
+    JSON Lines ({"name": ..., "members": [...]} per list) in the order of the list
+    names. At most twice as many shards as there are processes are submitted to
+    the pool at once, and a new one is submitted only after the oldest one has
+    been written, so only those shards are kept in memory even if the output is
+    written more slowly than the workers fetch the lists."""
+
+    def __init__(self, client_factory = authenticatedClient, processes = 4, shard_size = 256, tags = False, retries = 3):
+        self.client_factory = client_factory
+        self.processes = processes
+        self.shard_size = shard_size
+        self.tags = tags
+        self.retries = retries
+
+        self.denied = set()
+        self.missing = set()
+        self.crawled = 0
+
+    def listNames(self, pattern = '*'):
+        """Returns the names of all lists matching the wildcard pattern."""
+
+        client = self.client_factory()
+        try:
+            return [ row[0] for row in client.iterQuery( 'get_list_info', (pattern, ), version = 14 ) ]
+        finally:
+            client.close()
+
+    def shards(self, names):
+        query_name = "get_tagged_members_of_list" if self.tags else "get_members_of_list"
+        for i in range(0, len(names), self.shard_size):
+            yield (names[i:i + self.shard_size], query_name, self.retries)
+
+    def run(self, output, names = None, pattern = '*', progress = None):
+        """Crawls the specified lists (or all lists matching the pattern) and writes
+        the snapshot into the output file object. If progress callback is specified,
+        it is called with the number of lists crawled and the total number of lists
+        after every shard. Returns the number of lists written."""
+
+        if names is None:
+            names = self.listNames(pattern)
+        names = sorted(set(names))
+
+        pool = multiprocessing.Pool( self.processes, _initWorker, (self.client_factory, ) )
+        try:
+            written = 0
+            shards = self.shards(names)
+            in_flight = collections.deque()
+            for shard in shards:
+                in_flight.append( pool.apply_async( _crawlShard, (shard, ) ) )
+                if len(in_flight) == 2 * self.processes:
+                    break
+
+            while in_flight:
+                results = in_flight.popleft().get()
+                for name, response in results:
+                    if response == constants.MR_PERM:
+                        self.denied.add(name)
+                    elif response in (constants.MR_NO_MATCH, constants.MR_LIST):
+                        self.missing.add(name)
+                    elif isinstance(response, int):
+                        raise MoiraError(response)
+                    else:
+                        output.write( json.dumps( { 'name' : name, 'members' : [ list(member) for member in response ] }, sort_keys = True ) + "\n" )
+                        written += 1
+
+                self.crawled += len(results)
+                if progress:
+                    progress( self.crawled, len(names) )
+
+                shard = next(shards, None)
+                if shard is not None:
+                    in_flight.append( pool.apply_async( _crawlShard, (shard, ) ) )
+
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        output.flush()
+        return written
+
+def readSnapshot(source):
+    """Reads the snapshot written by MembershipCrawler from a file object into the
+    dictionary mapping the list names to the frozensets of member tuples."""
+
+    result = {}
+    for line in source:
+        line = line.strip()
+        if line:
+            record = json.loads(line)
+            name = record['name']
+            result[ name if isinstance(name, str) else name.encode('utf-8') ] = frozenset( tuple( field if isinstance(field, str) else field.encode('utf-8') for field in member ) for member in record['members'] )
+    return result
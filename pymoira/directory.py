@@ -0,0 +1,206 @@
+#
+## PyMoira client library
+##
+## This file contains the in-memory directory of user accounts, which answers
+## lookups by login, uid, MIT ID, sponsor and class without querying the server.
+#
+
+import bisect
+
+from . import columnar
+from .errors import *
+from .user import User
+
+class UserDirectory(object):
+    """The directory of all user accounts, bulk-loaded from the streamed
+    get_user_account_by_login dump. The raw rows are stored column by column; the
+    fields with few distinct values (shells, classes, statuses) are
+    dictionary-encoded, so each value is kept once, and the mostly unique ones
+    (logins, names, IDs, timestamps) are stored as they are. The directory keeps hash indexes on login,
+    uid, MIT ID, sponsor and class, and sorted indexes on login and last name for
+    prefix search; the users returned are User objects loaded from the stored rows.
+
+    Moira has no query returning only the accounts modified since some time, so
+    refresh() streams the dump again, but only the accounts whose lastmod_datetime
+    has changed are stored and reindexed."""
+
+    description = tuple( (name, str) for name, datatype in User.info_query_description )
+    lastmod_position = [ name for name, datatype in description ].index('lastmod_datetime')
+
+    # Fields in which most values are distinct, so they are not dictionary-encoded
+    plain_fields = ('name', 'uid', 'last_name', 'first_name', 'mit_id', 'comments', 'alternate_email',
+                    'alternate_phone', 'lastmod_datetime', 'created_date')
+
+    # Fields with hash indexes which may map a value to several accounts
+    grouped_fields = ('uid', 'mit_id', 'user_class')
+
+    # Fields with sorted indexes for prefix search
+    sorted_fields = ('name', 'last_name')
+
+    def __init__(self, client, pattern = '*'):
+        self.client = client
+        self.pattern = pattern
+        self.clear()
+
+    def clear(self):
+        self.records = columnar.ColumnarResult(self.description, self.plain_fields)
+        self.dead = 0
+
+        self.by_login = {}
+        self.by_sponsor = {}
+        self.indexes = { field : {} for field in self.grouped_fields }
+        self.sorted_indexes = None
+
+        self.fields = { name : self.records[name] for name in self.records.fields }
+
+    def __len__(self):
+        return len(self.by_login)
+
+    def __contains__(self, login):
+        return login in self.by_login
+
+    def __iter__(self):
+        for login in sorted(self.by_login):
+            yield self.user(self.by_login[login])
+
+    def stream(self):
+        return self.client.iterQuery( 'get_user_account_by_login', (self.pattern, ), version = 14 )
+
+    def load(self):
+        """Loads all the accounts from the server, replacing the current contents."""
+
+        self.clear()
+        for row in self.stream():
+            self.insert(row)
+        return len(self)
+
+    def refresh(self):
+        """Brings the directory up to date with the server. Returns the tuple of
+        the lists of logins which were added, updated and removed."""
+
+        added = []
+        updated = []
+        seen = set()
+        for row in self.stream():
+            login = row[0]
+            seen.add(login)
+            index = self.by_login.get(login)
+            if index is None:
+                added.append(login)
+            elif self.fields['lastmod_datetime'][index] != row[self.lastmod_position]:
+                updated.append(login)
+                self.remove(login)
+            else:
+                continue
+            self.insert(row)
+
+        removed = [ login for login in self.by_login if login not in seen ]
+        for login in removed:
+            self.remove(login)
+
+        if self.dead > len(self.by_login):
+            self.compact()
+        return added, updated, removed
+
+    def insert(self, row):
+        """Stores a get_user_account_by_login row and indexes it."""
+
+        index = len(self.records)
+        self.records.append(row)
+        self.by_login[ row[0] ] = index
+        for field in self.grouped_fields:
+            self.indexes[field].setdefault( self.fields[field][index], [] ).append(index)
+        self.by_sponsor.setdefault( self.sponsorKey(index), [] ).append(index)
+        self.sorted_indexes = None
+
+    def remove(self, login):
+        """Removes the account from the indexes. The row stays in the columns until
+        the directory is compacted."""
+
+        index = self.by_login.pop(login)
+        for field in self.grouped_fields:
+            self.discard( self.indexes[field], self.fields[field][index], index )
+        self.discard( self.by_sponsor, self.sponsorKey(index), index )
+        self.sorted_indexes = None
+        self.dead += 1
+
+    @staticmethod
+    def discard(index, key, value):
+        values = index[key]
+        values.remove(value)
+        if not values:
+            del index[key]
+
+    def compact(self):
+        """Rebuilds the columns and indexes without the rows of removed accounts."""
+
+        rows = [ self.records.values(index) for login, index in sorted( self.by_login.items(), key = lambda item: item[1] ) ]
+        self.clear()
+        for row in rows:
+            self.insert(row)
+
+    def sponsorKey(self, index):
+        return ( self.fields['sponsor_type'][index], self.fields['sponsor_name'][index] )
+
+    def user(self, index):
+        """Returns the User object loaded from the stored row."""
+
+        row = self.records.values(index)
+        user = User(self.client, row[0])
+        user.loadInfoFromResponse(row)
+        return user
+
+    def users(self, indices):
+        return [ self.user(index) for index in sorted(indices) ]
+
+    def get(self, login, default = None):
+        """Returns the User with the specified login, or default if there is none."""
+
+        index = self.by_login.get(login)
+        return self.user(index) if index is not None else default
+
+    def byUid(self, uid):
+        return self.users( self.indexes['uid'].get( str(uid), () ) )
+
+    def byMitId(self, mit_id):
+        return self.users( self.indexes['mit_id'].get(mit_id, ()) )
+
+    def byClass(self, user_class):
+        return self.users( self.indexes['user_class'].get(user_class, ()) )
+
+    def bySponsor(self, sponsor):
+        """Returns the users sponsored by the member (ListMember or a (type, name) tuple)."""
+
+        key = sponsor if isinstance(sponsor, tuple) else (sponsor.mtype, sponsor.name)
+        return self.users( self.by_sponsor.get(key, ()) )
+
+    def buildSortedIndexes(self):
+        self.sorted_indexes = {}
+        for field in self.sorted_fields:
+            column = self.fields[field]
+            entries = sorted( (column[index].lower(), index) for index in self.by_login.values() )
+            self.sorted_indexes[field] = ( [ key for key, index in entries ], [ index for key, index in entries ] )
+
+    def search(self, field, prefix):
+        """Returns the users whose field (login or last_name) starts with the prefix,
+        compared case-insensitively, ordered by the field."""
+
+        if field not in self.sorted_fields:
+            raise UserError("Field %s does not have a sorted index" % field)
+        if self.sorted_indexes is None:
+            self.buildSortedIndexes()
+
+        keys, indices = self.sorted_indexes[field]
+        prefix = prefix.lower()
+        result = []
+        position = bisect.bisect_left(keys, prefix)
+        while position < len(keys) and keys[position].startswith(prefix):
+            result.append( self.user(indices[position]) )
+            position += 1
+        return result
+
+    def searchLogin(self, prefix):
+        return self.search('name', prefix)
+
+    def searchLastName(self, prefix):
+        return self.search('last_name', prefix)
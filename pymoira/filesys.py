@@ -11,7 +11,7 @@ from . import utils
 import datetime
 from .errors import *
 
-class Filesys(object):
+class Filesys(utils.LazyRecord):
     info_query_description = (
         ('label', str),
         ('type', str),
@@ -39,6 +39,7 @@ class Filesys(object):
         ('lastmod_by', str),
         ('lastmod_with', str),
     )
+    lazy_fields = ('quota', 'quota_lastmod_datetime', 'quota_lastmod_by', 'quota_lastmod_with')
 
     def __init__(self, client, name):
         self.client = client
@@ -47,24 +48,96 @@ class Filesys(object):
     def __cmp__(self, other):
         return cmp(self.name, other.name)
 
-    def loadInfo(self):
-        """Loads the information about the list from the server into the object."""
-        
-        response, = self.client.query( 'get_filesys_by_label', (self.name, ), version = 14 )
-        result = utils.responseToDict(self.info_query_description, response)
-        self.__dict__.update(result)
-
-        try:
-            self.loadQuota()
-        except MoiraError as err:
-            if err.code == constants.MR_NO_MATCH:
+    def infoQueries(self):
+        """The filesystem and quota queries are sent together through the pipeline."""
+
+        label = self.label if self.isLoaded() else self.name
+        return [
+            ('get_filesys_by_label', (label, )),
+            ('get_quota_by_filesys', (label, )),
+        ]
+
+    def loadInfoFromResults(self, results):
+        info, quota = results
+        if isinstance(info, MoiraError):
+            raise info
+        self.loadInfoFromResponse(info[0], quota)
+
+    def loadInfoFromResponse(self, response, quota):
+        """Loads the information about the filesystem from a get_filesys_by_label row
+        and the get_quota_by_filesys response (which may be a MoiraError). The fields
+        are decoded when they are first accessed."""
+
+        self.attachInfo(response)
+
+        if isinstance(quota, MoiraError):
+            if quota.code == constants.MR_NO_MATCH:
                 self.quota = None
             else:
-                raise err
+                raise quota
+        else:
+            self.loadQuotaFromResponse(quota[0])
 
     def loadQuota(self):
         """Loads the information about the quota on the filesystem."""
 
         response, = self.client.query( 'get_quota_by_filesys', (self.label, ), version = 14 )
+        self.loadQuotaFromResponse(response)
+
+    def loadQuotaFromResponse(self, response):
+        """Loads the information about the quota from a get_quota_by_filesys row."""
+
         result = utils.responseToDict(self.quota_query_description, response)
         self.quota, self.quota_lastmod_datetime, self.quota_lastmod_by, self.quota_lastmod_with = result['size'], result['lastmod_datetime'], result['lastmod_by'], result['lastmod_with']
+
+    @staticmethod
+    def loadMany(client, labels = None, wildcard = None, batch_size = 256):
+        """Yields the Filesys objects with the information and quota loaded for all
+        specified labels and all filesystems matching the wildcard. For a wildcard,
+        the filesystem information is requested with a single query; the quota
+        queries (and the information queries for the explicit labels) are pipelined
+        in batches. Every batch is received completely before its objects are
+        yielded, so the client may be used while iterating. The labels which do not
+        exist are skipped."""
+
+        def loadBatch(batch):
+            queries = []
+            for label, info in batch:
+                if info is None:
+                    queries.append( ('get_filesys_by_label', (label, )) )
+                queries.append( ('get_quota_by_filesys', (label, )) )
+            responses = iter( client.queryMany(queries, version = 14) )
+
+            for label, info in batch:
+                if info is None:
+                    info = next(responses)
+                quota = next(responses)
+                if isinstance(info, MoiraError):
+                    if info.code == constants.MR_NO_MATCH:
+                        continue
+                    raise info
+
+                filesys = Filesys(client, label)
+                filesys.loadInfoFromResponse(info[0], quota)
+                yield filesys
+
+        batch = []
+        for label in (labels or ()):
+            batch.append( (label, None) )
+            if len(batch) == batch_size:
+                for filesys in loadBatch(batch):
+                    yield filesys
+                batch = []
+
+        if wildcard:
+            # The whole response has to be received before the quota queries may be sent
+            rows = client.query( 'get_filesys_by_label', (wildcard, ), version = 14 )
+            for row in rows:
+                batch.append( (row[0], (row, )) )
+                if len(batch) == batch_size:
+                    for filesys in loadBatch(batch):
+                        yield filesys
+                    batch = []
+
+        for filesys in loadBatch(batch):
+            yield filesys
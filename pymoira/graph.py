@@ -0,0 +1,425 @@
+#
+## PyMoira client library
+##
+## This file contains the algorithms working on the graph of list memberships,
+## which allow to answer the questions about many members or lists at once
+## without querying the server for each of them.
+#
+
+import binascii
+import sys
+
+from . import constants
+from . import profiling
+from . import protocol
+from .errors import *
+from .lists import ListMember
+
+class MembershipGraph(object):
+    """The upward graph of memberships: for every member (user, list, etc) which was
+    fetched, the set of the lists it is explicitly on. The direct memberships are
+    fetched with get_lists_of_member queries sent through the pipeline, and each
+    list's own memberships (the list-in-list edges) are fetched only once no matter
+    how many members are on it. The transitive memberships are then computed
+    locally, memoizing the result for every list."""
+
+    def __init__(self, client, window = protocol.MOIRA_PIPELINE_WINDOW):
+        self.client = client
+        self.window = window
+
+        self.parents = {}
+        self.denied = set()
+        self.memo = {}
+
+    @profiling.operation('MembershipGraph.fetch', 'graph')
+    def fetch(self, keys):
+        """Fetches the direct memberships of the (type, name) keys which were not
+        fetched before, and then the memberships of all the lists they are on,
+        recursively, up to the top-level lists."""
+
+        frontier = [key for key in set(keys) if key not in self.parents]
+        while frontier:
+            queries = ( ('get_lists_of_member', key) for key in frontier )
+            results = self.client.pipeline(queries, version = 14, window = self.window)
+
+            discovered = set()
+            for key, response in zip(frontier, results):
+                if isinstance(response, MoiraError):
+                    if response.code == constants.MR_PERM:
+                        self.denied.add(key)
+                    elif response.code != constants.MR_NO_MATCH:
+                        raise response
+                    response = ()
+
+                names = frozenset( row[0] for row in response )
+                self.parents[key] = names
+                discovered.update( (ListMember.List, name) for name in names )
+
+            frontier = [key for key in discovered if key not in self.parents]
+
+        # The memoized closures may become incomplete when new edges are added
+        self.memo = {}
+
+    def listAncestors(self, name):
+        """Returns the set of names of all lists which contain the list directly or
+        through other lists."""
+
+        if name in self.memo:
+            return self.memo[name]
+
+        result = set()
+        stack = list( self.parents.get( (ListMember.List, name), () ) )
+        while stack:
+            current = stack.pop()
+            if current in result:
+                continue
+            result.add(current)
+            if current in self.memo:
+                # The memoized closure is complete, so its lists need not be expanded
+                result |= self.memo[current]
+                continue
+            stack.extend( self.parents.get( (ListMember.List, current), () ) )
+
+        result = frozenset(result)
+        self.memo[name] = result
+        return result
+
+    def memberships(self, key, recursive = True):
+        """Returns the set of names of the lists on which the (type, name) member is,
+        explicitly or, if recursive is set, through other lists."""
+
+        direct = self.parents.get(key, frozenset())
+        if not recursive:
+            return direct
+
+        result = set(direct)
+        for name in direct:
+            result |= self.listAncestors(name)
+        return frozenset(result)
+
+@profiling.operation('getBulkMemberships', 'graph')
+def getBulkMemberships(client, members, recursive = True):
+    """Returns the dictionary which maps each of the members to the set of names of
+    the lists it is on (through other lists as well, if recursive is set). This is
+    equivalent to calling getMemberships() for each member, but the queries are
+    pipelined and the memberships of the lists shared by many members are fetched
+    and computed once."""
+
+    graph = MembershipGraph(client)
+    graph.fetch( (member.mtype, member.name) for member in members )
+    return { member : graph.memberships( (member.mtype, member.name), recursive ) for member in members }
+
+@profiling.timed('graph')
+def stronglyConnectedComponents(nodes, successors):
+    """Returns the strongly connected components of the graph as lists of nodes,
+    in reverse topological order (every component comes after all the components
+    reachable from it). This is the Tarjan's algorithm, implemented without
+    recursion so that deep list hierarchies do not hit Python's recursion limit."""
+
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    result = []
+
+    for root in nodes:
+        if root in index:
+            continue
+
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [ (root, iter(successors(root))) ]
+        while work:
+            node, children = work[-1]
+            descended = False
+            for child in children:
+                if child not in index:
+                    index[child] = lowlink[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append( (child, iter(successors(child))) )
+                    descended = True
+                    break
+                elif child in on_stack:
+                    lowlink[node] = min(lowlink[node], index[child])
+            if descended:
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+            if lowlink[node] == index[node]:
+                component = []
+                while True:
+                    current = stack.pop()
+                    on_stack.discard(current)
+                    component.append(current)
+                    if current == node:
+                        break
+                result.append(component)
+
+    return result
+
+class ListHierarchy(object):
+    """The hierarchy of lists (as returned by List.getAllMembers() in the lists
+    dictionary) condensed into a directed acyclic graph of strongly connected
+    components. Lists which include each other belong to the same component and
+    have the same members, so everything computed for a component is computed
+    once and shared by all its lists."""
+
+    @profiling.operation('ListHierarchy', 'graph')
+    def __init__(self, lists):
+        self.lists = lists
+        self.sublists = {}
+        for listname, members in lists.items():
+            self.sublists[listname] = [ member.name for member in (members or ()) if member.mtype == ListMember.List ]
+
+        self.components = stronglyConnectedComponents( sorted(self.sublists), lambda listname: self.sublists.get(listname, ()) )
+        self.component = {}
+        for i, component in enumerate(self.components):
+            for listname in component:
+                self.component[listname] = i
+
+        # Edges between the components; since the components are in reverse topological
+        # order, the successors of a component always have smaller indices
+        self.successors = []
+        for i, component in enumerate(self.components):
+            successors = set()
+            for listname in component:
+                successors.update( self.component[sublist] for sublist in self.sublists.get(listname, ()) )
+            successors.discard(i)
+            self.successors.append(successors)
+
+        self.expanded = None
+
+    def isCyclic(self, listname):
+        """Returns whether the list is (indirectly) a member of itself."""
+
+        i = self.component[listname]
+        return len(self.components[i]) > 1 or listname in self.sublists.get(listname, ())
+
+    def accumulate(self, own, combine):
+        """Computes a value for every component from the bottom up: the value of
+        a component is combine(own(component), [values of its successors]).
+        Returns the list of values by component index."""
+
+        values = []
+        for i, component in enumerate(self.components):
+            values.append( combine( own(component), [ values[j] for j in self.successors[i] ] ) )
+        return values
+
+    @profiling.operation('ListHierarchy.expand', 'graph')
+    def expand(self):
+        """Returns the dictionary which maps every list to the frozenset of all its
+        members (including the nested lists). Lists in the same component share
+        the same frozenset."""
+
+        if self.expanded is None:
+            def own(component):
+                result = set()
+                for listname in component:
+                    result.update( self.lists.get(listname) or () )
+                return result
+
+            def combine(members, successors):
+                for successor in successors:
+                    members |= successor
+                return frozenset(members)
+
+            values = self.accumulate(own, combine)
+            self.expanded = { listname : values[self.component[listname]] for listname in self.sublists }
+
+        return self.expanded
+
+# The bitsets store bit i in the byte i >> 3, at the position i & 7. They are
+# built and read byte by byte; the unions are computed on Python integers, for
+# which the conversion is linear.
+
+# The positions of the set bits of every byte value
+_byte_bits = [ tuple( bit for bit in range(8) if value & (1 << bit) ) for value in range(256) ]
+
+def _bitsetFromIds(ids):
+    """Returns the bitset with the bits of the specified ids set."""
+
+    ids = list(ids)
+    if not ids:
+        return bytearray()
+    bitset = bytearray( (max(ids) >> 3) + 1 )
+    for i in ids:
+        bitset[i >> 3] |= 1 << (i & 7)
+    return bitset
+
+def _toBitset(bits):
+    """Converts a Python integer used as a set of bits into a bitset."""
+
+    if not bits:
+        return bytearray()
+    digits = '%x' % bits
+    if len(digits) % 2:
+        digits = '0' + digits
+    bitset = bytearray( binascii.unhexlify(digits) )
+    bitset.reverse()
+    return bitset
+
+def _fromBitset(bitset):
+    if not bitset:
+        return 0
+    digits = bytearray(bitset)
+    digits.reverse()
+    return int( binascii.hexlify( bytes(digits) ), 16 )
+
+def _testBit(bitset, i):
+    index = i >> 3
+    return index < len(bitset) and bool( bitset[index] & (1 << (i & 7)) )
+
+def _iterBits(bitset):
+    """Yields the positions of the set bits, skipping the zero bytes."""
+
+    for index, value in enumerate(bitset):
+        if value:
+            base = index << 3
+            for bit in _byte_bits[value]:
+                yield base + bit
+
+def _memberKey(member):
+    if isinstance(member, tuple):
+        return member[0:2]
+    return (member.mtype, member.name)
+
+class ClosureIndex(object):
+    """The precomputed transitive closure of list membership, which answers whether
+    a member is on a list (directly or through other lists) in constant time. Every
+    member is assigned a small integer id, and for every list the set of ids of all
+    its members is stored as a bitset.
+
+    The index is built from the explicit members of the lists, in the format of the
+    lists dictionary returned by List.getAllMembers() (the lists to which the access
+    was denied have None instead of the member set)."""
+
+    def __init__(self, lists = None):
+        self.ids = {}
+        self.keys = []
+        self.explicit = {}
+        self.parents = {}
+        self.closure = {}
+
+        if lists:
+            self.build(lists)
+
+    @staticmethod
+    def fromList(mlist, tags = False):
+        """Builds the index for a list using client-side expansion."""
+
+        members, inaccessible, lists = mlist.getAllMembers(include_lists = True, tags = tags)
+        return ClosureIndex(lists)
+
+    def intern(self, key):
+        """Returns the id of the (type, name) member key, assigning one if needed."""
+
+        if key not in self.ids:
+            self.ids[key] = len(self.keys)
+            self.keys.append(key)
+        return self.ids[key]
+
+    def setExplicitMembers(self, listname, members):
+        """Replaces the explicit members of the list, without updating the closure."""
+
+        for sublist in self.sublists(listname):
+            self.parents[sublist].discard(listname)
+
+        if members is None:
+            self.explicit[listname] = frozenset()
+            return
+
+        self.explicit[listname] = frozenset( self.intern(_memberKey(member)) for member in members )
+        for sublist in self.sublists(listname):
+            self.parents.setdefault(sublist, set()).add(listname)
+
+    def sublists(self, listname):
+        """Returns the names of the lists which are explicitly on the list."""
+
+        return [ self.keys[i][1] for i in self.explicit.get(listname, ()) if self.keys[i][0] == ListMember.List ]
+
+    @profiling.operation('ClosureIndex.build', 'graph')
+    def build(self, lists):
+        """Builds the index from the dictionary of explicit list members."""
+
+        for listname, members in lists.items():
+            self.setExplicitMembers(listname, members)
+        self.computeClosure( list(self.explicit) )
+
+    def computeClosure(self, listnames):
+        """Recomputes the closure bitsets of the specified lists. The set has to be
+        closed upwards (contain every list which contains one of its lists), so the
+        closures of the other lists are still valid. The lists are condensed into
+        the strongly connected components, so every closure is computed once."""
+
+        listnames = set(listnames)
+        components = stronglyConnectedComponents( sorted(listnames), lambda listname: [ sublist for sublist in self.sublists(listname) if sublist in listnames ] )
+
+        computed = {}
+        for component in components:
+            explicit = set()
+            for listname in component:
+                explicit.update( self.explicit.get(listname, ()) )
+            value = _fromBitset( _bitsetFromIds(explicit) )
+            for listname in component:
+                for sublist in self.sublists(listname):
+                    if sublist in computed:
+                        value |= computed[sublist]
+                    elif sublist not in listnames:
+                        value |= _fromBitset( self.closure.get(sublist, bytearray()) )
+
+            bitset = _toBitset(value)
+            for listname in component:
+                computed[listname] = value
+                self.closure[listname] = bitset
+
+    def ancestors(self, listname):
+        """Returns the names of the list and all lists containing it, directly or not."""
+
+        result = set( (listname, ) )
+        stack = [listname]
+        while stack:
+            for parent in self.parents.get(stack.pop(), ()):
+                if parent not in result:
+                    result.add(parent)
+                    stack.append(parent)
+        return result
+
+    @profiling.operation('ClosureIndex.updateList', 'graph')
+    def updateList(self, listname, members):
+        """Updates the index after the explicit members of a single list have changed.
+        Only the closures of the list and the lists containing it are recomputed."""
+
+        affected = self.ancestors(listname)
+        self.setExplicitMembers(listname, members)
+        self.computeClosure( affected | self.ancestors(listname) )
+
+    def isMember(self, member, listname):
+        """Returns whether the member (ListMember or a (type, name) tuple) is on the
+        list directly or through other lists."""
+
+        member_id = self.ids.get( _memberKey(member) )
+        if member_id is None or listname not in self.closure:
+            return False
+        return _testBit(self.closure[listname], member_id)
+
+    def members(self, listname):
+        """Returns the set of (type, name) keys of all members of the list."""
+
+        return set( self.keys[i] for i in _iterBits( self.closure.get(listname, ()) ) )
+
+    def memoryFootprint(self):
+        """Returns the approximate amount of memory used by the index, in bytes."""
+
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.keys) + sys.getsizeof(self.closure)
+        size += sys.getsizeof(self.explicit) + sys.getsizeof(self.parents)
+        size += sum( sys.getsizeof(key) + sys.getsizeof(key[1]) for key in self.keys )
+        size += sum( sys.getsizeof(bitset) for bitset in self.closure.values() )
+        size += sum( sys.getsizeof(members) for members in self.explicit.values() )
+        size += sum( sys.getsizeof(parents) for parents in self.parents.values() )
+        return size
@@ -5,7 +5,7 @@
 #
 
 from .lists import ListMember
-import socket
+from .client import default_locator
 
 class Host(ListMember):
     def __init__(self, client, name, canonicalize = True):
@@ -18,7 +18,25 @@ class Host(ListMember):
             self.canonicalize()
     
     def canonicalize(self):
-        """Replaces the alias form of the host with the proper name."""
+        """Replaces the alias form of the host with the proper name. The results of
+        the DNS lookups are cached for the whole process (see ServerLocator)."""
 
-        self.name = socket.getfqdn(self.name)
+        self.name = default_locator.canonicalize(self.name)
 
+    @staticmethod
+    def canonicalizeMany(hosts, threads = 16):
+        """Does the same thing as canonicalize() for many hosts at once, resolving
+        the names which are not cached concurrently. This allows the hosts to be
+        created with canonicalize = False and canonicalized in one batch later.
+        Returns the list of new Host objects with the canonical names, in the same
+        order; the hosts passed are not changed, as they may already be stored in
+        sets or used as dictionary keys. The names which could not be resolved are
+        kept as they are."""
+
+        names = default_locator.canonicalizeMany( [host.name for host in hosts], threads )
+        result = []
+        for host in hosts:
+            canonical = Host(host.client, host.name, canonicalize = False)
+            canonical.name = names.get(host.name, host.name)
+            result.append(canonical)
+        return result
@@ -6,6 +6,7 @@
 #
 
 from . import protocol
+from . import profiling
 from . import constants
 from . import utils
 from . import stubs
@@ -113,6 +114,7 @@ class ListMember(object):
             list_obj.is_mailing = is_mailing
             list_obj.is_afsgroup = is_afsgroup
             result.append(list_obj)
+        utils.LoadGroup(result)
         
         return frozenset(result)
     
@@ -164,6 +166,30 @@ class ListMember(object):
         
         return None
 
+def _createStub(stub_type):
+    def create(client, name):
+        m = stub_type()
+        m.name = name
+        return m
+    return create
+
+def _createHost(client, name):
+    from .host import Host
+    return Host(client, name, canonicalize = False)
+
+# Constructors for the objects returned by get_ace_use, by object type
+_owned_object_types = {
+    'CONTAINER' : _createStub(stubs.Container),
+    'CONTAINER-MEMACL' : _createStub(stubs.ContainerMembershipACL),
+    'FILESYS' : lambda client, name: Filesys(client, name),
+    'LIST' : lambda client, name: List(client, name),
+    'MACHINE' : _createHost,
+    'QUERY' : _createStub(stubs.Query),
+    'QUOTA' : _createStub(stubs.Quota),
+    'SERVICE' : _createStub(stubs.Service),
+    'ZEPHYR' : _createStub(stubs.ZephyrClass),
+}
+
 # Users and lists are only object capable of owning other objects
 class Owner(ListMember):
     """This class provides a getOwnedObjects() method which allows to determine which
@@ -180,50 +206,38 @@ class Owner(ListMember):
     # SERVICE (alleged by source)
     # ZEPHYR
 
-    def getOwnedObjects(self, recursive = False):
-        """Return all the objects owned by this owner."""
+    @staticmethod
+    def createOwnedObject(client, mtype, name):
+        """Constructs the object of a given type returned by get_ace_use query.
+        Returns None for the types which are not known."""
+
+        if mtype not in _owned_object_types:
+            return None
+        return _owned_object_types[mtype](client, name)
+
+    def getOwnedObjectsQuery(self, recursive = False):
+        """Returns the (query name, arguments) tuple of the query which returns
+        the objects owned by this owner."""
 
         owner_type = ('R' + self.mtype) if recursive else self.mtype
+        return ( 'get_ace_use', (owner_type, self.name) )
 
-        response = self.client.query( 'get_ace_use', (owner_type, self.name), version = 14 )
+    def getOwnedObjects(self, recursive = False):
+        """Return all the objects owned by this owner."""
+
+        query_name, args = self.getOwnedObjectsQuery(recursive)
+        response = self.client.query( query_name, args, version = 14 )
 
         result = []
         for mtype, name in response:
-            if mtype == 'CONTAINER':
-                m = stubs.Container()
-                m.name = name
-                result.append(m)
-            if mtype == 'CONTAINER-MEMACL':
-                m = stubs.ContainerMembershipACL()
-                m.name = name
-                result.append(m)
-            if mtype == 'FILESYS':
-                result.append( Filesys(self.client, name) )
-            if mtype == 'LIST':
-                result.append( List(self.client, name) )
-            if mtype == 'MACHINE':
-                from .host import Host
-                result.append( Host(self.client, name, canonicalize = False) )
-            if mtype == 'QUERY':
-                m = stubs.Query()
-                m.name = name
-                result.append(m)
-            if mtype == 'QUOTA':
-                m = stubs.Quota()
-                m.name = name
-                result.append(m)
-            if mtype == 'SERVICE':
-                m = stubs.Service()
-                m.name = name
-                result.append(m)
-            if mtype == 'ZEPHYR':
-                m = stubs.ZephyrClass()
-                m.name = name
+            m = Owner.createOwnedObject(self.client, mtype, name)
+            if m is not None:
                 result.append(m)
+        utils.LoadGroup(result)
 
         return result
 
-class List(Owner):
+class List(Owner, utils.LazyRecord):
     info_query_description = (
         ('name', str),
         ('active', bool),
@@ -244,6 +258,7 @@ class List(Owner):
         ('lastmod_by', str),
         ('lastmod_with', str),
     )
+    lazy_fields = ('owner', 'memacl')
 
     def __init__(self, client, listname):
         # FIXME: name validation should go here
@@ -260,17 +275,228 @@ class List(Owner):
         that is, not by other lists."""
         
         response = self.client.query( query_name, (self.name,), version = 14 )
-        result = []
-        for member in response:
-            result.append( ListMember.fromTuple(self.client, member) )
-        
+        return List.membersFromResponse(self.client, response)
+
+    @staticmethod
+    def membersFromResponse(client, response):
+        """Returns the frozenset of the members in the rows of a list member query."""
+
+        result = [ ListMember.fromTuple(client, member) for member in response ]
+        utils.LoadGroup(result)
         return frozenset(result)
 
     def getExplicitMembers(self, tags = False):
         query_name = "get_tagged_members_of_list" if tags else "get_members_of_list"
         return self.getMembersViaQuery(query_name)
 
-    def getAllMembers(self, server_side = False, include_lists = False, tags = False):
+    # Strategies of the recursive expansion, see expand()
+    ServerSide = 'server'
+    ClientSide = 'client'
+    Hybrid = 'hybrid'
+    Auto = 'auto'
+
+    def chooseExpansionStrategy(self, tags = False, trace = False):
+        """Chooses the cheapest expansion strategy which provides the requested
+        information. Server-side expansion is a single query, but it requires the
+        access to get_end_members_of_list (which is checked with an MR_ACCESS probe)
+        and returns neither the tags nor the structure of the nested lists. Hybrid
+        expansion adds these by fetching the explicit members of all nested lists
+        at once. Client-side expansion works with any access, but needs one
+        query per nested list and as many round trips as the hierarchy is deep."""
+
+        if self.client.probe( 'get_end_members_of_list', (self.name, ), version = 14 ) != constants.MR_SUCCESS:
+            return List.ClientSide
+        if tags or trace:
+            return List.Hybrid
+        return List.ServerSide
+
+    @profiling.operation('List.expand', 'graph')
+    def expand(self, strategy = Auto, include_lists = False, tags = False, trace = False, memory_budget = None):
+        """Performs a recursive expansion of the list using the specified strategy
+        (ServerSide, ClientSide, Hybrid, or Auto to choose one automatically, see
+        chooseExpansionStrategy()). If trace is set, the structure of the nested
+        lists is required. Returns the (members, inaccessible_lists, lists) tuple as
+        the client-side getAllMembers() does; for the server-side strategy, the
+        inaccessible_lists is empty and lists is None. The memory_budget is used by
+        the client-side strategy, see getAllMembers().
+
+        In the hybrid strategy, all end members are fetched on the server side, and
+        the explicit members of the list and all its nested lists are then fetched
+        through the pipeline, so the members of the nested lists to which the access
+        is denied are still included into the result."""
+
+        if strategy == List.Auto:
+            strategy = self.chooseExpansionStrategy(tags, trace)
+
+        if strategy == List.ClientSide:
+            return self.getAllMembers(include_lists = include_lists, tags = tags, memory_budget = memory_budget)
+
+        end_members = self.getMembersViaQuery("get_end_members_of_list")
+        if strategy == List.ServerSide:
+            if tags or trace:
+                raise UserError("Server-side expansion does not support member tag retrieval and tracing")
+            members = end_members
+        elif strategy == List.Hybrid:
+            known = {}
+            denied = set()
+
+            query_name = "get_tagged_members_of_list" if tags else "get_members_of_list"
+            names = [self.name] + sorted( set(member.name for member in end_members if type(member) == List) - set((self.name, )) )
+            results = self.client.pipeline( ( (query_name, (name, )) for name in names ), version = 14 )
+            for name, response in zip(names, results):
+                if isinstance(response, MoiraError):
+                    if response.code == constants.MR_PERM and name != self.name:
+                        denied.add(name)
+                        known[name] = None
+                        continue
+                    raise response
+                known[name] = frozenset( ListMember.fromTuple(self.client, member) for member in response )
+
+            members = set()
+            for explicit in known.values():
+                members.update(explicit or ())
+            members.update(end_members)
+            members = frozenset(members)
+        else:
+            raise UserError("Unknown list expansion strategy: %s" % strategy)
+
+        if not include_lists:
+            members = [m for m in members if type(m) != List]
+        if strategy == List.ServerSide:
+            return (members, set(), None)
+        return (members, denied, known)
+
+    # Events yielded by iterAllMembers()
+    MemberEvent = 'member'
+    EnterEvent = 'enter'
+    DeniedEvent = 'denied'
+
+    def iterAllMembers(self, include_lists = False, tags = False, events = False, known = None, denied = None):
+        """Performs the client-side recursive expansion of the list, yielding every
+        member as soon as the list on which it is first found is fetched, so the
+        members may be processed before the whole hierarchy is expanded. The nested
+        lists are fetched level by level through the pipeline, in chunks which are
+        received completely before their members are yielded, so the client may be
+        used (and the members loaded) while iterating.
+
+        If events is set, (event, value) pairs are yielded instead of the members:
+        (MemberEvent, member) for every member, (EnterEvent, list name) before the
+        members of every list and (DeniedEvent, list name) for every nested list to
+        which the access is denied. If the known dictionary and the denied set are
+        specified, they are filled in the same way as by getAllMembers()."""
+
+        if known is None:
+            known = {}
+        if denied is None:
+            denied = set()
+
+        seen = set()
+        for name, members in self.walkHierarchy(tags):
+            if members is None:
+                denied.add(name)
+                known[name] = None
+                if events:
+                    yield (List.DeniedEvent, name)
+                continue
+
+            known[name] = members
+            if events:
+                yield (List.EnterEvent, name)
+            for member in members:
+                if member in seen:
+                    continue
+                seen.add(member)
+                if not include_lists and type(member) == List:
+                    continue
+                yield (List.MemberEvent, member) if events else member
+
+    def walkHierarchy(self, tags = False):
+        """Yields the (list name, explicit members) pairs for the list and all its
+        nested lists, each list once, level by level; the members are None for the
+        nested lists to which the access is denied. The access error for the list
+        itself is raised."""
+
+        query_name = "get_tagged_members_of_list" if tags else "get_members_of_list"
+        visited = set()
+        pending = [ (self.name, self.getExplicitMembers(tags = tags)) ]
+        depth = 0
+        while True:
+            sublists = []
+            for name, members in pending:
+                visited.add(name)
+                yield (name, members)
+                if members is not None:
+                    sublists.extend( member.name for member in members if type(member) == List )
+
+            level = []
+            for name in sublists:
+                if name not in visited:
+                    visited.add(name)
+                    level.append(name)
+            if not level:
+                return
+
+            depth += 1
+            if depth >= protocol.MOIRA_MAX_LIST_DEPTH:
+                raise UserError("List expansion depth limit exceeded")
+            pending = self.fetchSublists(level, query_name)
+
+    def fetchSublists(self, names, query_name, window = protocol.MOIRA_PIPELINE_WINDOW):
+        """Yields the (name, members) pairs for the lists, fetched through the
+        pipeline; members is None for the lists to which the access is denied.
+        The lists are fetched in chunks of window lists, and every chunk is received
+        completely before its lists are yielded, so no responses are outstanding on
+        the connection while the caller processes them (and, for instance, loads
+        the members lazily)."""
+
+        for start in range(0, len(names), window):
+            chunk = names[start:start + window]
+            results = self.client.queryMany( ( (query_name, (name, )) for name in chunk ), version = 14, window = window )
+            for name, response in zip(chunk, results):
+                if isinstance(response, MoiraError):
+                    if response.code == constants.MR_PERM:
+                        yield (name, None)
+                        continue
+                    raise response
+                yield (name, List.membersFromResponse(self.client, response))
+
+    @profiling.operation('List.expandBounded', 'graph')
+    def expandBounded(self, memory_budget, include_lists = False, tags = False, directory = None):
+        """Performs the client-side recursive expansion of the list keeping at most
+        about memory_budget bytes of members in memory. Half of the budget is used
+        for the explicit members of the nested lists, which are moved into a dbm
+        file once it is exceeded; the other half buffers the members of the result,
+        which are written out as sorted run files and deduplicated by merging them.
+        The temporary files are created in the directory (or the system default).
+        The memory used is estimated from the sizes of the member names and the
+        fixed per-member overheads measured on CPython (see spill.py), so the budget
+        is only approximate.
+
+        Returns the (members, inaccessible_lists, lists) tuple as getAllMembers()
+        does, but the members are the iterable which yields them from the merged
+        runs and the lists is the dictionary-like object reading the spilled sets
+        back on access. Both have close() which removes their temporary files, and
+        each may be used after the other one is closed. If a member is found with
+        different tags, the tag found first is kept, as in getAllMembers()."""
+
+        from . import spill
+
+        known = spill.SpillingListStore( memory_budget // 2, spill.SpillDirectory(directory), lambda rows: List.membersFromResponse(self.client, rows) )
+        members = spill.ExternalSorter( memory_budget // 2, spill.SpillDirectory(directory), lambda row: ListMember.fromTuple(self.client, row) )
+        denied = set()
+        for name, explicit in self.walkHierarchy(tags):
+            known[name] = explicit
+            if explicit is None:
+                denied.add(name)
+                continue
+            for member in explicit:
+                if include_lists or type(member) != List:
+                    members.add( member.toTuple() )
+
+        return (members, denied, known)
+
+    @profiling.operation('List.getAllMembers', 'graph')
+    def getAllMembers(self, server_side = False, include_lists = False, tags = False, memory_budget = None):
         """Performs a recursive expansion of the given list. This may be done both
         on the side of the client and on the side of the server. In the latter case,
         the server does not communicate the list of the nested lists to which user
@@ -279,7 +505,8 @@ class List(Owner):
         the (members, inaccessible_lists, lists) tuple instead of just the member list.
         The inaccessible_lists is a set of lists to which the access was denied, and
         the lists is the dictionary with the memers of all lists encountered during
-        the expansion process."""
+        the expansion process. If the memory_budget (in bytes) is specified, the
+        client-side expansion is done by expandBounded()."""
         
         if server_side:
             if tags:
@@ -291,52 +518,44 @@ class List(Owner):
             else:
                 return frozenset( [m for m in members if type(m) != List] )
 
+        elif memory_budget:
+            return self.expandBounded(memory_budget, include_lists = include_lists, tags = tags)
+
         else:
-            # Already expanded lists
             known = {}
             denied = set()
-            
-            # We need seperate handling for the first list, because if access to it is denied,
-            # we are supposed to return the error message
-            members = self.getExplicitMembers(tags = tags)
-            known[self.name] = members
-            
-            to_expand = True
-            current_depth = 0
-            max_depth = protocol.MOIRA_MAX_LIST_DEPTH
-            while to_expand:
-                current_depth += 1
-                if current_depth > max_depth:
-                    raise UserError("List expansion depth limit exceeded")
-                
-                to_expand = {member.name for member in members if type(member) == List} - set(known)
-                for sublist_name in to_expand:
-                    try:
-                        new_members = List(self.client, sublist_name).getExplicitMembers()
-                    except MoiraError as err:
-                        if err.code == constants.MR_PERM:
-                            denied.add(sublist_name)
-                            known[sublist_name] = None
-                            continue
-                        else:
-                            raise err
-                            
-                    known[sublist_name] = new_members
-                    members |= new_members
-            
-            if not include_lists:
-                members = [m for m in members if type(m) != List]
+            members = self.iterAllMembers(include_lists = include_lists, tags = tags, known = known, denied = denied)
+            members = frozenset(members) if include_lists else list(members)
             
             return (members, denied, known)
     
+    def infoQueries(self):
+        return [ ('get_list_info', (self.name, )) ]
+    
+    def loadInfoFromResults(self, results):
+        response, = results
+        if isinstance(response, MoiraError):
+            raise response
+        self.loadInfoFromResponse(response[0])
+    
     def loadInfo(self):
         """Loads the information about the list from the server into the object."""
         
         response, = self.client.query( 'get_list_info', (self.name, ), version = 14 )
-        result = utils.responseToDict(self.info_query_description, response)
-        self.__dict__.update(result)
-        self.owner  = ListMember.create( self.client, self.owner_type, self.owner_name )
-        self.memacl = ListMember.create( self.client, self.memacl_type, self.memacl_name ) if self.memacl_type != 'NONE' else None
+        self.loadInfoFromResponse(response)
+    
+    def loadInfoFromResponse(self, response):
+        """Loads the information about the list from a row returned by get_list_info.
+        The fields are decoded when they are first accessed."""
+        
+        self.attachInfo(response)
+    
+    def deriveField(self, name):
+        if name == 'owner':
+            return ListMember.create( self.client, self.owner_type, self.owner_name )
+        if name == 'memacl':
+            return ListMember.create( self.client, self.memacl_type, self.memacl_name ) if self.memacl_type != 'NONE' else None
+        raise AttributeError(name)
     
     def updateParams(self, **updates):
         """Updates a certain parameter in user information."""
@@ -448,7 +667,12 @@ class List(Owner):
         be stored in JSON or other machine-readable format and reset from it."""
 
         self.loadInfo()
-        members = self.getExplicitMembers(tags = True)
+        return self.serializeLoaded( self.getExplicitMembers(tags = True) )
+
+    def serializeLoaded(self, members):
+        """Does the same thing as serialize(), but uses the already loaded list
+        information and the specified explicit members instead of querying them."""
+
         result = {}
         for field, field_type in self.info_query_description:
             result[field] = getattr(self, field)
@@ -462,12 +686,13 @@ class List(Owner):
 
 class ListTracer(object):
     """A class which for a given list allows to determine why the certain member is on that list.
-    When you initialize it, it does the recursive expansion of the list on the client side,
-    and then you may ask the class for the inclusion paths for different members."""
+    When you initialize it, it does the recursive expansion of the list (client-side or hybrid,
+    see List.expand()), and then you may ask the class for the inclusion paths for different members."""
     
-    def __init__(self, mlist, tags = False, max_pathways = 65536):
+    @profiling.operation('ListTracer', 'graph')
+    def __init__(self, mlist, tags = False, max_pathways = 65536, strategy = List.Auto):
         self.mlist = mlist
-        self.members, self.inaccessible, self.lists = mlist.getAllMembers(include_lists = True, tags = tags)
+        self.members, self.inaccessible, self.lists = mlist.expand(strategy, include_lists = True, tags = tags, trace = True)
         self.max_pathways = max_pathways
         self.createInverseMap()
     
@@ -487,6 +712,7 @@ class ListTracer(object):
         self.inverse = result
         self.inverseLists = { member.name : contents for member, contents in self.inverse.items() if type(member) == List }
     
+    @profiling.operation('ListTracer.trace', 'graph')
     def trace(self, member):
         """Returns the pathways by which user is included into a list. The pathways
         are tuples in which the first element is the root list and the last one is
@@ -501,16 +727,32 @@ class ListTracer(object):
         return pathways
         
     def recursiveTrace(self, member, curlist, curway, output):
-        newway = curway + (curlist,)
-        if curlist == self.mlist.name:
-            if len(output) == self.max_pathways:
-                raise UserError("Maximum number (%s) of possible inclusion pathways reached" % self.max_pathways)
-            output.append( newway[::-1] )
-            return
+        """Appends to output all the pathways from the root list to curlist which do
+        not pass through curway. The search uses an explicit stack, so it is not
+        limited by the Python recursion depth, and the lists on the current path
+        are kept in a set, so the cycle check does not depend on the path length."""
         
-        for listname in self.inverseLists[curlist]:
+        path = list(curway)
+        on_path = set(path)
+        stack = [ iter( (curlist, ) ) ]
+        while stack:
+            listname = next(stack[-1], None)
+            if listname is None:
+                stack.pop()
+                if stack:
+                    on_path.discard( path.pop() )
+                continue
+            
             # Protect ourselves from recursions
-            if listname in newway:
+            if listname in on_path:
+                continue
+            
+            if listname == self.mlist.name:
+                if len(output) == self.max_pathways:
+                    raise UserError("Maximum number (%s) of possible inclusion pathways reached" % self.max_pathways)
+                output.append( tuple(path + [listname])[::-1] )
                 continue
             
-            self.recursiveTrace(member, listname, newway, output)
+            path.append(listname)
+            on_path.add(listname)
+            stack.append( iter(self.inverseLists.get(listname, ())) )
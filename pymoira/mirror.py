@@ -0,0 +1,346 @@
+#
+## PyMoira client library
+##
+## This file contains the local SQLite mirror of lists, users, filesystems and
+## list memberships, and the read-only client which answers queries from it.
+#
+
+import sqlite3
+import time
+
+from . import cache
+from . import constants
+from . import protocol
+from . import schema
+from .errors import *
+from .filesys import Filesys
+from .lists import List
+from .user import User
+
+def _columns(description):
+    return [ name for name, datatype in description ]
+
+def _quote(name):
+    return '"%s"' % name
+
+def _wildcardToGlob(pattern):
+    """Converts the Moira wildcard (with * and ?) into the SQLite GLOB pattern."""
+
+    return pattern.replace('[', '[[]')
+
+class Mirror(object):
+    """The local copy of Moira lists, users, filesystems (with their quotas) and
+    explicit list memberships in an SQLite database, which allows to run arbitrary
+    reports as SQL joins without querying the server. The records are stored as
+    raw response rows, one column per field of the info_query_description of List,
+    User and Filesys; the members table has the list_name, member_type,
+    member_name and tag columns.
+
+    sync() streams the records from the server and writes only the changed ones.
+    The explicit members are fetched (pipelined) only for the lists which are new
+    or have a different lastmod_datetime, as changing the membership of a list
+    updates its modification time."""
+
+    tables = {
+        'lists' : _columns(List.info_query_description),
+        'users' : _columns(User.info_query_description),
+        'filesys' : _columns(Filesys.info_query_description),
+        'quotas' : _columns(Filesys.quota_query_description),
+    }
+
+    indexes = (
+        ('lists', ('owner_type', 'owner_name')),
+        ('lists', ('memacl_type', 'memacl_name')),
+        ('users', ('uid', )),
+        ('users', ('mit_id', )),
+        ('users', ('status', )),
+        ('users', ('sponsor_type', 'sponsor_name')),
+        ('filesys', ('owner_user', )),
+        ('filesys', ('owner_group', )),
+        ('quotas', ('filesys', )),
+        ('members', ('list_name', )),
+        ('members', ('member_type', 'member_name')),
+    )
+
+    # The amount of rows written with a single executemany() call
+    batch_size = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.text_factory = str
+        self.createSchema()
+
+    def createSchema(self):
+        with self.db:
+            for table, columns in self.tables.items():
+                primary = '' if table == 'quotas' else ' PRIMARY KEY'
+                fields = [ _quote(columns[0]) + ' TEXT' + primary ] + [ _quote(column) + ' TEXT' for column in columns[1:] ]
+                self.db.execute( 'CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ', '.join(fields)) )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS members (list_name TEXT, member_type TEXT, member_name TEXT, tag TEXT)' )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS list_sync (name TEXT PRIMARY KEY, lastmod_datetime TEXT, status INTEGER)' )
+            self.db.execute( 'CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)' )
+            for table, columns in self.indexes:
+                index_name = 'idx_%s_%s' % (table, '_'.join(columns))
+                self.db.execute( 'CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (index_name, table, ', '.join( _quote(column) for column in columns )) )
+
+    def execute(self, sql, params = ()):
+        """Runs an SQL statement against the mirror and returns the cursor."""
+
+        return self.db.execute(sql, params)
+
+    def close(self):
+        self.db.close()
+
+    def client(self):
+        """Returns the read-only client answering the queries from the mirror."""
+
+        return MirrorClient(self)
+
+    def lastSync(self):
+        """Returns the time of the last completed sync in seconds since the epoch,
+        or None if the mirror was never synced."""
+
+        row = self.db.execute( "SELECT value FROM sync_state WHERE key = 'last_sync'" ).fetchone()
+        return float(row[0]) if row else None
+
+    def writeMany(self, sql, rows):
+        """Runs executemany() for the rows in batches of batch_size. Has to be called
+        inside a transaction."""
+
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                self.db.executemany(sql, batch)
+                batch = []
+        if batch:
+            self.db.executemany(sql, batch)
+
+    def syncRecords(self, table, rows):
+        """Brings the table up to date with the streamed rows, writing only the rows
+        whose lastmod_datetime has changed. Returns the tuple of the sets of keys
+        which were changed (or added) and removed."""
+
+        columns = self.tables[table]
+        key, lastmod = _quote(columns[0]), columns.index('lastmod_datetime')
+        existing = dict( self.db.execute( 'SELECT %s, lastmod_datetime FROM %s' % (key, table) ) )
+
+        changed = set()
+        seen = set()
+        def changedRows():
+            for row in rows:
+                seen.add(row[0])
+                if existing.get(row[0]) != row[lastmod]:
+                    changed.add(row[0])
+                    yield tuple(row)
+
+        insert = 'INSERT OR REPLACE INTO %s VALUES (%s)' % (table, ', '.join( '?' for column in columns ))
+        with self.db:
+            self.writeMany(insert, changedRows())
+            removed = set(existing) - seen
+            self.writeMany( 'DELETE FROM %s WHERE %s = ?' % (table, key), ( (name, ) for name in removed ) )
+        return changed, removed
+
+    def syncQuotas(self, client):
+        """Replaces all the quotas; the quota rows do not have a unique key."""
+
+        rows = client.iterQuery( 'get_quota_by_filesys', ('*', ), version = 14 )
+        with self.db:
+            self.db.execute( 'DELETE FROM quotas' )
+            self.writeMany( 'INSERT INTO quotas VALUES (%s)' % ', '.join( '?' for column in self.tables['quotas'] ), rows )
+
+    def syncMembers(self, client, names, removed = (), window = protocol.MOIRA_PIPELINE_WINDOW):
+        """Fetches the explicit members of the lists through the pipeline and
+        replaces them in the mirror. The lists to which the access is denied are
+        recorded with the error code, which the mirror client then returns."""
+
+        lastmods = dict( self.db.execute( 'SELECT name, lastmod_datetime FROM lists' ) )
+        names = sorted(names)
+
+        with self.db:
+            self.writeMany( 'DELETE FROM members WHERE list_name = ?', ( (name, ) for name in removed ) )
+            self.writeMany( 'DELETE FROM list_sync WHERE name = ?', ( (name, ) for name in removed ) )
+
+        for start in range(0, len(names), self.batch_size):
+            batch = names[start:start + self.batch_size]
+            queries = ( ('get_tagged_members_of_list', (name, )) for name in batch )
+            results = client.pipeline(queries, version = 14, window = window)
+
+            with self.db:
+                for name, response in zip(batch, results):
+                    self.db.execute( 'DELETE FROM members WHERE list_name = ?', (name, ) )
+                    if isinstance(response, MoiraError):
+                        if response.code not in (constants.MR_PERM, constants.MR_LIST, constants.MR_NO_MATCH):
+                            raise response
+                        status = response.code
+                    else:
+                        status = constants.MR_SUCCESS
+                        self.db.executemany( 'INSERT INTO members VALUES (?, ?, ?, ?)', [ (name, ) + tuple(member) for member in response ] )
+                    self.db.execute( 'INSERT OR REPLACE INTO list_sync VALUES (?, ?, ?)', (name, lastmods.get(name), status) )
+
+    def sync(self, client, lists = True, users = True, filesys = True, members = True, window = protocol.MOIRA_PIPELINE_WINDOW):
+        """Brings the mirror up to date with the server. Returns the dictionary which
+        maps each synced table to the (changed, removed) tuple of numbers of records."""
+
+        stats = {}
+        if users:
+            changed, removed = self.syncRecords( 'users', client.iterQuery( 'get_user_account_by_login', ('*', ), version = 14 ) )
+            stats['users'] = ( len(changed), len(removed) )
+
+        if filesys:
+            changed, removed = self.syncRecords( 'filesys', client.iterQuery( 'get_filesys_by_label', ('*', ), version = 14 ) )
+            stats['filesys'] = ( len(changed), len(removed) )
+            self.syncQuotas(client)
+
+        if lists:
+            changed, removed = self.syncRecords( 'lists', client.iterQuery( 'get_list_info', ('*', ), version = 14 ) )
+            stats['lists'] = ( len(changed), len(removed) )
+
+            if members:
+                # Also fetch the members of the lists never synced or last synced with an older lastmod
+                stale = self.db.execute( 'SELECT l.name FROM lists l LEFT JOIN list_sync s ON l.name = s.name WHERE s.lastmod_datetime IS NOT l.lastmod_datetime' )
+                names = changed | set( row[0] for row in stale )
+                self.syncMembers(client, names, removed, window)
+                stats['members'] = ( len(names), len(removed) )
+
+        with self.db:
+            self.db.execute( "INSERT OR REPLACE INTO sync_state VALUES ('last_sync', ?)", (repr(time.time()), ) )
+        return stats
+
+class MirrorClient(object):
+    """The read-only client which answers the queries from a Mirror instead of the
+    server, providing the same querying interface as Client. This allows to use
+    List, User and Filesys objects with the mirrored data. Only the retrieval
+    queries which can be answered from the mirror are supported; the other ones
+    fail with MR_NO_HANDLE, and the queries modifying the data raise UserError."""
+
+    cache = None
+    limiter = None
+
+    def __init__(self, mirror):
+        self.mirror = mirror
+        self.version = protocol.MOIRA_QUERY_VERSION
+        self.handlers = {
+            'get_list_info' : self.getListInfo,
+            'get_members_of_list' : self.getMembersOfList,
+            'get_tagged_members_of_list' : self.getTaggedMembersOfList,
+            'get_end_members_of_list' : self.getEndMembersOfList,
+            'count_members_of_list' : self.countMembersOfList,
+            'get_lists_of_member' : self.getListsOfMember,
+            'get_user_account_by_login' : self.getUserAccountByLogin,
+            'get_filesys_by_label' : self.getFilesysByLabel,
+            'get_quota_by_filesys' : self.getQuotaByFilesys,
+        }
+
+    def setVersion(self, version):
+        self.version = version
+
+    def checkQuery(self, name, params):
+        return schema.checkArguments(name, params, self.version)
+
+    def rows(self, sql, params):
+        return tuple( self.mirror.execute(sql, params).fetchall() )
+
+    def select(self, table, pattern):
+        key = _quote( self.mirror.tables[table][0] )
+        rows = self.rows( 'SELECT * FROM %s WHERE %s GLOB ? ORDER BY %s' % (table, key, key), (_wildcardToGlob(pattern), ) )
+        if not rows:
+            raise MoiraError(constants.MR_NO_MATCH)
+        return rows
+
+    def getListInfo(self, name):
+        return self.select('lists', name)
+
+    def getUserAccountByLogin(self, login):
+        return self.select('users', login)
+
+    def getFilesysByLabel(self, label):
+        return self.select('filesys', label)
+
+    def getQuotaByFilesys(self, label):
+        return self.select('quotas', label)
+
+    def checkListSynced(self, name):
+        """Raises the error the members of the list could not be fetched with, or
+        MR_LIST if the list is not in the mirror."""
+
+        row = self.mirror.execute( 'SELECT status FROM list_sync WHERE name = ?', (name, ) ).fetchone()
+        if row is None:
+            raise MoiraError(constants.MR_LIST)
+        if row[0] != constants.MR_SUCCESS:
+            raise MoiraError(row[0])
+
+    def getMembersOfList(self, name):
+        self.checkListSynced(name)
+        return self.rows( 'SELECT member_type, member_name FROM members WHERE list_name = ? ORDER BY member_type, member_name', (name, ) )
+
+    def getTaggedMembersOfList(self, name):
+        self.checkListSynced(name)
+        return self.rows( 'SELECT member_type, member_name, tag FROM members WHERE list_name = ? ORDER BY member_type, member_name', (name, ) )
+
+    def countMembersOfList(self, name):
+        self.checkListSynced(name)
+        return self.rows( 'SELECT CAST(COUNT(*) AS TEXT) FROM members WHERE list_name = ?', (name, ) )
+
+    def getEndMembersOfList(self, name):
+        self.checkListSynced(name)
+        return self.rows( """WITH RECURSIVE sublists(name) AS (
+                SELECT ? UNION
+                SELECT m.member_name FROM members m JOIN sublists s ON m.list_name = s.name WHERE m.member_type = 'LIST'
+            )
+            SELECT DISTINCT m.member_type, m.member_name FROM members m JOIN sublists s ON m.list_name = s.name
+            ORDER BY m.member_type, m.member_name""", (name, ) )
+
+    def getListsOfMember(self, mtype, name):
+        fields = 'l.name, l.active, l.public, l.hidden, l.is_mailing, l.is_afsgroup'
+        if mtype.startswith('R'):
+            rows = self.rows( """WITH RECURSIVE containing(name) AS (
+                    SELECT list_name FROM members WHERE member_type = ? AND member_name = ? UNION
+                    SELECT m.list_name FROM members m JOIN containing c ON m.member_type = 'LIST' AND m.member_name = c.name
+                )
+                SELECT %s FROM lists l JOIN containing c ON l.name = c.name ORDER BY l.name""" % fields, (mtype[1:], name) )
+        else:
+            rows = self.rows( 'SELECT DISTINCT %s FROM lists l JOIN members m ON l.name = m.list_name WHERE m.member_type = ? AND m.member_name = ? ORDER BY l.name' % fields, (mtype, name) )
+        if not rows:
+            raise MoiraError(constants.MR_NO_MATCH)
+        return rows
+
+    def query(self, name, params, version = None):
+        """Answers the query from the mirror and returns the result."""
+
+        if not cache.isReadOnly(name):
+            raise UserError("The Moira mirror is read-only, %s may not be run on it" % name)
+        error = self.checkQuery(name, tuple(params))
+        if error:
+            raise error
+        if name not in self.handlers:
+            raise MoiraError(constants.MR_NO_HANDLE)
+        return self.handlers[name](*params)
+
+    def iterQuery(self, name, params, version = None):
+        return iter( self.query(name, params, version) )
+
+    def pipeline(self, queries, version = None, window = None):
+        for name, params in queries:
+            try:
+                yield self.query(name, params, version)
+            except MoiraError as err:
+                yield err
+
+    def queryMany(self, queries, version = None, window = None):
+        return list( self.pipeline(queries, version) )
+
+    def probe(self, name, params, version = None):
+        """Returns the status code the query would result in."""
+
+        if not cache.isReadOnly(name):
+            return constants.MR_PERM
+        try:
+            self.query(name, params, version)
+        except MoiraError as err:
+            return err.code
+        return constants.MR_SUCCESS
+
+    def close(self):
+        pass
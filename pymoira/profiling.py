@@ -0,0 +1,252 @@
+#
+## PyMoira client library
+##
+## This file contains the profiling mode, which attributes the time spent by the
+## library to the phases of work (waiting for the socket, encoding and decoding
+## the packets, converting the values, working on the list graphs).
+#
+
+import atexit
+import functools
+import os
+import sys
+import threading
+import time
+
+# Whether the profiling is on; checked by the instrumented functions on every call
+enabled = False
+
+# The Profile collecting the timings
+_current = None
+
+_state = threading.local()
+
+def _stack():
+    stack = getattr(_state, 'stack', None)
+    if stack is None:
+        stack = _state.stack = []
+    return stack
+
+class Profile(object):
+    """The collected timings. For every high-level operation (the outermost
+    instrumented call, such as List.getAllMembers or Client.query), the wall time
+    is split between the phases: socket (waiting for the network), encode, decode
+    (building and parsing the packets), conversion (of the field values), graph
+    (the Python-side work of the graph algorithms) and python (the rest of the
+    time spent inside the operation). Optionally, cProfile statistics and a
+    tracemalloc snapshot are captured as well."""
+
+    def __init__(self, cprofile = False, memory = False):
+        self.operations = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+        self.started = None
+        self.elapsed = 0.0
+
+        self.use_cprofile = cprofile
+        self.use_memory = memory
+        self.cprofile = None
+        self.snapshot = None
+
+    def record(self, operation, phase, exclusive, total, outermost):
+        with self.lock:
+            entry = self.phases.setdefault( (operation, phase), [0, 0.0] )
+            entry[0] += 1
+            entry[1] += exclusive
+            if outermost:
+                entry = self.operations.setdefault( operation, [0, 0.0] )
+                entry[0] += 1
+                entry[1] += total
+
+    def start(self):
+        self.started = time.time()
+        if self.use_cprofile:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        if self.use_memory:
+            try:
+                import tracemalloc
+                tracemalloc.start()
+            except ImportError:
+                self.use_memory = False
+
+    def stop(self):
+        self.elapsed += time.time() - self.started
+        if self.cprofile:
+            self.cprofile.disable()
+        if self.use_memory:
+            import tracemalloc
+            self.snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+    def report(self, output = None, limit = 15):
+        """Writes the concise report into the output file (stderr by default)."""
+
+        output = output or sys.stderr
+        output.write( "pymoira profile: %.3f s of wall time\n" % self.elapsed )
+        for operation, (calls, total) in sorted( self.operations.items(), key = lambda item: -item[1][1] ):
+            output.write( "  %-32s %8i calls %10.3f s\n" % (operation, calls, total) )
+            phases = [ (phase, seconds) for (name, phase), (count, seconds) in self.phases.items() if name == operation ]
+            for phase, seconds in sorted( phases, key = lambda item: -item[1] ):
+                share = 100.0 * seconds / total if total else 0.0
+                output.write( "      %-28s %10.3f s %6.1f%%\n" % (phase, seconds, share) )
+
+        if self.cprofile:
+            import pstats
+            output.write( "\ncProfile, top %i by cumulative time:\n" % limit )
+            pstats.Stats(self.cprofile, stream = output).sort_stats('cumulative').print_stats(limit)
+
+        if self.snapshot:
+            output.write( "\ntracemalloc, top %i allocation sites:\n" % limit )
+            for stat in self.snapshot.statistics('lineno')[:limit]:
+                output.write( "  %s\n" % stat )
+
+class _Timer(object):
+    """Measures the time of a phase (or an operation, which is also a phase) and
+    records its exclusive time, the time not spent in the nested phases."""
+
+    __slots__ = ('operation', 'phase', 'outermost', 'started', 'children')
+
+    def __init__(self, operation, phase):
+        self.operation = operation
+        self.phase = phase
+
+    def __enter__(self):
+        stack = _stack()
+        inherited = stack[-1].operation if stack else None
+        if inherited and (inherited != 'other' or self.operation is None):
+            # The time is attributed to the outermost operation
+            self.operation = inherited
+            self.outermost = False
+        else:
+            self.operation = self.operation or 'other'
+            self.outermost = True
+        self.children = 0.0
+        stack.append(self)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed = time.time() - self.started
+        stack = _stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        profile = _current
+        if profile:
+            profile.record(self.operation, self.phase, elapsed - self.children, elapsed, self.outermost)
+        return False
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_timer = _NullTimer()
+
+def phase(name):
+    """Returns the context manager timing a phase of the current operation."""
+
+    return _Timer(None, name) if enabled else _null_timer
+
+def timed(phase_name):
+    """The decorator timing every call of the function as a phase."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Timer(None, phase_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def operation(name, phase_name = 'python'):
+    """The decorator marking the function as a high-level operation; its own time
+    is attributed to the phase. If it is called inside another operation, it is
+    only a phase of that one."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with _Timer(name, phase_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start(cprofile = False, memory = False):
+    """Turns the profiling on and returns the Profile collecting the timings."""
+
+    global enabled, _current
+    _current = Profile(cprofile, memory)
+    _current.start()
+    enabled = True
+    return _current
+
+def stop():
+    """Turns the profiling off and returns the Profile with the timings."""
+
+    global enabled, _current
+    profile = _current
+    enabled = False
+    _current = None
+    if profile:
+        profile.stop()
+    return profile
+
+class profile(object):
+    """The context manager profiling the code inside it. The Profile is returned
+    by __enter__; if the output file is specified, the report is written into it
+    when the block is left. If the profiling is already on (for instance, through
+    the environment variable), the block is profiled as a part of the current
+    Profile, which keeps collecting after the block."""
+
+    def __init__(self, cprofile = False, memory = False, output = None):
+        self.cprofile = cprofile
+        self.memory = memory
+        self.output = output
+
+    def __enter__(self):
+        self.nested = enabled
+        self.profile = _current if self.nested else start(self.cprofile, self.memory)
+        return self.profile
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.nested:
+            stop()
+        if self.output:
+            self.profile.report(self.output)
+        return False
+
+def _reportAtExit():
+    profile = stop()
+    if not profile:
+        return
+    path = os.environ.get('PYMOIRA_PROFILE_OUTPUT')
+    if path:
+        with open(path, 'w') as output:
+            profile.report(output)
+    else:
+        profile.report(sys.stderr)
+
+def configureFromEnvironment():
+    """Turns the profiling on if the PYMOIRA_PROFILE environment variable is set.
+    Its value is a comma-separated list of options: 'cprofile' and 'memory' enable
+    the cProfile and tracemalloc capture (any other value, such as 1, only enables
+    the phase timings). The report is written at exit into the file named by
+    PYMOIRA_PROFILE_OUTPUT, or to stderr."""
+
+    value = os.environ.get('PYMOIRA_PROFILE')
+    if not value or value == '0':
+        return
+    options = set( option.strip() for option in value.split(',') )
+    start( 'cprofile' in options, 'memory' in options )
+    atexit.register(_reportAtExit)
+
+configureFromEnvironment()
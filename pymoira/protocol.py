@@ -6,6 +6,7 @@
 
 import struct
 
+from . import profiling
 from .errors import *
 
 #
@@ -20,6 +21,7 @@ MOIRA_KERBEROS_SERVICE_NAME = "moira"
 
 MOIRA_QUERY_VERSION = 14
 MOIRA_MAX_LIST_DEPTH = 3072    # server/qsupport.pc, line 206
+MOIRA_PIPELINE_WINDOW = 32     # Queries sent ahead of the responses when pipelining
 
 #
 # Utility functions
@@ -59,6 +61,7 @@ class Packet(object):
     # Either built or received
     raw = None
     
+    @profiling.timed('encode')
     def build(self):
         """Constructs a binary packet which may be sent to Moira server."""
         
@@ -82,6 +85,7 @@ class Packet(object):
         self.raw = header + body
         return self.raw
     
+    @profiling.timed('decode')
     def parse(self, orig):
         """Parses the packet from the network."""
         
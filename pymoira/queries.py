@@ -0,0 +1,26 @@
+# Moira query catalog
+#
+# NOTE: this file is maintained by hand and only contains the queries used by
+#       pymoira itself, in the format produced by tools/queries_gen.py; run the
+#       generator on the Moira sources (server/queries2.c) to obtain the complete
+#       catalog. The queries missing from the catalog are not checked locally.
+
+# (name, version) : (short name, query type, argument names, returned field names)
+queries = {
+    ('add_list', 14) : ('alis', 'append', ('name', 'active', 'publicflg', 'hidden', 'maillist', 'grouplist', 'gid', 'nfsgroup', 'mailman', 'mailman_server', 'ace_type', 'ace_name', 'memace_type', 'memace_name', 'description'), ()),
+    ('add_member_to_list', 2) : ('amtl', 'append', ('list_name', 'member_type', 'member_name'), ()),
+    ('add_tagged_member_to_list', 12) : ('atml', 'append', ('list_name', 'member_type', 'member_name', 'tag'), ()),
+    ('count_members_of_list', 2) : ('cmol', 'retrieve', ('list_name',), ('count',)),
+    ('delete_member_from_list', 2) : ('dmfl', 'delete', ('list_name', 'member_type', 'member_name'), ()),
+    ('get_ace_use', 2) : ('gaus', 'retrieve', ('ace_type', 'ace_name'), ('use_type', 'use_name')),
+    ('get_end_members_of_list', 2) : ('geml', 'retrieve', ('list_name',), ('member_type', 'member_name')),
+    ('get_filesys_by_label', 2) : ('gfsl', 'retrieve', ('label',), ('label', 'type', 'machine', 'name', 'mount', 'access', 'comments', 'owner', 'owners', 'create', 'lockertype', 'modtime', 'modby', 'modwith')),
+    ('get_list_info', 14) : ('glin', 'retrieve', ('name',), ('name', 'active', 'publicflg', 'hidden', 'maillist', 'grouplist', 'gid', 'nfsgroup', 'mailman', 'mailman_server', 'ace_type', 'ace_name', 'memace_type', 'memace_name', 'description', 'modtime', 'modby', 'modwith')),
+    ('get_lists_of_member', 2) : ('glom', 'retrieve', ('member_type', 'member_name'), ('list_name', 'active', 'publicflg', 'hidden', 'maillist', 'grouplist')),
+    ('get_members_of_list', 2) : ('gmol', 'retrieve', ('list_name',), ('member_type', 'member_name')),
+    ('get_quota_by_filesys', 2) : ('gqbf', 'retrieve', ('filesys',), ('filesys', 'type', 'name', 'quota', 'directory', 'machine', 'modtime', 'modby', 'modwith')),
+    ('get_tagged_members_of_list', 12) : ('gtml', 'retrieve', ('list_name',), ('member_type', 'member_name', 'tag')),
+    ('get_user_account_by_login', 14) : ('gual', 'retrieve', ('login',), ('login', 'unix_uid', 'shell', 'winconsoleshell', 'last', 'first', 'middle', 'status', 'clearid', 'class', 'comments', 'signature', 'secure', 'winhomedir', 'winprofiledir', 'sponsor_name', 'sponsor_type', 'expiration', 'alternate_email', 'alternate_phone', 'modtime', 'modby', 'modwith', 'created', 'creator')),
+    ('tag_member_of_list', 12) : ('tmol', 'update', ('list_name', 'member_type', 'member_name', 'tag'), ()),
+    ('update_list', 14) : ('ulis', 'update', ('name', 'newname', 'active', 'publicflg', 'hidden', 'maillist', 'grouplist', 'gid', 'nfsgroup', 'mailman', 'mailman_server', 'ace_type', 'ace_name', 'memace_type', 'memace_name', 'description'), ()),
+}
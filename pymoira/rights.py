@@ -0,0 +1,122 @@
+#
+## PyMoira client library
+##
+## This file contains the calculator of the effective administrative rights on
+## lists for many principals at once.
+#
+
+from . import graph
+from . import protocol
+from .errors import *
+from .lists import List, ListMember
+
+def _principalKey(principal):
+    if isinstance(principal, tuple):
+        return principal[0:2]
+    return (principal.mtype, principal.name)
+
+class RightsCalculator(object):
+    """Computes which lists a principal (user, list, etc) may administer: the lists
+    it owns, and the lists whose membership it may change (the ones it owns or is
+    the membership ACL of). The rights are granted either to the principal itself
+    or to any list it is on, directly or through other lists.
+
+    The owners and membership ACLs of all lists are taken from a single streamed
+    get_list_info dump (or the rows supplied), and the memberships of the
+    principals are fetched through the MembershipGraph, so the queries for all
+    principals are pipelined. The rights granted through each list are computed
+    once and shared by all the principals on it."""
+
+    def __init__(self, client, list_rows = None, window = protocol.MOIRA_PIPELINE_WINDOW):
+        self.client = client
+        self.graph = graph.MembershipGraph(client, window)
+
+        # (type, name) of the ACE -> set of names of the lists
+        self.owned_by = {}
+        self.memacl_of = {}
+
+        # List name -> (owned, membership) rights granted through the list
+        self.memo = {}
+
+        self.loadLists(list_rows)
+
+    def loadLists(self, rows = None):
+        """Indexes the owners and membership ACLs of the lists from get_list_info
+        rows, streaming all of them from the server if the rows are not specified."""
+
+        if rows is None:
+            rows = self.client.iterQuery( 'get_list_info', ('*', ), version = 14 )
+
+        fields = [ name for name, datatype in List.info_query_description ]
+        name_index = fields.index('name')
+        owner_index = fields.index('owner_type'), fields.index('owner_name')
+        memacl_index = fields.index('memacl_type'), fields.index('memacl_name')
+
+        self.owned_by = {}
+        self.memacl_of = {}
+        self.memo = {}
+        for row in rows:
+            name = row[name_index]
+            owner = (row[owner_index[0]], row[owner_index[1]])
+            memacl = (row[memacl_index[0]], row[memacl_index[1]])
+            if owner[0] != ListMember.No:
+                self.owned_by.setdefault(owner, set()).add(name)
+            if memacl[0] != ListMember.No:
+                self.memacl_of.setdefault(memacl, set()).add(name)
+
+    def directRights(self, key):
+        """Returns the (owned, membership) sets of list names for which the ACE is
+        the owner or the membership ACL."""
+
+        owned = self.owned_by.get(key, frozenset())
+        return owned, owned | self.memacl_of.get(key, frozenset())
+
+    def listRights(self, name):
+        """Returns the rights granted to the members of the list: the rights of the
+        list and of all lists containing it."""
+
+        if name not in self.memo:
+            owned, membership = set(), set()
+            for listname in (name, ) + tuple( self.graph.listAncestors(name) ):
+                direct_owned, direct_membership = self.directRights( (ListMember.List, listname) )
+                owned |= direct_owned
+                membership |= direct_membership
+            self.memo[name] = ( frozenset(owned), frozenset(membership) )
+        return self.memo[name]
+
+    def rightsOfMany(self, principals):
+        """Returns the dictionary which maps every principal (ListMember or a (type,
+        name) tuple) to the (owned, membership) tuple of frozensets of list names."""
+
+        principals = list(principals)
+        self.graph.fetch( _principalKey(principal) for principal in principals )
+
+        result = {}
+        for principal in principals:
+            key = _principalKey(principal)
+            if key[0] == ListMember.List:
+                result[principal] = self.listRights(key[1])
+                continue
+
+            owned, membership = self.directRights(key)
+            owned, membership = set(owned), set(membership)
+            for listname in self.graph.memberships(key, recursive = False):
+                list_owned, list_membership = self.listRights(listname)
+                owned |= list_owned
+                membership |= list_membership
+            result[principal] = ( frozenset(owned), frozenset(membership) )
+        return result
+
+    def rightsOf(self, principal):
+        return self.rightsOfMany( (principal, ) )[principal]
+
+    def canModify(self, principal, listname):
+        """Returns whether the principal may change the membership of the list."""
+
+        return listname in self.rightsOf(principal)[1]
+
+    @property
+    def denied(self):
+        """The principals and lists whose memberships could not be fetched."""
+
+        return self.graph.denied
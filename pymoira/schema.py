@@ -0,0 +1,96 @@
+#
+## PyMoira client library
+##
+## This file contains the access to the query catalog generated from Moira
+## sources (queries.py): local validation of the query arguments and decoding
+## of the query results.
+#
+
+import datetime
+
+from . import constants
+from . import queries
+from .protocol import MOIRA_QUERY_VERSION
+from . import utils
+from .errors import *
+
+# The types of the returned fields, inferred from their names in the catalog;
+# all the other fields are strings
+field_types = {
+    'active' : bool,
+    'publicflg' : bool,
+    'hidden' : bool,
+    'maillist' : bool,
+    'grouplist' : bool,
+    'nfsgroup' : bool,
+    'mailman' : bool,
+    'create' : bool,
+    'secure' : bool,
+    'gid' : int,
+    'unix_uid' : int,
+    'uid' : int,
+    'status' : int,
+    'quota' : int,
+    'count' : int,
+    'modtime' : datetime.datetime,
+    'created' : datetime.datetime,
+}
+
+# The versions of each query available in the catalog, and the full names of the
+# queries by their short names
+_versions = {}
+_names = {}
+for (_name, _version), _entry in queries.queries.items():
+    _versions.setdefault(_name, []).append(_version)
+    _names[_entry[0]] = _name
+for _list in _versions.values():
+    _list.sort(reverse = True)
+
+_decoders = {}
+
+def lookup(name, version = MOIRA_QUERY_VERSION):
+    """Returns the (short name, query type, argument names, returned field names)
+    catalog entry for the query as it is handled by the server at the given query
+    version, which is the highest version of the query not exceeding it. Returns
+    None if the query is not in the catalog."""
+
+    name = _names.get(name, name)
+    for query_version in _versions.get(name, ()):
+        if query_version <= version:
+            return queries.queries[ (name, query_version) ]
+    return None
+
+def checkArguments(name, params, version = MOIRA_QUERY_VERSION):
+    """Returns MoiraError with MR_ARGS code if the number of arguments does not
+    match the one the query expects, or None if it does or the query is unknown."""
+
+    entry = lookup(name, version)
+    if entry is not None and len(params) != len(entry[2]):
+        return MoiraError(constants.MR_ARGS)
+    return None
+
+def description(name, version = MOIRA_QUERY_VERSION):
+    """Returns the ( (field name, type) ) description of the query result, in the
+    format used by utils.responseToDict()."""
+
+    entry = lookup(name, version)
+    if entry is None:
+        raise UserError("Query %s is not in the query catalog" % name)
+    return tuple( (field, field_types.get(field, str)) for field in entry[3] )
+
+def decoder(name, version = MOIRA_QUERY_VERSION):
+    """Returns the function which converts a row of the query result into the
+    dictionary of its fields. The decoders are built once per query version."""
+
+    key = (name, version)
+    if key not in _decoders:
+        converters = tuple( (field, utils._converters[datatype]) for field, datatype in description(name, version) )
+        count = len(converters)
+
+        def decode(row):
+            if len(row) != count:
+                raise UserError("Error returned the response with invalid number of entries")
+            return { field : convert(value) for (field, convert), value in zip(converters, row) }
+
+        _decoders[key] = decode
+    return _decoders[key]
@@ -0,0 +1,221 @@
+#
+## PyMoira client library
+##
+## This file contains the on-disk structures which allow to expand very large
+## lists within a bounded amount of memory.
+#
+
+import heapq
+import os
+import shutil
+import tempfile
+
+try:
+    import anydbm as dbm
+except ImportError:
+    import dbm
+
+from .errors import *
+
+# The estimated memory taken, in addition to the length of the name, by a
+# ListMember kept in a frozenset and by a (type, name, tag) row kept in a list.
+# These were measured on 64-bit CPython 2.7 and are only estimates, so the
+# memory budgets are approximate.
+MEMBER_OVERHEAD = 550
+ROW_OVERHEAD = 170
+
+def _memberCost(member):
+    return MEMBER_OVERHEAD + len(member.name)
+
+def _rowCost(row):
+    return ROW_OVERHEAD + sum( len(field) for field in row )
+
+def _encodeRow(row):
+    return '\0'.join(row)
+
+def _decodeRow(line):
+    return tuple( line.split('\0') )
+
+class SpillDirectory(object):
+    """The temporary directory holding the spilled data; it is removed on close().
+    Every spilling structure has its own directory, as closing the structure
+    closes the directory."""
+
+    def __init__(self, parent = None):
+        self.path = tempfile.mkdtemp(prefix = 'pymoira-', dir = parent)
+        self.counter = 0
+        self.databases = []
+
+    def newPath(self, name):
+        self.counter += 1
+        return os.path.join( self.path, '%s-%i' % (name, self.counter) )
+
+    def openDatabase(self, name):
+        """Creates a new dbm file, which is closed together with the directory."""
+
+        if not self.path:
+            raise UserError("The spill directory is already closed")
+        database = dbm.open( self.newPath(name), 'n' )
+        self.databases.append(database)
+        return database
+
+    def close(self):
+        for database in self.databases:
+            database.close()
+        self.databases = []
+        if self.path:
+            shutil.rmtree(self.path, True)
+            self.path = None
+
+    def __del__(self):
+        self.close()
+
+class SpillingListStore(object):
+    """The dictionary-like mapping of list names to the frozensets of their explicit
+    members (or None for the lists to which the access is denied). Once the sets
+    kept in memory exceed the budget (in bytes, approximately), all of them are
+    written into a dbm file as member rows; the sets are decoded again from the
+    rows (with the decode function) when they are accessed."""
+
+    def __init__(self, budget, directory, decode):
+        self.budget = budget
+        self.directory = directory
+        self.decode = decode
+
+        self.names = []
+        self.memory = {}
+        self.used = 0
+        self.db = None
+
+    def __setitem__(self, name, members):
+        if name in self:
+            raise UserError("List %s is already stored" % name)
+        self.names.append(name)
+        self.memory[name] = members
+
+        if members is not None:
+            self.used += sum( _memberCost(member) for member in members )
+            if self.used > self.budget:
+                self.spill()
+
+    def spill(self):
+        if self.db is None:
+            self.db = self.directory.openDatabase('lists')
+        for name, members in list(self.memory.items()):
+            if members is not None:
+                self.db[name] = '\n'.join( _encodeRow( member.toTuple() ) for member in members )
+                del self.memory[name]
+        self.used = 0
+
+    def __getitem__(self, name):
+        if name in self.memory:
+            return self.memory[name]
+        if self.db is not None and name in self.db:
+            data = self.db[name]
+            return self.decode( [ _decodeRow(line) for line in data.split('\n') ] if data else [] )
+        raise KeyError(name)
+
+    def get(self, name, default = None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self.memory or (self.db is not None and name in self.db)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    def values(self):
+        return [ self[name] for name in self.names ]
+
+    def items(self):
+        return [ (name, self[name]) for name in self.names ]
+
+    def close(self):
+        self.db = None
+        self.memory = {}
+        self.directory.close()
+
+class ExternalSorter(object):
+    """Collects the member rows, possibly with duplicates, and yields the distinct
+    members. The rows are buffered in memory until the buffer exceeds the budget
+    (in bytes, approximately); the buffer is then sorted and written into a run
+    file. Iterating merges the runs and the buffer, so only one row per run is
+    kept in memory, and yields the members created from the rows by the decode
+    function, each (type, name) once. If the same member is added with different
+    tags, the row added first is kept, as in the in-memory expansion."""
+
+    def __init__(self, budget, directory, decode):
+        self.budget = budget
+        self.directory = directory
+        self.decode = decode
+
+        self.buffer = []
+        self.used = 0
+        self.runs = []
+        self.count = None
+        self.sequence = 0
+
+    def add(self, row):
+        # The rows are stored as (type, name, sequence number, tag...), so the
+        # duplicates of a member are sorted in the order they were added
+        row = tuple(row[0:2]) + ( '%012i' % self.sequence, ) + tuple(row[2:])
+        self.sequence += 1
+        self.buffer.append(row)
+        self.used += _rowCost(row)
+        self.count = None
+        if self.used > self.budget:
+            self.flush()
+
+    def flush(self):
+        """Writes the buffer into a new sorted run file."""
+
+        path = self.directory.newPath('run')
+        with open(path, 'w') as run:
+            for row in sorted(self.buffer):
+                run.write( _encodeRow(row) + '\n' )
+        self.runs.append(path)
+        self.buffer = []
+        self.used = 0
+
+    def readRun(self, path):
+        with open(path, 'r') as run:
+            for line in run:
+                yield _decodeRow( line[:-1] )
+
+    def rows(self):
+        """Yields the distinct member rows in sorted order."""
+
+        self.buffer.sort()
+        sources = [ self.readRun(path) for path in self.runs ] + [ iter(self.buffer) ]
+        previous = None
+        for row in heapq.merge(*sources):
+            if row[0:2] != previous:
+                previous = row[0:2]
+                yield row[0:2] + row[3:]
+
+    def __iter__(self):
+        for row in self.rows():
+            yield self.decode(row)
+
+    def __len__(self):
+        if self.count is None:
+            self.count = sum( 1 for row in self.rows() )
+        return self.count
+
+    def __contains__(self, member):
+        key = (member.mtype, member.name)
+        return any( row[0:2] == key for row in self.rows() )
+
+    def close(self):
+        self.buffer = []
+        self.runs = []
+        self.directory.close()
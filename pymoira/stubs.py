@@ -9,7 +9,7 @@ class StubCommon(object):
     stub_type_title = '???'
 
     def __repr__(self):
-        '%s %s' % (self.stub_type_title, self.name)
+        return '%s %s' % (self.stub_type_title, self.name)
 
     def __cmp__(self, other):
         return cmp(self.name, other.name)
@@ -0,0 +1,373 @@
+#
+## PyMoira client library
+##
+## This file contains the synthetic list hierarchies and the fake client serving
+## them, which allow to test and benchmark the algorithms without a Moira server.
+#
+
+import collections
+import random
+import socket
+import threading
+import time
+
+from . import cache
+from . import constants
+from . import protocol
+from . import schema
+from .client import Client
+from .errors import *
+from .lists import ListMember
+
+class SyntheticGraph(object):
+    """A synthetic hierarchy of lists: the explicit members of every list as the
+    (type, name, tag) rows. The builder methods add the typical shapes (wide
+    fan-out, deep chains, diamonds and cycles) and fill the lists with users whose
+    popularity and list sizes follow power laws, as they do in real deployments.
+    The lists in the denied set respond with MR_PERM."""
+
+    def __init__(self, seed = 0, users = 10000):
+        self.random = random.Random(seed)
+        self.users = users
+        self.members = collections.OrderedDict()
+        self.denied = set()
+        self.counter = 0
+
+    def newList(self, prefix = 'list'):
+        self.counter += 1
+        name = '%s-%i' % (prefix, self.counter)
+        self.members[name] = []
+        return name
+
+    def addMember(self, listname, mtype, name, tag = ''):
+        self.members[listname].append( (mtype, name, tag) )
+
+    def include(self, parent, child):
+        self.addMember(parent, ListMember.List, child)
+
+    def fanOut(self, width, depth = 1, root = None):
+        """Adds a tree in which every list has width sublists, depth levels deep.
+        Returns the name of the root list."""
+
+        root = root or self.newList('fanout')
+        level = [root]
+        for i in range(depth):
+            next_level = []
+            for parent in level:
+                for j in range(width):
+                    child = self.newList('fanout')
+                    self.include(parent, child)
+                    next_level.append(child)
+            level = next_level
+        return root
+
+    def chain(self, length, root = None):
+        """Adds a chain of lists, each containing the next one."""
+
+        root = root or self.newList('chain')
+        current = root
+        for i in range(length):
+            child = self.newList('chain')
+            self.include(current, child)
+            current = child
+        return root
+
+    def diamonds(self, count, root = None):
+        """Adds count diamonds stacked on each other: every diamond top contains two
+        lists, both of which contain the top of the next one."""
+
+        root = root or self.newList('diamond')
+        top = root
+        for i in range(count):
+            left, right, bottom = self.newList('diamond'), self.newList('diamond'), self.newList('diamond')
+            self.include(top, left)
+            self.include(top, right)
+            self.include(left, bottom)
+            self.include(right, bottom)
+            top = bottom
+        return root
+
+    def cycle(self, length, root = None):
+        """Adds a cycle of lists, the last of which contains the first one."""
+
+        root = root or self.newList('cycle')
+        current = root
+        for i in range(length - 1):
+            child = self.newList('cycle')
+            self.include(current, child)
+            current = child
+        self.include(current, root)
+        return root
+
+    def userName(self, exponent):
+        # Popular users are drawn much more often than the others
+        return 'user%i' % int( self.users * self.random.random() ** exponent )
+
+    def populate(self, mean_size = 20, alpha = 1.5, exponent = 3.0, max_size = 100000, tagged = 0.0):
+        """Adds the users to every list. The list sizes follow the Pareto distribution
+        with the given shape (alpha) scaled to the mean size, and the users are
+        picked with the power-law popularity. The fraction of tagged members may be
+        set as well."""
+
+        scale = mean_size * (alpha - 1) / alpha
+        for listname in self.members:
+            size = min( max_size, int( scale * self.random.paretovariate(alpha) ) )
+            for i in range(size):
+                tag = 'tag%i' % self.random.randint(0, 9) if self.random.random() < tagged else ''
+                self.addMember( listname, ListMember.User, self.userName(exponent), tag )
+
+    def deny(self, fraction):
+        """Makes the random fraction of the lists (except the first one) inaccessible."""
+
+        names = list(self.members)[1:]
+        self.denied = set( self.random.sample( names, int( len(names) * fraction ) ) )
+
+    def endMembers(self, listname):
+        """Returns the rows of all members of the list, including the nested lists."""
+
+        result = set()
+        visited = set( (listname, ) )
+        stack = [listname]
+        while stack:
+            for mtype, name, tag in self.members.get(stack.pop(), ()):
+                result.add( (mtype, name) )
+                if mtype == ListMember.List and name not in visited:
+                    visited.add(name)
+                    stack.append(name)
+        return sorted(result)
+
+    def memberCount(self):
+        return sum( len(members) for members in self.members.values() )
+
+def generateHierarchy(shape, size, seed = 0, users = 10000, mean_size = 20):
+    """Returns the populated SyntheticGraph of a given shape ('fanout', 'chain',
+    'diamond', 'cycle' or 'mixed') scaled by the size, and the name of its root."""
+
+    graph = SyntheticGraph(seed, users)
+    if shape == 'fanout':
+        root = graph.fanOut( max(2, int(size ** 0.5)), 2 )
+    elif shape == 'chain':
+        root = graph.chain(size)
+    elif shape == 'diamond':
+        root = graph.diamonds(size)
+    elif shape == 'cycle':
+        root = graph.cycle(size)
+    elif shape == 'mixed':
+        root = graph.newList('mixed')
+        graph.include( root, graph.fanOut( max(2, int(size ** 0.5)), 2 ) )
+        graph.include( root, graph.chain(size) )
+        graph.include( root, graph.diamonds(size) )
+        graph.include( root, graph.cycle(size) )
+    else:
+        raise UserError("Unknown hierarchy shape: %s" % shape)
+
+    graph.populate(mean_size)
+    return graph, root
+
+class FakeClient(object):
+    """The client which answers the list queries from a SyntheticGraph instead of
+    the server, providing the same querying interface as Client, so List and
+    ListTracer may be used with it. Every query may be delayed by latency seconds
+    to simulate the round trips (pipelined queries are delayed once per window).
+    Of the wildcards, only '*' is supported by get_list_info. The number of
+    queries of each name is counted in the queries counter."""
+
+    cache = None
+    limiter = None
+
+    def __init__(self, graph, latency = 0.0):
+        self.graph = graph
+        self.latency = latency
+        self.version = protocol.MOIRA_QUERY_VERSION
+        self.queries = collections.Counter()
+        self.parents = None
+
+    def setVersion(self, version):
+        self.version = version
+
+    def checkQuery(self, name, params):
+        return schema.checkArguments(name, params, self.version)
+
+    def listRow(self, name):
+        return ( name, '1', '0', '0', '1', '0', '-1', '0', '0', '', 'USER', 'root', 'NONE', 'NONE', 'Synthetic list', '01-Jan-2020 00:00:00', 'root', 'pymoira' )
+
+    def listsOfMember(self, mtype, name):
+        if self.parents is None:
+            self.parents = {}
+            for listname, members in self.graph.members.items():
+                for member in members:
+                    self.parents.setdefault( member[0:2], set() ).add(listname)
+        return sorted( self.parents.get( (mtype, name), () ) )
+
+    def answer(self, name, params):
+        if not cache.isReadOnly(name):
+            raise UserError("The fake client is read-only, %s may not be run on it" % name)
+        error = self.checkQuery(name, tuple(params))
+        if error:
+            raise error
+        self.queries[name] += 1
+
+        if name == 'get_list_info' and params[0] == '*':
+            return tuple( self.listRow(listname) for listname in self.graph.members )
+
+        if name in ('get_members_of_list', 'get_tagged_members_of_list', 'get_end_members_of_list', 'count_members_of_list', 'get_list_info'):
+            listname = params[0]
+            if listname not in self.graph.members:
+                raise MoiraError(constants.MR_LIST if name != 'get_list_info' else constants.MR_NO_MATCH)
+            if listname in self.graph.denied and name != 'get_list_info':
+                raise MoiraError(constants.MR_PERM)
+
+            if name == 'get_members_of_list':
+                return tuple( member[0:2] for member in self.graph.members[listname] )
+            if name == 'get_tagged_members_of_list':
+                return tuple(self.graph.members[listname])
+            if name == 'get_end_members_of_list':
+                return tuple( self.graph.endMembers(listname) )
+            if name == 'count_members_of_list':
+                return ( (str( len(self.graph.members[listname]) ), ), )
+            return ( self.listRow(listname), )
+
+        if name == 'get_lists_of_member':
+            mtype, member = params
+            if mtype.startswith('R'):
+                raise MoiraError(constants.MR_NO_HANDLE)
+            rows = tuple( (listname, '1', '0', '0', '1', '0') for listname in self.listsOfMember(mtype, member) )
+            if not rows:
+                raise MoiraError(constants.MR_NO_MATCH)
+            return rows
+
+        raise MoiraError(constants.MR_NO_HANDLE)
+
+    def query(self, name, params, version = None):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.answer(name, params)
+
+    def iterQuery(self, name, params, version = None):
+        return iter( self.query(name, params, version) )
+
+    def pipeline(self, queries, version = None, window = protocol.MOIRA_PIPELINE_WINDOW):
+        for i, (name, params) in enumerate(queries):
+            if self.latency and i % window == 0:
+                time.sleep(self.latency)
+            try:
+                yield self.answer(name, params)
+            except MoiraError as err:
+                yield err
+
+    def queryMany(self, queries, version = None, window = protocol.MOIRA_PIPELINE_WINDOW):
+        return list( self.pipeline(queries, version, window) )
+
+    def probe(self, name, params, version = None):
+        if not cache.isReadOnly(name):
+            return constants.MR_PERM
+        try:
+            self.answer(name, params)
+        except MoiraError as err:
+            return err.code
+        return constants.MR_SUCCESS
+
+    def close(self):
+        pass
+
+class FakeServer(object):
+    """The in-process Moira server answering the queries from a FakeClient, which
+    allows to test the protocol handling of the real Client (pipelining, the
+    limiter slots, streaming) without the network. It provides the interface of
+    ServerLocator, so the clients are connected with Client(locator = server);
+    every connection is a socket pair served by its own thread. If hangup_after
+    is set, the connections are closed after that many queries; the query versions
+    above max_version are rejected."""
+
+    def __init__(self, fake):
+        self.fake = fake
+        self.hangup_after = None
+        self.max_version = None
+        self.received = 0
+
+    def connect(self, servers = None, timeout = None):
+        ours, theirs = socket.socketpair()
+        thread = threading.Thread( target = self.serve, args = (theirs, ) )
+        thread.daemon = True
+        thread.start()
+        return 'fake.moira', ours
+
+    def canonicalize(self, server):
+        return server
+
+    def client(self, **kwargs):
+        """Returns a new Client connected to the server."""
+
+        return Client( locator = self, **kwargs )
+
+    def recvExactly(self, sock, size):
+        data = ""
+        while len(data) < size:
+            new_data = sock.recv(size - len(data))
+            if not new_data:
+                return None
+            data += new_data
+        return data
+
+    def recvPacket(self, sock):
+        length_data = self.recvExactly(sock, 4)
+        if length_data is None:
+            return None
+        remainder = self.recvExactly( sock, protocol._read_u32(length_data) - 4 )
+        if remainder is None:
+            return None
+        packet = protocol.Packet()
+        packet.parse(length_data + remainder)
+        return packet
+
+    def sendPacket(self, sock, opcode, data = ()):
+        packet = protocol.Packet()
+        packet.opcode = opcode
+        packet.data = data
+        sock.sendall( packet.build() )
+
+    def respond(self, sock, name, params):
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        try:
+            rows = self.fake.answer(name, params)
+        except MoiraError as err:
+            self.sendPacket(sock, err.code)
+            return
+        except UserError:
+            self.sendPacket(sock, constants.MR_PERM)
+            return
+        for row in rows:
+            self.sendPacket( sock, constants.MR_MORE_DATA, tuple(row) )
+        self.sendPacket(sock, constants.MR_SUCCESS)
+
+    def serve(self, sock):
+        try:
+            if self.recvExactly( sock, len(protocol.MOIRA_PROTOCOL_CHALLENGE) ) is None:
+                return
+            sock.sendall(protocol.MOIRA_PROTOCOL_RESPONSE)
+            while True:
+                packet = self.recvPacket(sock)
+                if packet is None:
+                    return
+
+                if packet.opcode == constants.MR_MOTD:
+                    self.sendPacket(sock, constants.MR_SUCCESS)
+                elif packet.opcode == constants.MR_SETVERSION:
+                    if self.max_version is not None and int(packet.data[0]) > self.max_version:
+                        self.sendPacket(sock, constants.MR_VERSION_HIGH)
+                    else:
+                        self.sendPacket(sock, constants.MR_SUCCESS)
+                elif packet.opcode == constants.MR_ACCESS:
+                    self.sendPacket( sock, self.fake.probe(packet.data[0], packet.data[1:]) )
+                elif packet.opcode == constants.MR_QUERY:
+                    self.received += 1
+                    if self.hangup_after is not None and self.received > self.hangup_after:
+                        return
+                    self.respond(sock, packet.data[0], packet.data[1:])
+                else:
+                    self.sendPacket(sock, constants.MR_UNKNOWN_PROC)
+        except socket.error:
+            pass
+        finally:
+            sock.close()
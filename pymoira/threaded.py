@@ -0,0 +1,335 @@
+#
+## PyMoira client library
+##
+## This file contains the thread-safe client which allows many threads to share
+## a single Moira connection.
+#
+
+import collections
+import logging
+import threading
+import time
+
+from . import concurrency
+from .constants import *
+from .errors import *
+from .protocol import MOIRA_PIPELINE_WINDOW
+
+logger = logging.getLogger(__name__)
+logger.addHandler( logging.NullHandler() )
+
+class Future(object):
+    """The result of a query which may not have been received yet."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def setResult(self, value):
+        self.value = value
+        self.finish()
+
+    def setError(self, error):
+        self.error = error
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            self.runCallback(callback)
+
+    def runCallback(self, callback):
+        # The callbacks usually run on the I/O thread, which must not be stopped
+        # by their errors
+        try:
+            callback(self)
+        except Exception:
+            logger.exception("Exception in a Moira query callback")
+
+    def done(self):
+        return self.event.is_set()
+
+    def addDoneCallback(self, callback):
+        """Calls the callback with the future as an argument once it is done."""
+
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(callback)
+                return
+        self.runCallback(callback)
+
+    def exception(self, timeout = None):
+        """Waits for the query to complete and returns the error, or None if it succeeded."""
+
+        if not self.event.wait(timeout) and not self.event.is_set():
+            raise UserError("Timed out while waiting for the Moira query result")
+        return self.error
+
+    def result(self, timeout = None):
+        """Waits for the query to complete and returns its result or raises its error."""
+
+        error = self.exception(timeout)
+        if error:
+            raise error
+        return self.value
+
+# Kinds of requests handled by the I/O thread
+_QUERY = 'query'
+_ACCESS = 'access'
+_VERSION = 'version'
+
+class _VersionChange(object):
+    """A query version change sent to the server. The requests sent for that
+    version after it fail if the server rejects the version."""
+
+    def __init__(self, version, previous):
+        self.version = version
+        self.previous = previous
+        self.error = None
+
+class SharedClient(object):
+    """A thread-safe wrapper around a connected (and, if needed, authenticated)
+    Client. A single background thread owns the connection: the queries submitted
+    by any thread are queued, sent to the server pipelined (at most window queries
+    in flight) in the order they were submitted, and their results are delivered
+    through futures. SharedClient provides the same querying interface as Client,
+    so it may be used with the higher-level objects.
+
+    Requests are submitted with a priority (concurrency.Interactive by default):
+    the queued interactive requests are sent before the batch ones, and the order
+    is preserved among the requests of the same priority. If the client has an
+    AdaptiveLimiter, the number of queries in flight is also limited by it."""
+
+    def __init__(self, client, window = MOIRA_PIPELINE_WINDOW):
+        self.client = client
+        self.window = window
+        self.lanes = { concurrency.Interactive : collections.deque(), concurrency.Batch : collections.deque() }
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.failure = None
+        self.closed = False
+        self.version_change = None
+
+        self.thread = threading.Thread(target = self.run, name = 'pymoira-io')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def version(self):
+        return self.client.version
+
+    @property
+    def cache(self):
+        return self.client.cache
+
+    def submitRequest(self, kind, name, params, version, priority):
+        future = Future()
+        with self.condition:
+            # Checked under the lock, so no request is queued after the I/O thread
+            # has seen the lanes empty and exited
+            if self.stopping:
+                raise UserError("The shared Moira client is closed")
+            if self.failure:
+                future.setError(self.failure)
+            else:
+                self.lanes[priority].append( (kind, name, tuple(params), version, future) )
+                self.condition.notify()
+        return future
+
+    def submit(self, name, params, version = None, priority = concurrency.Interactive):
+        """Queues a query and returns the Future for its result."""
+
+        return self.submitRequest(_QUERY, name, params, version, priority)
+
+    def query(self, name, params, version = None):
+        """Sends a query to the Moira server and returns the result."""
+
+        return self.submit(name, params, version).result()
+
+    def iterQuery(self, name, params, version = None):
+        """Yields the rows of the query result. Unlike Client.iterQuery(), the whole
+        result is received before the first row is returned."""
+
+        return iter( self.query(name, params, version) )
+
+    def pipeline(self, queries, version = None, window = None, priority = concurrency.Batch):
+        """Submits the queries and yields their results in order, the failed ones
+        as MoiraError objects. All queries are submitted at once with the batch
+        priority; the pipelining window is the one of the shared client."""
+
+        futures = [ self.submit(name, params, version, priority) for name, params in queries ]
+        for future in futures:
+            error = future.exception()
+            if isinstance(error, MoiraError):
+                yield error
+            elif error:
+                raise error
+            else:
+                yield future.value
+
+    def queryMany(self, queries, version = None, window = None, priority = concurrency.Batch):
+        return list( self.pipeline(queries, version, priority = priority) )
+
+    def probe(self, name, params, version = None):
+        """Returns the status code the query would result in, see Client.probe()."""
+
+        return self.submitRequest(_ACCESS, name, params, version, concurrency.Interactive).result()
+
+    def close(self):
+        """Waits for the submitted queries to complete and closes the connection."""
+
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        self.client.close()
+
+    def nextRequest(self, block, in_flight):
+        """Takes the next request to be sent, interactive ones first. Returns None if
+        there are no requests, or if the limiter does not admit the request while
+        other requests are in flight."""
+
+        with self.condition:
+            while True:
+                for priority in (concurrency.Interactive, concurrency.Batch):
+                    lane = self.lanes[priority]
+                    if lane:
+                        break
+                else:
+                    if not block or self.stopping:
+                        return None
+                    self.condition.wait()
+                    continue
+
+                limiter = self.client.limiter
+                if limiter and not limiter.tryAcquire(priority):
+                    if in_flight:
+                        return None
+                    # Nothing to receive, so wait for the slot outside of the lock
+                    self.condition.release()
+                    try:
+                        limiter.acquire(priority)
+                    finally:
+                        self.condition.acquire()
+                return lane.popleft() + (time.time(), )
+
+    def run(self):
+        """The main loop of the I/O thread."""
+
+        # (kind, cache key, future, time sent, version change) for every request
+        # sent, in order
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < self.window:
+                    request = self.nextRequest(not pending, len(pending))
+                    if request is None:
+                        break
+                    self.sendRequest(request, pending)
+
+                if pending:
+                    self.receiveResponse(pending)
+                elif self.stopping:
+                    with self.condition:
+                        if not any(self.lanes.values()):
+                            break
+        except Exception as err:
+            failure = err if isinstance(err, BaseError) else ConnectionError("Shared Moira client failed: %s" % err)
+        else:
+            # The requests are refused once the client is stopping, so none should
+            # be left, but their futures must not be left incomplete if they are
+            failure = UserError("The shared Moira client is closed")
+
+        with self.condition:
+            self.failure = failure
+            requests = [ request for lane in self.lanes.values() for request in lane ]
+            for lane in self.lanes.values():
+                lane.clear()
+        for request in pending:
+            if request[2]:
+                request[2].setError(failure)
+        for request in requests:
+            request[4].setError(failure)
+
+    def sendRequest(self, request, pending):
+        kind, name, params, version, future, sent = request
+        client = self.client
+
+        if version and version != client.version:
+            client.sendPacket( MR_SETVERSION, (str(version), ) )
+            self.version_change = _VersionChange(version, client.version)
+            client.version = version
+            pending.append( (_VERSION, None, None, None, self.version_change) )
+        # The requests which do not ask for a version do not depend on the change
+        change = self.version_change if version else None
+
+        error = client.checkQuery(name, params)
+        if error:
+            if client.limiter:
+                client.limiter.release(None)
+            if kind == _ACCESS:
+                future.setResult(error.code)
+            else:
+                future.setError(error)
+            return
+
+        if kind == _ACCESS:
+            client.sendPacket( MR_ACCESS, (name, ) + params )
+            pending.append( (_ACCESS, None, future, sent, change) )
+            return
+
+        cache_key = client.cacheKey(name, params)
+        if cache_key is not None:
+            result = client.cache.lookup(cache_key)
+            if result is not None:
+                if client.limiter:
+                    client.limiter.release(None)
+                future.setResult(result)
+                return
+
+        client.sendPacket( MR_QUERY, (name, ) + params )
+        pending.append( (_QUERY, cache_key, future, sent, change) )
+
+    def receiveResponse(self, pending):
+        kind, cache_key, future, sent, change = pending.popleft()
+        client = self.client
+
+        if kind == _VERSION:
+            response = client.recvPacket()
+            if response.opcode != MR_SUCCESS and response.opcode != MR_VERSION_LOW:
+                # Only the requests for the rejected version fail, the connection
+                # stays at the previous one
+                change.error = MoiraError(response.opcode)
+                if self.version_change is change:
+                    client.version = change.previous
+                    self.version_change = None
+            return
+
+        error = None
+        if kind == _ACCESS:
+            result = client.recvPacket().opcode
+        else:
+            try:
+                result = client.recvQueryResult()
+            except MoiraError as err:
+                error = err
+
+        if client.limiter:
+            client.limiter.release( time.time() - sent, error.code if error else None )
+        if change and change.error:
+            future.setError(change.error)
+            return
+        if error:
+            future.setError(error)
+            return
+        if cache_key is not None:
+            client.cache.store(cache_key, result)
+        future.setResult(result)
@@ -12,7 +12,7 @@ import datetime
 from .lists import ListMember, Owner
 from .errors import *
 
-class User(Owner):
+class User(Owner, utils.LazyRecord):
     Registerable = 0
     Active = 1
     HalfRegistered = 2
@@ -52,19 +52,36 @@ class User(Owner):
         ('created_date', datetime.datetime),
         ('created_by', str),
     )
+    lazy_fields = ('sponsor', )
 
     def __init__(self, client, username):
         super(User, self).__init__(client, ListMember.User, username)
     
+    def infoQueries(self):
+        return [ ('get_user_account_by_login', (self.name, )) ]
+
+    def loadInfoFromResults(self, results):
+        response, = results
+        if isinstance(response, MoiraError):
+            raise response
+        self.loadInfoFromResponse(response[0])
+
     def loadInfo(self):
         """Loads the information about the list from the server into the object."""
         
         response, = self.client.query( 'get_user_account_by_login', (self.name, ), version = 14 )
-        result = utils.responseToDict(self.info_query_description, response)
-        self.__dict__.update(result)
+        self.loadInfoFromResponse(response)
+
+    def loadInfoFromResponse(self, response):
+        """Loads the information about the user from a row returned by
+        get_user_account_by_login. The fields are decoded when they are first accessed."""
 
-        if self.sponsor_type != 'NONE':
-            self.sponsor = ListMember.create(self.client, self.sponsor_type, self.sponsor_name)
-        else:
-            self.sponsor = None
+        self.attachInfo(response)
 
+    def deriveField(self, name):
+        if name == 'sponsor':
+            if self.sponsor_type != 'NONE':
+                return ListMember.create(self.client, self.sponsor_type, self.sponsor_name)
+            else:
+                return None
+        raise AttributeError(name)
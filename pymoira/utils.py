@@ -5,7 +5,11 @@
 #
 
 import datetime
-from .errors import UserError
+import threading
+import time
+import weakref
+from . import profiling
+from .errors import UserError, MoiraError
 
 def convertMoiraBool(val):
     if val == '1':
@@ -31,6 +35,25 @@ def convertToMoiraValue(val):
     else:
         return str(val)
 
+_converters = {
+    bool : convertMoiraBool,
+    int : convertMoiraInt,
+    datetime.datetime : convertMoiraDateTime,
+    str : lambda val: val,
+}
+
+def fieldDecoders(description):
+    """Returns the dictionary which maps the name of each field of the description
+    to the (position in the response, conversion function) tuple."""
+
+    result = {}
+    for i, (name, datatype) in enumerate(description):
+        if datatype not in _converters:
+            raise UserError("Unsupported Moira data type specified: %s" % datatype)
+        result[name] = (i, _converters[datatype])
+    return result
+
+@profiling.timed('conversion')
 def responseToDict(description, response):
     """Transforms the query response to a dictionary using a description
     of format ( (field name, type) ), where types are bool, int, string and
@@ -40,17 +63,208 @@ def responseToDict(description, response):
         raise UserError("Error returned the response with invalid number of entries")
     
     result = {}
-    for value, field in ( (response[i], description[i]) for i in range( 0, len(response) ) ):
-        name, datatype = field
-        if datatype == bool:
-            result[name] = convertMoiraBool(value)
-        elif datatype == int:
-            result[name] = convertMoiraInt(value)
-        elif datatype == datetime.datetime:
-            result[name] = convertMoiraDateTime(value)
-        elif datatype == str:
-            result[name] = value
-        else:
+    for value, (name, datatype) in zip(response, description):
+        if datatype not in _converters:
             raise UserError("Unsupported Moira data type specified: %s" % datatype)
+        result[name] = _converters[datatype](value)
     
     return result
+
+class LoadGroup(object):
+    """A group of lazily loaded objects which were obtained together (for instance,
+    the members of the same list). When the information about one of them is
+    needed, it is fetched for all of them at once through the pipeline."""
+
+    def __init__(self, objects = ()):
+        self.members = []
+        for obj in objects:
+            self.add(obj)
+
+    def add(self, obj):
+        if isinstance(obj, LazyRecord):
+            self.members.append( weakref.ref(obj) )
+            obj.__dict__['_load_group'] = self
+
+    def pending(self):
+        """Returns the objects of the group which are still alive, not loaded and
+        did not fail to load before."""
+
+        result = []
+        for ref in self.members:
+            obj = ref()
+            if obj is not None and not obj.isLoaded() and '_load_error' not in obj.__dict__:
+                result.append(obj)
+        return result
+
+@profiling.operation('loadInfoMany')
+def loadInfoMany(objects, version = 14):
+    """Loads the information for all the specified lazily loaded objects, sending
+    the queries for all objects sharing a client through the pipeline. Returns the
+    dictionary which maps the objects which failed to load to the errors."""
+
+    by_client = {}
+    for obj in objects:
+        by_client.setdefault( id(obj.client), [] ).append(obj)
+
+    errors = {}
+    for objects in by_client.values():
+        client = objects[0].client
+        queries = [ obj.infoQueries() for obj in objects ]
+        results = iter( client.pipeline( (query for obj_queries in queries for query in obj_queries), version = version ) )
+        for obj, obj_queries in zip(objects, queries):
+            obj_results = [ next(results) for query in obj_queries ]
+            try:
+                obj.loadInfoFromResults(obj_results)
+            except MoiraError as err:
+                errors[obj] = err
+    return errors
+
+class LazyRecord(object):
+    """A mixin for the objects which represent a Moira record described by
+    info_query_description. The record keeps the raw response row and converts
+    each field into the Python value the first time it is accessed. Accessing any
+    field of an object which was not loaded yet loads it automatically, together
+    with the other unloaded objects of its LoadGroup, if there is one.
+
+    Subclasses implement infoQueries(), which returns the list of (query name,
+    arguments) tuples used to load the object, and loadInfoFromResults(), which
+    loads the object from the results of those queries (raising the MoiraError
+    if any of them failed). They may also list in lazy_fields the attributes which
+    are not in the description but become available after loading. Such attributes
+    are obtained through deriveField() unless loading sets them directly.
+
+    If an object of the group fails to load, the error is remembered and raised
+    on every access to its fields, so the object is not requested again. As
+    loading sends queries, the fields of an object which is not loaded must not
+    be accessed while the results of a streaming query (Client.iterQuery() or
+    Client.pipeline()) are received on the same connection; the client raises
+    UserError in that case."""
+
+    info_query_description = ()
+    lazy_fields = ()
+
+    # The maximum amount of objects loaded at once from the LoadGroup
+    load_batch_size = 256
+
+    def loadInfo(self):
+        """Loads the information about the object from the server."""
+
+        self.loadInfoFromResults( self.client.queryMany(self.infoQueries(), version = 14) )
+
+    def isLoaded(self):
+        return '_info_row' in self.__dict__
+
+    def attachInfo(self, response):
+        """Stores the raw response row in the object, replacing any information
+        loaded before."""
+
+        if len(response) != len(self.info_query_description):
+            raise UserError("Error returned the response with invalid number of entries")
+
+        for name, datatype in self.info_query_description:
+            self.__dict__.pop(name, None)
+        for name in self.lazy_fields:
+            self.__dict__.pop(name, None)
+        self.__dict__.pop('_load_error', None)
+        self.__dict__['_info_row'] = response
+
+    def deriveField(self, name):
+        """Computes the value of one of the lazy_fields from the loaded information."""
+
+        raise AttributeError(name)
+
+    def loadLazily(self):
+        """Loads the object, together with the other pending objects of its group."""
+
+        group = self.__dict__.get('_load_group')
+        if group:
+            batch = [ obj for obj in group.pending() if obj is not self ][:self.load_batch_size - 1]
+            errors = loadInfoMany( [self] + batch )
+            for obj, err in errors.items():
+                obj.__dict__['_load_error'] = err
+            if self in errors:
+                raise errors[self]
+        else:
+            self.loadInfo()
+
+    @profiling.timed('conversion')
+    def __getattr__(self, name):
+        # Only called when the attribute is not found in the usual way
+        cls = type(self)
+        if '_field_decoders' not in cls.__dict__:
+            cls._field_decoders = fieldDecoders(cls.info_query_description)
+
+        if name not in cls._field_decoders and name not in cls.lazy_fields:
+            raise AttributeError(name)
+
+        if '_info_row' not in self.__dict__:
+            if '_load_error' in self.__dict__:
+                raise self.__dict__['_load_error']
+            self.loadLazily()
+            if name in self.__dict__:
+                return self.__dict__[name]
+
+        if name in cls._field_decoders:
+            index, convert = cls._field_decoders[name]
+            value = convert( self.__dict__['_info_row'][index] )
+        else:
+            value = self.deriveField(name)
+
+        self.__dict__[name] = value
+        return value
+
+class TTLCache(object):
+    """A thread-safe dictionary-like cache whose entries expire after a given
+    amount of seconds. The cache may be stored in and restored from a JSON file,
+    which allows several processes to share the results of slow lookups."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+        """Returns the cached value, or default if it is absent or has expired."""
+
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, expires = self.entries[key]
+            if expires < time.time():
+                del self.entries[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl = None):
+        """Stores the value in the cache for ttl seconds (or for the default
+        cache TTL if it is not specified)."""
+
+        with self.lock:
+            self.entries[key] = (value, time.time() + (ttl if ttl is not None else self.ttl))
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def dump(self):
+        """Returns the list of non-expired entries in a JSON-serializable form."""
+
+        now = time.time()
+        with self.lock:
+            return [ [key, value, expires] for key, (value, expires) in self.entries.items() if expires >= now ]
+
+    def restore(self, entries):
+        """Loads the entries produced by dump(). Expired entries are ignored,
+        and the existing entries are not overriden by the ones which expire earlier."""
+
+        now = time.time()
+        with self.lock:
+            for key, value, expires in entries:
+                if expires < now:
+                    continue
+                if key in self.entries and self.entries[key][1] >= expires:
+                    continue
+                self.entries[key] = (value, expires)
@@ -0,0 +1,289 @@
+#
+## PyMoira client library
+##
+## This file contains the watcher which detects the changes in the membership
+## of many lists with cheap periodic checks.
+#
+
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from . import constants
+from . import protocol
+from .errors import *
+from .lists import List, ListMember
+
+def membershipFingerprint(rows):
+    """Returns the fingerprint of the membership given as (type, name) rows, which
+    does not depend on the order of the rows."""
+
+    digest = hashlib.sha1()
+    for row in sorted(rows):
+        digest.update( '\0'.join(row) + '\n' )
+    return digest.hexdigest()
+
+class ListDelta(object):
+    """The change of the membership of a watched list: the sets of members added
+    and removed since the previous check. The list is removed if it no longer
+    exists (all members are reported as removed then)."""
+
+    def __init__(self, name, added, removed, lastmod = None, removed_list = False):
+        self.name = name
+        self.added = added
+        self.removed = removed
+        self.lastmod = lastmod
+        self.removed_list = removed_list
+
+    def __repr__(self):
+        return "<ListDelta %s: +%i -%i>" % (self.name, len(self.added), len(self.removed))
+
+class _WatchedList(object):
+    def __init__(self, name):
+        self.name = name
+        self.hint = None
+        self.fingerprint = None
+        self.members = None
+        self.error = None
+
+        # Identifies the current schedule entry of the list; the other entries in
+        # the heap (left by unwatch() or a reschedule) are skipped
+        self.token = None
+
+class _Change(object):
+    """The new state of a watched list found by a check, which is stored only
+    once its delta (if any) has been handed to the caller."""
+
+    def __init__(self, watched, delta = None, hint = None, members = None, fingerprint = None, removed = False):
+        self.watched = watched
+        self.delta = delta
+        self.hint = hint
+        self.members = members
+        self.fingerprint = fingerprint
+        self.removed = removed
+
+class ListWatcher(object):
+    """Watches the membership of many lists. Every list is checked about every
+    interval seconds, with the check times randomly spread by the jitter fraction
+    so the checks of the lists added together do not stay synchronized. A check
+    compares a cheap hint to the one seen before: the lastmod_datetime returned by
+    get_list_info (LastModHint), or the number of members returned by
+    count_members_of_list (CountHint, which is cheaper but misses the changes
+    which do not alter the number of members). The members are refetched only for
+    the lists whose hint has changed, and the change is reported as a ListDelta
+    unless the fingerprint of the new membership equals the stored one. The new
+    membership of a list is stored only once its delta has been handed to the
+    caller, so no change is lost if the poll fails.
+
+    The lists due for a check are split between the connections of the pool,
+    each of which pipelines its queries in a separate thread."""
+
+    LastModHint = 'lastmod'
+    CountHint = 'count'
+
+    def __init__(self, clients, interval = 60, jitter = 0.2, hint = LastModHint, window = protocol.MOIRA_PIPELINE_WINDOW):
+        if not isinstance(clients, (list, tuple)):
+            clients = [clients]
+        if hint not in (ListWatcher.LastModHint, ListWatcher.CountHint):
+            raise UserError("Unknown change hint: %s" % hint)
+
+        self.clients = clients
+        self.interval = interval
+        self.jitter = jitter
+        self.hint = hint
+        self.window = window
+
+        self.lists = {}
+        self.schedule = []
+        self.tokens = itertools.count()
+        self.lock = threading.Lock()
+
+    def nextCheck(self, now):
+        return now + self.interval * (1.0 + random.uniform(-self.jitter, self.jitter))
+
+    def scheduleCheck(self, watched, when):
+        """Schedules the next check of the list, replacing the one scheduled before.
+        Has to be called with the lock held."""
+
+        watched.token = next(self.tokens)
+        heapq.heappush( self.schedule, (when, watched.token, watched.name) )
+
+    def watch(self, name, now = None):
+        """Starts watching the list. The first check fetches its members, and only
+        the following ones report the changes."""
+
+        with self.lock:
+            if name in self.lists:
+                return
+            watched = self.lists[name] = _WatchedList(name)
+            # The first checks are spread over the interval as well
+            now = now if now is not None else time.time()
+            self.scheduleCheck( watched, now + random.uniform(0, self.interval * self.jitter) )
+
+    def unwatch(self, name):
+        with self.lock:
+            self.lists.pop(name, None)
+
+    def due(self, now):
+        """Takes the names of the lists due for a check and schedules their next checks."""
+
+        names = []
+        with self.lock:
+            while self.schedule and self.schedule[0][0] <= now:
+                scheduled, token, name = heapq.heappop(self.schedule)
+                watched = self.lists.get(name)
+                if watched is None or watched.token != token:
+                    continue
+                names.append(name)
+                self.scheduleCheck( watched, self.nextCheck(now) )
+        return names
+
+    def nextDue(self):
+        with self.lock:
+            return self.schedule[0][0] if self.schedule else None
+
+    def hintQuery(self, name):
+        if self.hint == ListWatcher.CountHint:
+            return ('count_members_of_list', (name, ))
+        return ('get_list_info', (name, ))
+
+    def hintValue(self, response):
+        if self.hint == ListWatcher.CountHint:
+            return response[0][0]
+        fields = [ field for field, datatype in List.info_query_description ]
+        return response[0][ fields.index('lastmod_datetime') ]
+
+    def checkLists(self, client, names, changes):
+        """Checks the lists over a single connection and appends the changes found,
+        without storing them."""
+
+        changed = []
+        results = client.pipeline( (self.hintQuery(name) for name in names), version = 14, window = self.window )
+        for name, response in zip(names, results):
+            watched = self.lists.get(name)
+            if watched is None:
+                continue
+            if isinstance(response, MoiraError):
+                if response.code in (constants.MR_NO_MATCH, constants.MR_LIST):
+                    changes.append( self.listRemoved(client, watched) )
+                else:
+                    watched.error = response.code
+                continue
+
+            hint = self.hintValue(response)
+            if hint != watched.hint or watched.members is None:
+                changed.append( (watched, hint) )
+
+        queries = ( ('get_members_of_list', (watched.name, )) for watched, hint in changed )
+        results = client.pipeline(queries, version = 14, window = self.window)
+        for (watched, hint), response in zip(changed, results):
+            if isinstance(response, MoiraError):
+                watched.error = response.code
+                continue
+
+            rows = frozenset( tuple(row[0:2]) for row in response )
+            fingerprint = membershipFingerprint(rows)
+            delta = None
+            if watched.members is not None and fingerprint != watched.fingerprint:
+                added = frozenset( ListMember.fromTuple(client, row) for row in rows - watched.members )
+                removed = frozenset( ListMember.fromTuple(client, row) for row in watched.members - rows )
+                delta = ListDelta(watched.name, added, removed, hint if self.hint == ListWatcher.LastModHint else None)
+            changes.append( _Change(watched, delta, hint, rows, fingerprint) )
+
+    def listRemoved(self, client, watched):
+        delta = None
+        if watched.members:
+            removed = frozenset( ListMember.fromTuple(client, row) for row in watched.members )
+            delta = ListDelta(watched.name, frozenset(), removed, removed_list = True)
+        return _Change(watched, delta, removed = True)
+
+    def apply(self, change):
+        """Stores the new state of the list found by a check."""
+
+        watched = change.watched
+        with self.lock:
+            if self.lists.get(watched.name) is not watched:
+                # The list was unwatched while it was checked
+                return
+            if change.removed:
+                del self.lists[watched.name]
+                return
+        watched.error = None
+        watched.hint = change.hint
+        watched.members = change.members
+        watched.fingerprint = change.fingerprint
+
+    def poll(self, now = None, callback = None):
+        """Checks all the lists which are due. If the callback is specified, it is
+        called with every delta, and the deltas are not returned; otherwise, the
+        list of deltas is returned.
+
+        If the checks over some of the connections fail, the error is raised after
+        the deltas found over the other connections were passed to the callback.
+        Without the callback, those deltas can not be returned, so their lists are
+        left unchanged and rescheduled to be checked again immediately."""
+
+        now = now if now is not None else time.time()
+        names = self.due(now)
+        if not names:
+            return []
+
+        shards = [ names[i::len(self.clients)] for i in range(len(self.clients)) ]
+        shard_changes = [ [] for shard in shards ]
+        errors = []
+        if len(self.clients) == 1:
+            try:
+                self.checkLists(self.clients[0], shards[0], shard_changes[0])
+            except Exception as err:
+                errors.append(err)
+                shard_changes[0] = []
+        else:
+            def check(client, shard, changes):
+                try:
+                    self.checkLists(client, shard, changes)
+                except Exception as err:
+                    errors.append(err)
+                    del changes[:]
+
+            threads = [ threading.Thread( target = check, args = args ) for args in zip(self.clients, shards, shard_changes) if args[1] ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        deltas = []
+        for changes in shard_changes:
+            for change in changes:
+                if change.delta is None:
+                    self.apply(change)
+                elif callback:
+                    callback(change.delta)
+                    self.apply(change)
+                elif errors:
+                    with self.lock:
+                        if self.lists.get(change.watched.name) is change.watched:
+                            self.scheduleCheck(change.watched, now)
+                else:
+                    deltas.append(change.delta)
+                    self.apply(change)
+
+        if errors:
+            raise errors[0]
+        return deltas
+
+    def run(self, callback, stop = None):
+        """Polls the lists until the stop event (threading.Event) is set, calling the
+        callback with every delta."""
+
+        while not (stop and stop.is_set()):
+            self.poll(callback = callback)
+
+            next_due = self.nextDue()
+            delay = self.interval if next_due is None else max( 0.0, next_due - time.time() )
+            if stop:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
@@ -0,0 +1,54 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from pymoira import backup
+from pymoira.testing import FakeClient, SyntheticGraph
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = SyntheticGraph()
+        self.root = self.graph.fanOut(3, 2)
+        self.graph.populate(5)
+        self.client = FakeClient(self.graph)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'lists.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def exportedNames(self):
+        return sorted( record['name'] for record in backup.readRecords(self.path) )
+
+    def testRecursive(self):
+        exporter = backup.exportLists(self.client, [self.root], self.path)
+        self.assertEqual( self.exportedNames(), sorted(self.graph.members) )
+        self.assertEqual( exporter.missing, set() )
+
+    def testWildcardReusesListInfo(self):
+        backup.exportLists(self.client, [], self.path, recursive = False, wildcard = '*')
+        self.assertEqual( self.exportedNames(), sorted(self.graph.members) )
+        self.assertEqual( self.client.queries['get_list_info'], 1 )
+
+    def testMissingListReported(self):
+        exporter = backup.exportLists(self.client, [self.root, 'nonexistent'], self.path)
+        self.assertEqual( exporter.missing, set(['nonexistent']) )
+
+    def testDeniedListReported(self):
+        self.graph.denied = set( [list(self.graph.members)[1]] )
+        exporter = backup.exportLists(self.client, [self.root], self.path)
+        self.assertEqual( exporter.denied, self.graph.denied )
+
+    def testCheckpointWithoutOutput(self):
+        checkpoint = os.path.join(self.directory, 'checkpoint')
+        with open(checkpoint, 'w') as checkpoint_file:
+            json.dump( { 'done' : [self.root], 'pending' : [], 'denied' : [], 'offset' : 100 }, checkpoint_file )
+
+        backup.exportLists(self.client, [self.root], self.path, checkpoint)
+        self.assertEqual( self.exportedNames(), sorted(self.graph.members) )
+        self.assertFalse( os.path.exists(checkpoint) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from pymoira.cache import DirectoryCacheBackend, QueryCache
+from pymoira.errors import *
+
+class DirectoryCacheBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testSharedResults(self):
+        result = ( ('USER', 'alice'), ('STRING', '\xff\x00binary') )
+        first = QueryCache( backend = DirectoryCacheBackend(self.path) )
+        key = first.key('get_members_of_list', ('list', ), 14)
+        first.store(key, result)
+
+        second = QueryCache( backend = DirectoryCacheBackend(self.path) )
+        self.assertEqual( second.lookup(key), result )
+
+        second.invalidate('add_member_to_list')
+        self.assertEqual( first.lookup( first.key('get_members_of_list', ('list', ), 14) ), None )
+
+    def testPrivateDirectory(self):
+        DirectoryCacheBackend(self.path)
+        self.assertEqual( stat.S_IMODE( os.stat(self.path).st_mode ) & 0o077, 0 )
+
+    def testWritableDirectoryRefused(self):
+        os.mkdir(self.path)
+        os.chmod(self.path, 0o777)
+        self.assertRaises( UserError, DirectoryCacheBackend, self.path )
+
+    def testMalformedEntryIgnored(self):
+        cache = QueryCache( backend = DirectoryCacheBackend(self.path) )
+        key = cache.key('get_members_of_list', ('list', ), 14)
+        cache.backend.set( 'result:' + key, 'cos\nsystem\n(S"true"\ntR.' )
+        self.assertEqual( cache.lookup(key), None )
+
+    def testLeastRecentlyUsedRemoved(self):
+        backend = DirectoryCacheBackend(self.path, max_bytes = 1000)
+        cache = QueryCache(backend = backend)
+        cache.invalidate('add_member_to_list')
+
+        keys = [ cache.key('get_members_of_list', ('list%i' % i, ), 14) for i in range(4) ]
+        for i, key in enumerate(keys[:3]):
+            cache.store( key, ( ('USER', str(i) * 280), ) )
+            os.utime( backend.filename('result:' + key), (1000 + i, 1000 + i) )
+        self.assertNotEqual( backend.get('result:' + keys[0]), None )
+        cache.store( keys[3], ( ('USER', '3' * 280), ) )
+
+        remaining = [ backend.get('result:' + key) is not None for key in keys ]
+        self.assertEqual( remaining, [True, False, True, True] )
+        self.assertEqual( cache.generation('members'), 1 )
+        self.assertTrue( sum( os.path.getsize( os.path.join(self.path, name) ) for name in os.listdir(self.path) ) < 1100 )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import logging
+import socket
+import threading
+import unittest
+
+from pymoira import concurrency
+from pymoira.cache import QueryCache
+from pymoira.errors import *
+from pymoira.testing import FakeClient, FakeServer, SyntheticGraph
+from pymoira import threaded
+from pymoira.threaded import SharedClient
+
+def makeServer(lists = 10):
+    graph = SyntheticGraph()
+    for i in range(lists):
+        name = graph.newList()
+        graph.addMember(name, 'USER', 'user%i' % i)
+    return FakeServer( FakeClient(graph) ), list(graph.members)
+
+class AdaptiveLimiterTest(unittest.TestCase):
+    def testIncreaseAndDecrease(self):
+        limiter = concurrency.AdaptiveLimiter(initial = 4, maximum = 10)
+        for i in range(50):
+            limiter.acquire()
+            limiter.release(0.05)
+        self.assertEqual( limiter.currentLimit(), 10 )
+
+        limiter.acquire()
+        limiter.release(1.0)
+        self.assertEqual( limiter.currentLimit(), 5 )
+        self.assertEqual( limiter.stats()['decreases'], 1 )
+
+    def testReleaseWithoutSample(self):
+        limiter = concurrency.AdaptiveLimiter(initial = 4, maximum = 10)
+        for i in range(20):
+            limiter.acquire()
+            limiter.release(0.05)
+        limit = limiter.currentLimit()
+
+        limiter.acquire()
+        limiter.release(None)
+        for i in range(20):
+            limiter.acquire()
+            limiter.release(0.05)
+
+        stats = limiter.stats()
+        self.assertEqual( stats['base_latency'], 0.05 )
+        self.assertEqual( stats['decreases'], 0 )
+        self.assertEqual( stats['in_flight'], 0 )
+        self.assertTrue( stats['limit'] >= limit )
+
+    def testOverloadError(self):
+        from pymoira.constants import MR_BUSY
+        limiter = concurrency.AdaptiveLimiter(initial = 8)
+        limiter.acquire()
+        limiter.release(0.01, MR_BUSY)
+        self.assertEqual( limiter.currentLimit(), 4 )
+        self.assertEqual( limiter.stats()['overloads'], 1 )
+
+class PipelineSlotsTest(unittest.TestCase):
+    def testResults(self):
+        server, names = makeServer()
+        limiter = concurrency.AdaptiveLimiter(initial = 2)
+        client = server.client(limiter = limiter)
+        queries = [ ('get_members_of_list', (name, )) for name in names ] + [ ('get_members_of_list', ('nonexistent', )) ]
+        results = client.queryMany(queries, window = 4)
+        self.assertEqual( [ result[0][1] for result in results[:-1] ], [ 'user%i' % i for i in range(len(names)) ] )
+        self.assertTrue( isinstance(results[-1], MoiraError) )
+        self.assertEqual( limiter.stats()['in_flight'], 0 )
+
+    def testClosedEarly(self):
+        server, names = makeServer()
+        limiter = concurrency.AdaptiveLimiter(initial = 4)
+        client = server.client(limiter = limiter)
+        queries = [ ('get_members_of_list', (name, )) for name in names ]
+        for i in range(5):
+            results = client.pipeline(queries, window = 4)
+            next(results)
+            results.close()
+            self.assertEqual( limiter.stats()['in_flight'], 0 )
+
+        # The connection stays usable after the discarded responses
+        self.assertEqual( client.query('get_members_of_list', (names[0], )), ( ('USER', 'user0'), ) )
+
+    def testConnectionFailure(self):
+        server, names = makeServer()
+        server.hangup_after = 3
+        limiter = concurrency.AdaptiveLimiter(initial = 4)
+        client = server.client(limiter = limiter)
+        queries = [ ('get_members_of_list', (name, )) for name in names ]
+        self.assertRaises( (ConnectionError, socket.error), client.queryMany, queries, window = 4 )
+        self.assertEqual( limiter.stats()['in_flight'], 0 )
+
+class SharedClientSlotsTest(unittest.TestCase):
+    def testCacheHitTakesNoSample(self):
+        server, names = makeServer()
+        limiter = concurrency.AdaptiveLimiter(initial = 4)
+        shared = SharedClient( server.client(limiter = limiter, cache = QueryCache()) )
+        try:
+            shared.query('get_members_of_list', (names[0], ))
+            base_latency = limiter.stats()['base_latency']
+            shared.query('get_members_of_list', (names[0], ))
+            stats = limiter.stats()
+            self.assertEqual( stats['base_latency'], base_latency )
+            self.assertEqual( stats['completed'], 1 )
+            self.assertEqual( stats['in_flight'], 0 )
+        finally:
+            shared.close()
+
+    def testRejectedQueryTakesNoSample(self):
+        from pymoira.constants import MR_ARGS
+        server, names = makeServer()
+        limiter = concurrency.AdaptiveLimiter(initial = 4)
+        shared = SharedClient( server.client(limiter = limiter) )
+        try:
+            shared.query('get_members_of_list', (names[0], ))
+            base_latency = limiter.stats()['base_latency']
+            future = shared.submit('get_members_of_list', (names[0], 'extra'))
+            self.assertEqual( future.exception().code, MR_ARGS )
+            stats = limiter.stats()
+            self.assertEqual( stats['base_latency'], base_latency )
+            self.assertEqual( stats['in_flight'], 0 )
+        finally:
+            shared.close()
+
+class SharedClientFailureTest(unittest.TestCase):
+    def testCallbackError(self):
+        server, names = makeServer()
+        shared = SharedClient( server.client() )
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        threaded.logger.addHandler(handler)
+        try:
+            def callback(future):
+                raise ValueError("bug in user callback")
+
+            # The response is delayed, so the callback runs on the I/O thread
+            server.fake.latency = 0.1
+            future = shared.submit('get_members_of_list', (names[0], ))
+            future.addDoneCallback(callback)
+            self.assertEqual( future.result(), ( ('USER', 'user0'), ) )
+            self.assertEqual( shared.query('get_members_of_list', (names[1], )), ( ('USER', 'user1'), ) )
+            self.assertEqual( [ record.exc_info[0] for record in records ], [ValueError] )
+        finally:
+            threaded.logger.removeHandler(handler)
+            shared.close()
+
+    def testRejectedVersion(self):
+        from pymoira.constants import MR_VERSION_HIGH
+        server, names = makeServer()
+        client = server.client()
+        server.max_version = client.version
+        shared = SharedClient(client)
+        try:
+            before = shared.submit('get_members_of_list', (names[0], ))
+            rejected = [ shared.submit('get_members_of_list', (name, ), version = 99) for name in names[:3] ]
+            after = shared.submit('get_members_of_list', (names[1], ))
+            self.assertEqual( before.result(), ( ('USER', 'user0'), ) )
+            self.assertTrue( all( future.exception().code == MR_VERSION_HIGH for future in rejected ) )
+            self.assertEqual( after.result(), ( ('USER', 'user1'), ) )
+            self.assertEqual( shared.version, server.max_version )
+            self.assertEqual( shared.submit('get_members_of_list', (names[0], ), version = 99).exception().code, MR_VERSION_HIGH )
+        finally:
+            shared.close()
+
+class SharedClientCloseTest(unittest.TestCase):
+    def testSubmitWhileClosing(self):
+        server, names = makeServer()
+        shared = SharedClient( server.client() )
+        futures = []
+
+        def submit():
+            for i in range(500):
+                try:
+                    futures.append( shared.submit('get_members_of_list', (names[i % len(names)], )) )
+                except UserError:
+                    return
+
+        threads = [ threading.Thread(target = submit) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        shared.close()
+        for thread in threads:
+            thread.join()
+
+        self.assertTrue( all( future.done() for future in futures ) )
+        self.assertRaises( UserError, shared.submit, 'get_members_of_list', (names[0], ) )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import json
+import multiprocessing
+import StringIO
+import unittest
+
+from pymoira import crawler
+from pymoira.crawler import MembershipCrawler, readSnapshot
+from pymoira.testing import FakeClient, SyntheticGraph
+
+def makeGraph():
+    graph = SyntheticGraph()
+    for i in range(50):
+        graph.newList()
+    graph.populate(10)
+    return graph
+
+# The worker processes are forked, so they inherit the graph
+graph = makeGraph()
+
+def fakeClient():
+    return FakeClient(graph)
+
+class MembershipCrawlerTest(unittest.TestCase):
+    def testSnapshot(self):
+        names = list(graph.members)
+        output = StringIO.StringIO()
+        crawler = MembershipCrawler(fakeClient, processes = 2, shard_size = 3)
+        written = crawler.run(output, names = names + ['nonexistent'])
+
+        self.assertEqual( written, len(names) )
+        self.assertEqual( crawler.missing, set( ['nonexistent'] ) )
+        output.seek(0)
+        snapshot = readSnapshot(output)
+        self.assertEqual( snapshot, dict( (name, frozenset( row[0:2] for row in rows )) for name, rows in graph.members.items() ) )
+
+        # The snapshot is written in the order of the list names
+        written_names = [ json.loads(line)['name'] for line in output.getvalue().splitlines() ]
+        self.assertEqual( written_names, sorted(names) )
+
+    def testBoundedWindow(self):
+        submitted = []
+        make_pool = multiprocessing.Pool
+
+        def countingPool(*args):
+            pool = make_pool(*args)
+            apply_async = pool.apply_async
+            def submit(*args):
+                submitted.append(args)
+                return apply_async(*args)
+            pool.apply_async = submit
+            return pool
+
+        in_flight = []
+        def progress(crawled, total):
+            in_flight.append( len(submitted) - crawled // 2 )
+
+        crawler.multiprocessing.Pool = countingPool
+        try:
+            MembershipCrawler(fakeClient, processes = 2, shard_size = 2).run( StringIO.StringIO(), names = list(graph.members), progress = progress )
+        finally:
+            crawler.multiprocessing.Pool = make_pool
+        self.assertEqual( len(submitted), 25 )
+        self.assertEqual( max(in_flight), 3 )
+
+if __name__ == '__main__':
+    unittest.main()
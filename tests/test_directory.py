@@ -0,0 +1,41 @@
+import unittest
+
+from pymoira import columnar
+from pymoira.directory import UserDirectory
+
+def userRow(login, uid, last_name, user_class = 'G', sponsor = ('NONE', 'NONE'), lastmod = '01-Jan-2020 00:00:00'):
+    return ( login, str(uid), '/bin/athena/tcsh', '', last_name, 'First', '', '1', '9%08i' % uid, user_class, '', '', '0',
+             '[DFS]', '[DFS]', sponsor[1], sponsor[0], '', '', '', lastmod, 'root', 'moira', '01-Jan-2019 00:00:00', 'root' )
+
+class UserDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = UserDirectory(None)
+        self.directory.insert( userRow('alice', 1001, 'Smith') )
+        self.directory.insert( userRow('bob', 1002, 'Smithers', 'STAFF') )
+        self.directory.insert( userRow('carol', 1003, 'Jones', sponsor = ('USER', 'alice')) )
+
+    def testColumns(self):
+        columns = self.directory.records.columns
+        for field in UserDirectory.plain_fields:
+            self.assertTrue( isinstance(columns[field], columnar.PlainStringColumn) )
+        self.assertTrue( isinstance(columns['shell'], columnar.StringColumn) )
+        self.assertEqual( columns['shell'].values, ['/bin/athena/tcsh'] )
+        self.assertEqual( self.directory.records.where('name', 'bob'), [1] )
+        self.assertEqual( self.directory.records.where('user_class', 'G'), [0, 2] )
+
+    def testLookups(self):
+        self.assertEqual( self.directory.get('bob').last_name, 'Smithers' )
+        self.assertEqual( [ user.name for user in self.directory.byUid(1003) ], ['carol'] )
+        self.assertEqual( [ user.name for user in self.directory.byClass('G') ], ['alice', 'carol'] )
+        self.assertEqual( [ user.name for user in self.directory.bySponsor( ('USER', 'alice') ) ], ['carol'] )
+        self.assertEqual( [ user.name for user in self.directory.searchLastName('smith') ], ['alice', 'bob'] )
+
+    def testRemoveAndCompact(self):
+        self.directory.remove('alice')
+        self.directory.compact()
+        self.assertEqual( len(self.directory.records), 2 )
+        self.assertEqual( [ user.name for user in self.directory ], ['bob', 'carol'] )
+        self.assertEqual( self.directory.byClass('G')[0].name, 'carol' )
+
+if __name__ == '__main__':
+    unittest.main()
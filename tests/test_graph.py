@@ -0,0 +1,107 @@
+import sys
+import unittest
+
+from pymoira import graph
+from pymoira.lists import List, ListMember, ListTracer
+from pymoira.testing import FakeClient, SyntheticGraph, generateHierarchy
+
+class ClosureIndexTest(unittest.TestCase):
+    def checkShape(self, shape, size):
+        synthetic, root = generateHierarchy(shape, size, users = 2000)
+        client = FakeClient(synthetic)
+        index = graph.ClosureIndex.fromList( List(client, root) )
+        for listname in synthetic.members:
+            expected = set( synthetic.endMembers(listname) )
+            self.assertEqual( index.members(listname), expected )
+            for key in list(expected)[:10]:
+                self.assertTrue( index.isMember(key, listname) )
+        self.assertFalse( index.isMember( ('USER', 'nobody'), root ) )
+
+    def testShapes(self):
+        for shape in ('fanout', 'chain', 'diamond', 'cycle', 'mixed'):
+            self.checkShape(shape, 20)
+
+    def testUpdateList(self):
+        synthetic = SyntheticGraph()
+        root = synthetic.chain(3)
+        names = list(synthetic.members)
+        client = FakeClient(synthetic)
+        index = graph.ClosureIndex.fromList( List(client, root) )
+        self.assertFalse( index.isMember( ('USER', 'new'), root ) )
+
+        synthetic.addMember(names[-1], 'USER', 'new')
+        index.updateList( names[-1], List(client, names[-1]).getExplicitMembers() )
+        self.assertTrue( index.isMember( ('USER', 'new'), root ) )
+        self.assertTrue( index.isMember( ('USER', 'new'), names[1] ) )
+
+    def testBitsets(self):
+        ids = [0, 7, 8, 63, 64, 1000]
+        bitset = graph._bitsetFromIds(ids)
+        self.assertEqual( list( graph._iterBits(bitset) ), ids )
+        self.assertEqual( graph._toBitset( graph._fromBitset(bitset) ), bitset )
+        self.assertEqual( graph._fromBitset(bitset), sum( 1 << i for i in ids ) )
+        self.assertTrue( all( graph._testBit(bitset, i) for i in ids ) )
+        self.assertFalse( graph._testBit(bitset, 1) or graph._testBit(bitset, 5000) )
+
+class StronglyConnectedComponentsTest(unittest.TestCase):
+    def components(self, edges):
+        nodes = sorted( set(edges) | set( node for children in edges.values() for node in children ) )
+        return graph.stronglyConnectedComponents( nodes, lambda node: edges.get(node, ()) )
+
+    def testCyclesCondensed(self):
+        edges = { 'a' : ['b'], 'b' : ['c', 'd'], 'c' : ['a'], 'd' : ['e'], 'e' : ['d', 'f'] }
+        components = self.components(edges)
+        self.assertEqual( sorted( sorted(component) for component in components ), [ ['a', 'b', 'c'], ['d', 'e'], ['f'] ] )
+
+    def testReverseTopologicalOrder(self):
+        edges = { 'a' : ['b', 'c'], 'b' : ['d'], 'c' : ['d'], 'd' : ['e'], 'e' : ['d'] }
+        components = self.components(edges)
+        position = dict( (node, i) for i, component in enumerate(components) for node in component )
+        for node, children in edges.items():
+            for child in children:
+                self.assertTrue( position[child] <= position[node] )
+
+    def testDeepChain(self):
+        depth = sys.getrecursionlimit() * 3
+        edges = dict( (i, [i + 1]) for i in range(depth) )
+        edges[depth] = [0]
+        components = self.components(edges)
+        self.assertEqual( len(components), 1 )
+        self.assertEqual( len(components[0]), depth + 1 )
+
+class ListHierarchyTest(unittest.TestCase):
+    def testExpandMatchesEndMembers(self):
+        for shape in ('chain', 'diamond', 'cycle', 'mixed'):
+            synthetic, root = generateHierarchy(shape, 10, users = 500)
+            members, inaccessible, lists = List( FakeClient(synthetic), root ).getAllMembers(include_lists = True)
+            hierarchy = graph.ListHierarchy(lists)
+            expanded = hierarchy.expand()
+            for listname in lists:
+                self.assertEqual( set( member.toTuple()[0:2] for member in expanded[listname] ), set( synthetic.endMembers(listname) ) )
+
+    def testCyclicComponentShared(self):
+        synthetic = SyntheticGraph()
+        root = synthetic.newList()
+        cycle = synthetic.cycle(4)
+        synthetic.include(root, cycle)
+        synthetic.populate(5)
+        members, inaccessible, lists = List( FakeClient(synthetic), root ).getAllMembers(include_lists = True)
+        hierarchy = graph.ListHierarchy(lists)
+
+        cycle_lists = [ name for name in synthetic.members if name != root ]
+        self.assertFalse( hierarchy.isCyclic(root) )
+        self.assertTrue( all( hierarchy.isCyclic(name) for name in cycle_lists ) )
+        expanded = hierarchy.expand()
+        self.assertTrue( all( expanded[name] is expanded[cycle] for name in cycle_lists ) )
+
+    def testTraceThroughCycle(self):
+        synthetic = SyntheticGraph()
+        root = synthetic.cycle(3)
+        names = list(synthetic.members)
+        synthetic.addMember(names[2], 'USER', 'alice')
+        client = FakeClient(synthetic)
+        tracer = ListTracer( List(client, root), strategy = List.ClientSide )
+        self.assertEqual( tracer.trace( ListMember.fromTuple(client, ('USER', 'alice')) ), [ tuple(names) ] )
+
+if __name__ == '__main__':
+    unittest.main()
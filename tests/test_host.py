@@ -0,0 +1,42 @@
+import socket
+import unittest
+
+from pymoira import client
+from pymoira.host import Host
+
+class CanonicalizeManyTest(unittest.TestCase):
+    def setUp(self):
+        self.getfqdn = socket.getfqdn
+        self.resolved = []
+        socket.getfqdn = self.resolve
+        client.default_locator.hostnames.clear()
+
+    def tearDown(self):
+        socket.getfqdn = self.getfqdn
+        client.default_locator.hostnames.clear()
+
+    def resolve(self, name):
+        if name.startswith('BROKEN'):
+            raise socket.error("lookup failed")
+        self.resolved.append(name)
+        return name.lower().replace('.mit.edu', '-canonical.mit.edu')
+
+    def testNewObjects(self):
+        hosts = [ Host(None, 'host%i' % i, canonicalize = False) for i in range(5) ] + [ Host(None, 'host1', canonicalize = False) ]
+        members = frozenset(hosts)
+
+        canonical = Host.canonicalizeMany(hosts)
+        self.assertEqual( [ host.name for host in canonical ], [ 'host%i-canonical.mit.edu' % i for i in range(5) ] + [ 'host1-canonical.mit.edu' ] )
+        self.assertEqual( sorted(self.resolved), [ 'HOST%i.MIT.EDU' % i for i in range(5) ] )
+
+        # The original hosts are unchanged, so the set still finds them
+        self.assertEqual( hosts[0].name, 'HOST0.MIT.EDU' )
+        self.assertTrue( all( host in members for host in hosts ) )
+
+    def testFailedLookupKeepsName(self):
+        hosts = [ Host(None, 'broken', canonicalize = False), Host(None, 'fine', canonicalize = False) ]
+        canonical = Host.canonicalizeMany(hosts)
+        self.assertEqual( [ host.name for host in canonical ], [ 'BROKEN.MIT.EDU', 'fine-canonical.mit.edu' ] )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+
+from pymoira.errors import *
+from pymoira.lists import List
+from pymoira.testing import FakeClient, FakeServer, SyntheticGraph
+
+class LazyLoadingTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = SyntheticGraph()
+        self.root = self.graph.newList()
+        for i in range(5):
+            self.graph.include( self.root, self.graph.newList() )
+        self.graph.include(self.root, 'vanished')
+        self.client = FakeClient(self.graph)
+
+    def sublists(self):
+        return dict( (member.name, member) for member in List(self.client, self.root).getExplicitMembers() )
+
+    def testGroupLoadedAtOnce(self):
+        sublists = self.sublists()
+        self.assertEqual( sublists['list-2'].description, 'Synthetic list' )
+        self.assertEqual( self.client.queries['get_list_info'], 6 )
+        self.assertEqual( sublists['list-3'].description, 'Synthetic list' )
+        self.assertEqual( self.client.queries['get_list_info'], 6 )
+
+    def testFailureRemembered(self):
+        sublists = self.sublists()
+        sublists['list-2'].description
+        self.assertEqual( self.client.queries['get_list_info'], 6 )
+
+        for i in range(3):
+            self.assertRaises( MoiraError, getattr, sublists['vanished'], 'description' )
+        self.assertEqual( self.client.queries['get_list_info'], 6 )
+
+    def testNoQueriesWhileStreaming(self):
+        server = FakeServer(self.client)
+        client = server.client()
+        sublists = List(client, self.root).getExplicitMembers()
+        rows = client.iterQuery( 'get_members_of_list', (self.root, ), version = 14 )
+        next(rows)
+        self.assertRaises( UserError, getattr, list(sublists)[0], 'description' )
+
+        # The connection stays usable once the streaming query is over
+        rows.close()
+        self.assertEqual( list(sublists)[0].description, 'Synthetic list' )
+
+if __name__ == '__main__':
+    unittest.main()
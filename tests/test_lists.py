@@ -0,0 +1,100 @@
+import unittest
+
+from pymoira.errors import *
+from pymoira.lists import List
+from pymoira.testing import FakeClient, FakeServer, SyntheticGraph, generateHierarchy
+
+def memberKeys(members):
+    return set( member.toTuple()[0:2] for member in members )
+
+class IterAllMembersTest(unittest.TestCase):
+    def testMatchesEndMembers(self):
+        for shape in ('fanout', 'chain', 'diamond', 'cycle', 'mixed'):
+            synthetic, root = generateHierarchy(shape, 20, users = 1000)
+            members = list( List( FakeClient(synthetic), root ).iterAllMembers(include_lists = True) )
+            self.assertEqual( len(members), len( set(members) ) )
+            self.assertEqual( memberKeys(members), set( synthetic.endMembers(root) ) )
+
+    def testEvents(self):
+        synthetic = SyntheticGraph()
+        root = synthetic.chain(2)
+        top, middle, bottom = list(synthetic.members)
+        synthetic.addMember(bottom, 'USER', 'alice')
+        synthetic.denied = set( [middle] )
+
+        known, denied = {}, set()
+        events = list( List( FakeClient(synthetic), root ).iterAllMembers(events = True, known = known, denied = denied) )
+        self.assertEqual( [ (event, str(value)) for event, value in events ], [ (List.EnterEvent, top), (List.DeniedEvent, middle) ] )
+        self.assertEqual( denied, set( [middle] ) )
+        self.assertEqual( known[middle], None )
+
+    def testClientUsableWhileIterating(self):
+        synthetic = SyntheticGraph()
+        root = synthetic.fanOut(40, 2)
+        for name in synthetic.members:
+            synthetic.addMember(name, 'USER', 'owner-of-' + name)
+        client = FakeServer( FakeClient(synthetic) ).client()
+
+        count = 0
+        for member in List(client, root).iterAllMembers(include_lists = True):
+            if type(member) == List:
+                # Loads the list information lazily, which sends queries mid-iteration
+                self.assertEqual( member.description, 'Synthetic list' )
+                self.assertEqual( client.query('get_members_of_list', (member.name, ))[-1], ('USER', 'owner-of-' + member.name) )
+            count += 1
+        self.assertEqual( count, len( synthetic.endMembers(root) ) )
+
+class BoundedExpansionTest(unittest.TestCase):
+    def testMatchesInMemoryExpansion(self):
+        synthetic, root = generateHierarchy('mixed', 20, users = 1000)
+        client = FakeClient(synthetic)
+        expected, expected_denied, expected_lists = List(client, root).getAllMembers(include_lists = True)
+
+        members, denied, lists = List(client, root).expandBounded(20000, include_lists = True)
+        try:
+            self.assertTrue( len(members.runs) > 1 and lists.db is not None )
+            self.assertEqual( memberKeys(members), memberKeys(expected) )
+            self.assertEqual( len(members), len(expected) )
+            self.assertEqual( sorted(lists), sorted(expected_lists) )
+            for name in expected_lists:
+                self.assertEqual( lists[name], expected_lists[name] )
+        finally:
+            members.close()
+            lists.close()
+
+    def testClosedIndependently(self):
+        synthetic, root = generateHierarchy('fanout', 20, users = 1000)
+        client = FakeClient(synthetic)
+        expected = memberKeys( List(client, root).getAllMembers(include_lists = True)[0] )
+
+        members, denied, lists = List(client, root).expandBounded(10000, include_lists = True)
+        lists.close()
+        self.assertEqual( memberKeys(members), expected )
+        members.close()
+
+        members, denied, lists = List(client, root).expandBounded(10000, include_lists = True)
+        members.close()
+        self.assertEqual( sorted(lists), sorted(synthetic.members) )
+        self.assertEqual( memberKeys(lists[root]), set( row[0:2] for row in synthetic.members[root] ) )
+        lists.close()
+
+    def testFirstTagKept(self):
+        synthetic = SyntheticGraph()
+        root = synthetic.newList()
+        sublist = synthetic.newList()
+        synthetic.include(root, sublist)
+        synthetic.addMember(root, 'USER', 'alice', 'z')
+        synthetic.addMember(sublist, 'USER', 'alice', 'a')
+        client = FakeClient(synthetic)
+
+        expected = List(client, root).getAllMembers(tags = True)[0]
+        members, denied, lists = List(client, root).expandBounded(1, tags = True)
+        try:
+            self.assertEqual( [ member.toTuple() for member in members ], [ member.toTuple() for member in expected ] )
+            self.assertEqual( [ member.tag for member in members ], ['z'] )
+        finally:
+            members.close()
+            lists.close()
+
+if __name__ == '__main__':
+    unittest.main()
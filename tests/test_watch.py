@@ -0,0 +1,97 @@
+import unittest
+
+from pymoira.errors import *
+from pymoira.testing import FakeClient, SyntheticGraph
+from pymoira.watch import ListWatcher
+
+class FailingClient(FakeClient):
+    def pipeline(self, queries, version = None, window = None):
+        raise ConnectionError("Connection lost")
+
+def memberNames(members):
+    return sorted( member.name for member in members )
+
+class ListWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.graph = SyntheticGraph()
+        self.names = [ self.graph.newList() for i in range(4) ]
+        for name in self.names:
+            self.graph.addMember(name, 'USER', 'owner-of-' + name)
+        self.client = FakeClient(self.graph)
+
+    def makeWatcher(self, clients = None, hint = ListWatcher.CountHint):
+        watcher = ListWatcher(clients or self.client, interval = 60, hint = hint)
+        for name in self.names:
+            watcher.watch(name, now = 0)
+        self.assertEqual( watcher.poll(now = 100), [] )
+        return watcher
+
+    def testDelta(self):
+        watcher = self.makeWatcher()
+        self.graph.addMember(self.names[1], 'USER', 'alice')
+        deltas = watcher.poll(now = 200)
+        self.assertEqual( [ delta.name for delta in deltas ], [ self.names[1] ] )
+        self.assertEqual( memberNames(deltas[0].added), ['alice'] )
+        self.assertEqual( deltas[0].removed, frozenset() )
+        self.assertEqual( watcher.poll(now = 300), [] )
+
+    def testCountHintMissesSwaps(self):
+        watcher = self.makeWatcher()
+        self.graph.members[ self.names[0] ] = [ ('USER', 'bob', '') ]
+        self.assertEqual( watcher.poll(now = 200), [] )
+
+        self.graph.addMember(self.names[0], 'USER', 'carol')
+        deltas = watcher.poll(now = 300)
+        self.assertEqual( memberNames(deltas[0].added), ['bob', 'carol'] )
+        self.assertEqual( memberNames(deltas[0].removed), [ 'owner-of-' + self.names[0] ] )
+
+    def testRemovedList(self):
+        watcher = self.makeWatcher()
+        del self.graph.members[ self.names[2] ]
+        deltas = watcher.poll(now = 200)
+        self.assertEqual( [ (delta.name, delta.removed_list) for delta in deltas ], [ (self.names[2], True) ] )
+        self.assertEqual( memberNames(deltas[0].removed), [ 'owner-of-' + self.names[2] ] )
+        self.assertFalse( self.names[2] in watcher.lists )
+
+    def changeAll(self):
+        for name in self.names:
+            self.graph.addMember(name, 'USER', 'new-in-' + name)
+
+    def testFailedShardDeliversOthers(self):
+        watcher = self.makeWatcher( [ self.client, self.client ] )
+        watcher.clients = [ self.client, FailingClient(self.graph) ]
+        self.changeAll()
+
+        delivered = []
+        self.assertRaises( ConnectionError, watcher.poll, now = 200, callback = delivered.append )
+        self.assertEqual( len(delivered), 2 )
+
+        # The lists of the failed shard are checked again on the next poll
+        watcher.clients = [ self.client ]
+        deltas = watcher.poll(now = 300)
+        self.assertEqual( sorted( delta.name for delta in delivered + deltas ), sorted(self.names) )
+
+    def testFailedShardKeepsUndelivered(self):
+        watcher = self.makeWatcher( [ self.client, self.client ] )
+        watcher.clients = [ self.client, FailingClient(self.graph) ]
+        self.changeAll()
+        self.assertRaises( ConnectionError, watcher.poll, now = 200 )
+
+        # No delta was returned, so none of the changes is lost
+        watcher.clients = [ self.client ]
+        deltas = watcher.poll(now = 200)
+        self.assertEqual( len(deltas), 2 )
+        deltas += watcher.poll(now = 300)
+        self.assertEqual( sorted( delta.name for delta in deltas ), sorted(self.names) )
+        self.assertEqual( watcher.poll(now = 400), [] )
+
+    def testRewatchScheduledOnce(self):
+        watcher = ListWatcher(self.client, interval = 60)
+        watcher.watch(self.names[0], now = 0)
+        watcher.unwatch(self.names[0])
+        watcher.watch(self.names[0], now = 0)
+        self.assertEqual( watcher.due(100), [ self.names[0] ] )
+        self.assertEqual( watcher.due(200), [ self.names[0] ] )
+
+if __name__ == '__main__':
+    unittest.main()
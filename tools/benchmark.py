@@ -0,0 +1,294 @@
+#!/usr/bin/python
+
+# This file runs the microbenchmarks of the list expansion and tracing algorithms
+# on synthetic list hierarchies (see pymoira/testing.py). For every shape and size
+# it reports the wall time, the number of queries and the peak memory of each
+# operation. Every operation is run several times in separate forked processes, so
+# the results do not depend on the memory left by the previous ones, and the best
+# of the runs is reported to reduce the noise. The peak memory is the peak of the
+# memory traced by tracemalloc where it is available (Python 3 or the
+# pytracemalloc backport), or otherwise the growth of the maximum resident set
+# size of the process, which is coarser but is available on Python 2.
+#
+# The results are compared to the baseline committed in benchmark_baseline.json;
+# the script exits with status 1 if an operation which is in the baseline fails,
+# or takes more queries, more memory or more time than in the baseline (the last
+# two multiplied by their thresholds). The times are compared relative to a
+# calibration workload timed on both machines, so the baseline recorded on one
+# machine may be used on another. The baseline is rewritten with --save-baseline
+# after an intended change.
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath(__file__) ), '..' ) )
+
+from pymoira.lists import List, ListMember, ListTracer
+from pymoira.errors import UserError
+from pymoira.graph import ClosureIndex
+from pymoira.testing import FakeClient, generateHierarchy
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+default_baseline = os.path.join( os.path.dirname( os.path.abspath(__file__) ), 'benchmark_baseline.json' )
+
+# The times and the peaks below these are too noisy to be compared
+min_compared_time = 0.01
+min_compared_peak = 4 << 20
+
+# The members traced are the ones with at most this many estimated pathways, as
+# the number of pathways grows exponentially with the depth of the diamonds
+max_traced_pathways = 1024
+
+def maxResidentSize():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, and OS X reports bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def measureHere(function, client):
+    """Runs the function and returns the dictionary with its time, the number of
+    queries and the peak memory in bytes (None if it can not be measured)."""
+
+    gc.collect()
+    client.queries.clear()
+    if tracemalloc:
+        tracemalloc.start()
+    before = maxResidentSize() if resource else None
+    started = time.time()
+    try:
+        function()
+        elapsed = time.time() - started
+        if tracemalloc:
+            peak = tracemalloc.get_traced_memory()[1]
+        else:
+            peak = maxResidentSize() - before if resource else None
+    finally:
+        if tracemalloc:
+            tracemalloc.stop()
+    return { 'seconds' : elapsed, 'queries' : sum( client.queries.values() ), 'peak_bytes' : peak }
+
+def measure(function, client):
+    """Runs the function in a forked process, see measureHere(). Raises UserError
+    if the function fails."""
+
+    if not hasattr(os, 'fork'):
+        return measureHere(function, client)
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            report = measureHere(function, client)
+        except Exception as err:
+            report = { 'error' : str(err) }
+        with os.fdopen(write_fd, 'w') as output:
+            json.dump(report, output)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as output:
+        data = output.read()
+    os.waitpid(pid, 0)
+
+    report = json.loads(data) if data else { 'error' : "the benchmark process died" }
+    if 'error' in report:
+        raise UserError(report['error'])
+    return report
+
+def measureBest(function, client, repeat):
+    """Measures the function repeat times and returns the best time and peak."""
+
+    reports = [ measure(function, client) for i in range(repeat) ]
+    best = reports[0]
+    best['seconds'] = min( report['seconds'] for report in reports )
+    if best['peak_bytes'] is not None:
+        best['peak_bytes'] = min( report['peak_bytes'] for report in reports )
+    return best
+
+def calibrate(repeat = 10):
+    """Returns the best time of a fixed workload, which relates the speed of the
+    machine to the one on which the baseline was recorded."""
+
+    graph, root = generateHierarchy('mixed', 30, users = 2000)
+    client = FakeClient(graph)
+    best = None
+    for i in range(repeat):
+        gc.collect()
+        started = time.time()
+        List(client, root).getAllMembers()
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def pathwayEstimates(graph, root):
+    """Estimates the number of inclusion pathways from the root to every list. Only
+    the inclusions leading one level deeper from the root are counted, so every
+    cycle is broken at the inclusion closing it."""
+
+    depth = { root : 0 }
+    order = [root]
+    for name in order:
+        for mtype, child, tag in graph.members[name]:
+            if mtype == ListMember.List and child not in depth:
+                depth[child] = depth[name] + 1
+                order.append(child)
+
+    counts = dict.fromkeys(order, 0)
+    counts[root] = 1
+    for name in order:
+        for mtype, child, tag in graph.members[name]:
+            if mtype == ListMember.List and depth[child] == depth[name] + 1:
+                counts[child] += counts[name]
+    return counts
+
+def traceSample(graph, root, size = 20):
+    """Returns the users on the hierarchy with few enough pathways to be traced."""
+
+    counts = pathwayEstimates(graph, root)
+    pathways = {}
+    for listname, count in counts.items():
+        for mtype, name, tag in graph.members[listname]:
+            if mtype == ListMember.User:
+                pathways[name] = pathways.get(name, 0) + count
+    names = sorted( name for name, count in pathways.items() if count <= max_traced_pathways )
+    return [ (ListMember.User, name) for name in names[:size] ]
+
+def benchmarks(client, root, graph):
+    mlist = lambda: List(client, root)
+    sample = traceSample(graph, root)
+
+    def trace():
+        tracer = ListTracer( mlist(), strategy = List.ClientSide )
+        for member in sample:
+            tracer.trace( ListMember.fromTuple(client, member) )
+
+    return [
+        ('getAllMembers', lambda: mlist().getAllMembers()),
+        ('iterAllMembers', lambda: sum( 1 for member in mlist().iterAllMembers() )),
+        ('expand/hybrid', lambda: mlist().expand( strategy = List.Hybrid )),
+        ('expand/bounded', lambda: mlist().expandBounded( 1 << 20 )[0].close()),
+        ('ClosureIndex', lambda: ClosureIndex.fromList( mlist() )),
+        ('trace x%i' % len(sample), trace),
+    ]
+
+def loadBaseline(path):
+    if not os.path.exists(path):
+        return { 'calibration_seconds' : None, 'results' : {} }
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+def saveBaseline(path, baseline):
+    with open(path, 'w') as baseline_file:
+        json.dump( baseline, baseline_file, indent = 1, sort_keys = True, separators = (',', ': ') )
+        baseline_file.write('\n')
+
+def updateBaseline(baseline, results, calibration):
+    """Adds the results to the baseline. The times kept from the previous baseline
+    are rescaled to the current calibration."""
+
+    previous = baseline['calibration_seconds']
+    if previous:
+        for result in baseline['results'].values():
+            result['seconds'] *= calibration / previous
+    baseline['calibration_seconds'] = calibration
+    baseline['results'].update(results)
+
+def regressions(results, baseline, prefixes, calibration, threshold, memory_threshold):
+    """Returns the descriptions of the results worse than the baseline. Only the
+    baseline entries starting with one of the prefixes (the shapes and sizes which
+    were run) are compared; the ones without a result are the failed operations."""
+
+    found = []
+    previous = baseline['calibration_seconds']
+    scale = calibration / previous if previous else 1.0
+    for key in sorted( baseline['results'] ):
+        if not key.startswith( tuple(prefixes) ):
+            continue
+        expected = baseline['results'][key]
+        if key not in results:
+            found.append( "%s: failed, but is in the baseline" % key )
+            continue
+
+        result = results[key]
+        if result['queries'] > expected['queries']:
+            found.append( "%s: %i queries, %i in the baseline" % (key, result['queries'], expected['queries']) )
+        limit = max( expected['seconds'] * scale, min_compared_time ) * threshold
+        if result['seconds'] > limit:
+            found.append( "%s: %.4f seconds, %.4f in the baseline after calibration" % (key, result['seconds'], expected['seconds'] * scale) )
+        if result['peak_bytes'] is not None and expected.get('peak_bytes') is not None:
+            if result['peak_bytes'] > max( expected['peak_bytes'], min_compared_peak ) * memory_threshold:
+                found.append( "%s: %s MiB peak, %s MiB in the baseline" % (key, formatPeak( result['peak_bytes'] ).strip(), formatPeak( expected['peak_bytes'] ).strip()) )
+    return found
+
+def formatPeak(peak):
+    return '%9.1f' % (peak / 1048576.0) if peak is not None else '      n/a'
+
+def main():
+    parser = argparse.ArgumentParser( description = "Benchmarks the list algorithms on synthetic hierarchies." )
+    parser.add_argument( '--shapes', default = 'fanout,chain,diamond,cycle,mixed', help = "comma-separated hierarchy shapes" )
+    parser.add_argument( '--sizes', default = '10,100,1000', help = "comma-separated hierarchy sizes" )
+    parser.add_argument( '--users', type = int, default = 10000, help = "number of distinct users" )
+    parser.add_argument( '--mean-size', type = int, default = 20, help = "mean number of users on a list" )
+    parser.add_argument( '--seed', type = int, default = 0 )
+    parser.add_argument( '--repeat', type = int, default = 3, help = "number of runs of every operation" )
+    parser.add_argument( '--baseline', default = default_baseline, help = "the baseline file to compare the results to" )
+    parser.add_argument( '--save-baseline', action = 'store_true', help = "write the results to the baseline file instead of comparing them" )
+    parser.add_argument( '--threshold', type = float, default = 1.5, help = "the slowdown relative to the baseline reported as a regression" )
+    parser.add_argument( '--memory-threshold', type = float, default = 1.25, help = "the growth of the peak memory relative to the baseline reported as a regression" )
+    args = parser.parse_args()
+
+    if not tracemalloc:
+        print( "NOTE: tracemalloc is not available, the peak memory is the growth of the maximum resident set size" )
+
+    calibration = calibrate()
+    print( "Calibration: %.4f seconds" % calibration )
+
+    print( "%-8s %6s %8s %9s  %-16s %9s %9s %8s" % ('shape', 'size', 'lists', 'members', 'operation', 'seconds', 'peak MiB', 'queries') )
+    results = {}
+    prefixes = []
+    for shape in args.shapes.split(','):
+        for size in args.sizes.split(','):
+            prefixes.append( '%s/%s/' % (shape, size) )
+            graph, root = generateHierarchy( shape, int(size), args.seed, args.users, args.mean_size )
+            client = FakeClient(graph)
+            for name, function in benchmarks(client, root, graph):
+                try:
+                    result = measureBest(function, client, args.repeat)
+                except UserError as err:
+                    print( "%-8s %6s %8i %9i  %-16s  failed: %s" % (shape, size, len(graph.members), graph.memberCount(), name, err) )
+                    continue
+                results[ '%s/%s/%s' % (shape, size, name) ] = result
+                print( "%-8s %6s %8i %9i  %-16s %9.4f %s %8i" % (shape, size, len(graph.members), graph.memberCount(), name, result['seconds'], formatPeak( result['peak_bytes'] ), result['queries']) )
+
+    baseline = loadBaseline(args.baseline)
+    if args.save_baseline:
+        updateBaseline(baseline, results, calibration)
+        saveBaseline(args.baseline, baseline)
+        print( "Saved the baseline to %s" % args.baseline )
+        return 0
+
+    found = regressions( results, baseline, prefixes, calibration, args.threshold, args.memory_threshold )
+    if found:
+        print( "\nRegressions against %s:" % args.baseline )
+        for description in found:
+            print( "  " + description )
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit( main() )
@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+# This file generates the query catalog (pymoira/queries.py) from Moira sources.
+# The first argument is path to those sources.
+
+import sys, re, os, os.path
+
+##### Read the file #####
+
+basepath = sys.argv[1]
+if not os.path.isdir(basepath):
+    print "ERROR: the specified path is not a directory"
+    exit()
+
+with open(basepath + "/server/queries2.c", "r") as queries_file_handler:
+    queries_file = queries_file_handler.read()
+
+queries_match_version = re.search( r'\$Id: (.+) \$', queries_file )
+if not queries_match_version:
+    print "ERROR: unable to parse queries2.c file correctly"
+    exit()
+
+# Strip the comments
+source = re.sub( r'/\*.*?\*/', ' ', queries_file, flags = re.DOTALL )
+
+##### Field name arrays #####
+# static char *gali_fields[] = { "name", "active", ... };
+
+fields = {}
+for name, body in re.findall( r'static\s+char\s*\*\s*(\w+)\s*\[\]\s*=\s*\{(.*?)\};', source, re.DOTALL ):
+    fields[name] = re.findall( r'"([^"]*)"', body )
+
+##### Query table #####
+# Every entry of the Queries[] array has the following fields:
+#   name, shortname, version, type, rvar, rtable, tlist, fields, vcnt, qual, argc, sort, validate
+
+def split_entry(body):
+    """Splits the body of a C structure initializer into top-level items,
+    respecting string literals (which may contain commas)."""
+
+    items = []
+    current = ""
+    in_string = False
+    i = 0
+    while i < len(body):
+        c = body[i]
+        if in_string:
+            current += c
+            if c == '\\':
+                current += body[i + 1]
+                i += 1
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+            current += c
+        elif c == ',':
+            items.append(current.strip())
+            current = ""
+        else:
+            current += c
+        i += 1
+    if current.strip():
+        items.append(current.strip())
+    return items
+
+table_match = re.search( r'struct\s+query\s+Queries\s*\[\]\s*=\s*\{(.*)\};', source, re.DOTALL )
+if not table_match:
+    print "ERROR: unable to find the query table in queries2.c"
+    exit()
+
+query_types = {
+    'MR_Q_RETRIEVE' : 'retrieve',
+    'MR_Q_UPDATE' : 'update',
+    'MR_Q_APPEND' : 'append',
+    'MR_Q_DELETE' : 'delete',
+    'MR_Q_SPECIAL' : 'special',
+    'RETRIEVE' : 'retrieve',
+    'UPDATE' : 'update',
+    'APPEND' : 'append',
+    'DELETE' : 'delete',
+    'SPECIAL' : 'special',
+}
+
+entries = []
+for body in re.findall( r'\{([^{}]*)\}', table_match.group(1) ):
+    items = split_entry(body)
+    if len(items) < 11 or not items[0].startswith('"'):
+        continue
+
+    name = items[0].strip('"')
+    shortname = items[1].strip('"')
+    version = int(items[2])
+    query_type = query_types.get(items[3], items[3].lower())
+    field_list = fields.get(items[7], [])
+    vcnt = int(items[8])
+    argc = int(items[10])
+
+    arguments = field_list[:argc]
+    if query_type == 'retrieve':
+        returns = field_list[argc:argc + vcnt]
+    else:
+        returns = []
+
+    entries.append( (name, version, shortname, query_type, arguments, returns) )
+
+if not entries:
+    print "ERROR: unable to parse the query table in queries2.c"
+    exit()
+
+##### Code file header #####
+print "# Moira query catalog, generated from Moira sources"
+print "#"
+print "# NOTE: this file was autogenerated by tools/queries_gen.py from the following files:"
+print "#         %s" % queries_match_version.group(1)
+print ""
+
+print "# (name, version) : (short name, query type, argument names, returned field names)"
+print "queries = {"
+for name, version, shortname, query_type, arguments, returns in sorted(entries):
+    print "    (%s, %i) : (%s, %s, %s, %s)," % (repr(name), version, repr(shortname), repr(query_type), repr(tuple(arguments)), repr(tuple(returns)))
+print "}"
+print ""